@@ -12,10 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import dynamodb
+from statestore import get_store
 import api
+import broadcast
+import chatindex
 import telegram
-from errors import ValidationError
+from errors import DBError, ValidationError
+from identity import Identity
 from urllib.parse import urlparse
 from settings import CONFIG, STATUSES
 from helpers import (
@@ -23,7 +26,12 @@ from helpers import (
     save_chat_status,
     get_tos_link,
     get_pp_link,
-    change_lang)
+    invalidate_info_links,
+    change_lang,
+    remember_profile,
+    menu_key,
+    TOS_LINK,
+    PP_LINK)
 import globalvars
 
 def is_url(link):
@@ -49,12 +57,14 @@ def store_tos_link(link):
     """
     if not is_url(link):
         return False
-    return dynamodb.save_info_link(
+    stored = get_store().save_info_link(
         CONFIG['INFO_DYNAMO_TABLE'],
         link,
         globalvars.lang.language,
-        'termsofservice'
+        TOS_LINK
     )
+    invalidate_info_links()
+    return stored
 
 def store_pp_link(link):
     """
@@ -65,12 +75,14 @@ def store_pp_link(link):
     """
     if not is_url(link):
         return False
-    return dynamodb.save_info_link(
+    stored = get_store().save_info_link(
         CONFIG['INFO_DYNAMO_TABLE'],
         link,
         globalvars.lang.language,
-        'privacypolicy'
+        PP_LINK
     )
+    invalidate_info_links()
+    return stored
 
 def make_admin_keyboard():
     """
@@ -88,6 +100,7 @@ def make_admin_keyboard():
             globalvars.lang.text('MENU_ADMIN_ENROLLED_USERS'),
             globalvars.lang.text('MENU_ADMIN_BANNED_USERS'),
             globalvars.lang.text('MENU_ADMIN_BLOCKED_KEYS'),
+            globalvars.lang.text('MENU_ADMIN_BROADCAST'),
             globalvars.lang.text('MENU_HOME_CHANGE_LANGUAGE'),
             globalvars.lang.text('MENU_ADMIN_EXIT')
         ],
@@ -95,6 +108,18 @@ def make_admin_keyboard():
         ''
     )
 
+def make_broadcast_keyboard(confirm):
+    """
+    Creates the keyboard of a broadcast being entered, or confirmed
+
+    :param confirm: add the button sending the broadcast
+    :return: Keyboard
+    """
+    buttons = [globalvars.lang.text('MENU_CANCEL_REQUEST')]
+    if confirm:
+        buttons.insert(0, globalvars.lang.text('MENU_ADMIN_BROADCAST_SEND'))
+    return [buttons]
+
 def admin_menu(token, tmsg, chat_status):
     """
     Handles admin only menu
@@ -106,7 +131,7 @@ def admin_menu(token, tmsg, chat_status):
     :return: False in case user should not see admin menu
     """
     if tmsg.user_uid not in CONFIG['ADMIN']:
-        save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+        save_chat_status(tmsg.identity, STATUSES['HOME'])
         return False
 
     admin_keyboard = make_admin_keyboard()
@@ -117,10 +142,10 @@ def admin_menu(token, tmsg, chat_status):
             tmsg.chat_id,
             globalvars.lang.text('MSG_ADMIN_HOME'),
             admin_keyboard)
-        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])
+        save_chat_status(tmsg.identity, STATUSES['ADMIN_SECTION_HOME'])
     elif chat_status == STATUSES['ADMIN_SECTION_HOME']:
         if (tmsg.body == globalvars.lang.text('MENU_ADMIN_EXIT')):
-            save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+            save_chat_status(tmsg.identity, STATUSES['HOME'])
             return False
         elif (tmsg.body == globalvars.lang.text('MENU_ADMIN_BAN_USER')):
             telegram.send_message(
@@ -128,14 +153,14 @@ def admin_menu(token, tmsg, chat_status):
                 tmsg.chat_id,
                 globalvars.lang.text('MSG_ENTER_USER_TO_BAN'),
                 '')
-            save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_BAN_USER'])
+            save_chat_status(tmsg.identity, STATUSES['ADMIN_SECTION_BAN_USER'])
         elif (tmsg.body == globalvars.lang.text('MENU_ADMIN_UNBAN_USER')):
             telegram.send_message(
                 token,
                 tmsg.chat_id,
                 globalvars.lang.text('MSG_ENTER_USER_TO_BAN'),
                 '')
-            save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_UNBAN_USER'])
+            save_chat_status(tmsg.identity, STATUSES['ADMIN_SECTION_UNBAN_USER'])
         elif (tmsg.body == globalvars.lang.text('MENU_ADMIN_TERMS_OF_SERVICE')):
             telegram.send_message(
                 token,
@@ -145,7 +170,7 @@ def admin_menu(token, tmsg, chat_status):
                 token,
                 tmsg.chat_id,
                 globalvars.lang.text('MSG_ENTER_TERMS_OF_SERVICE'))
-            save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_TERMS_OF_SERVICE'])
+            save_chat_status(tmsg.identity, STATUSES['ADMIN_SECTION_TERMS_OF_SERVICE'])
         elif (tmsg.body == globalvars.lang.text('MENU_ADMIN_PRIVACY_POLICY')):
             telegram.send_message(
                 token,
@@ -155,7 +180,7 @@ def admin_menu(token, tmsg, chat_status):
                 token,
                 tmsg.chat_id,
                 globalvars.lang.text('MSG_ENTER_PRIVACY_POLICY'))
-            save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_PRIVACY_POLICY'])
+            save_chat_status(tmsg.identity, STATUSES['ADMIN_SECTION_PRIVACY_POLICY'])
         elif (tmsg.body == globalvars.lang.text('MENU_ADMIN_ENROLLED_USERS')):
             try:
                 telegram.send_csv(token, tmsg.chat_id, api.get_enrolled_users(), 'enrolled_users.csv')
@@ -201,6 +226,13 @@ def admin_menu(token, tmsg, chat_status):
                 tmsg.chat_id,
                 globalvars.lang.text('MSG_ADMIN_HOME'),
                 admin_keyboard)
+        elif (tmsg.body == globalvars.lang.text('MENU_ADMIN_BROADCAST')):
+            telegram.send_keyboard(
+                token,
+                tmsg.chat_id,
+                globalvars.lang.text('MSG_ENTER_BROADCAST'),
+                make_broadcast_keyboard(confirm=False))
+            save_chat_status(tmsg.identity, STATUSES['ADMIN_SECTION_BROADCAST'])
         elif (tmsg.body == globalvars.lang.text('MENU_HOME_CHANGE_LANGUAGE')):
             keyboard = make_language_keyboard()
             telegram.send_keyboard(
@@ -208,7 +240,7 @@ def admin_menu(token, tmsg, chat_status):
                 tmsg.chat_id,
                 globalvars.lang.text('MSG_SELECT_LANGUAGE'),
                 keyboard)
-            save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SET_LANGUAGE'])
+            save_chat_status(tmsg.identity, STATUSES['ADMIN_SET_LANGUAGE'])
         else:
             telegram.send_keyboard(
                 token,
@@ -230,6 +262,8 @@ def admin_menu(token, tmsg, chat_status):
         if ret is None or ret == {}:
             message = globalvars.lang.text('MSG_BAN_ERROR')
         else:
+            # the user's next update reads the flags from the API again
+            remember_profile(Identity.from_hash(tmsg.body), None)
             message = globalvars.lang.text('MSG_BAN_SUCCESS')
         telegram.send_message(
             token,
@@ -242,7 +276,7 @@ def admin_menu(token, tmsg, chat_status):
             globalvars.lang.text('MSG_ADMIN_HOME'),
             admin_keyboard
         )
-        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])
+        save_chat_status(tmsg.identity, STATUSES['ADMIN_SECTION_HOME'])
     elif chat_status == STATUSES['ADMIN_SECTION_UNBAN_USER']:
         ret = None
         try:
@@ -257,6 +291,8 @@ def admin_menu(token, tmsg, chat_status):
         if ret is None or ret == {}:
             message = globalvars.lang.text('MSG_BAN_ERROR')
         else:
+            # the user's next update reads the flags from the API again
+            remember_profile(Identity.from_hash(tmsg.body), None)
             message = globalvars.lang.text('MSG_BAN_SUCCESS')
         telegram.send_message(
             token,
@@ -269,7 +305,7 @@ def admin_menu(token, tmsg, chat_status):
             globalvars.lang.text('MSG_ADMIN_HOME'),
             admin_keyboard
         )
-        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])
+        save_chat_status(tmsg.identity, STATUSES['ADMIN_SECTION_HOME'])
     elif chat_status == STATUSES['ADMIN_SET_LANGUAGE']:
         if (tmsg.body is None or
                 tmsg.body not in globalvars.lang.text(
@@ -278,10 +314,11 @@ def admin_menu(token, tmsg, chat_status):
         else:
             new_lang = CONFIG['SUPPORTED_LANGUAGES'][globalvars.lang.text(
                 'SUPPORTED_LANGUAGES').index(tmsg.body)]
-            dynamodb.save_user_lang(
+            get_store().save_user_lang(
                 table=CONFIG["DYNAMO_TABLE"],
-                chat_id=tmsg.chat_id,
+                chat_id=tmsg.identity,
                 language=new_lang)
+            chatindex.update(tmsg.identity, language=new_lang)
             change_lang(new_lang)
             admin_keyboard = make_admin_keyboard()
             message = globalvars.lang.text('MSG_LANGUAGE_CHANGED').format(tmsg.body)
@@ -295,13 +332,68 @@ def admin_menu(token, tmsg, chat_status):
                 tmsg.chat_id,
                 globalvars.lang.text('MSG_ADMIN_HOME'),
                 admin_keyboard)
-        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])
+        save_chat_status(tmsg.identity, STATUSES['ADMIN_SECTION_HOME'])
+    elif chat_status == STATUSES['ADMIN_SECTION_BROADCAST']:
+        # a menu button, such as cancel or one of the admin menu left on
+        # the screen, is never taken for the message
+        if not tmsg.body or menu_key(tmsg.body) is not None:
+            save_chat_status(tmsg.identity, STATUSES['ADMIN_SECTION_HOME'])
+            telegram.send_keyboard(
+                token,
+                tmsg.chat_id,
+                globalvars.lang.text('MSG_REQUEST_CANCELED'),
+                admin_keyboard
+            )
+            return True
+        try:
+            broadcast.save_draft(tmsg.identity, tmsg.body)
+        except DBError:
+            save_chat_status(tmsg.identity, STATUSES['ADMIN_SECTION_HOME'])
+            telegram.send_keyboard(
+                token,
+                tmsg.chat_id,
+                globalvars.lang.text('MSG_ERROR'),
+                admin_keyboard
+            )
+            return True
+        # the message as the users will see it
+        telegram.send_message(
+            token,
+            tmsg.chat_id,
+            tmsg.body)
+        telegram.send_keyboard(
+            token,
+            tmsg.chat_id,
+            globalvars.lang.text('MSG_CONFIRM_BROADCAST'),
+            make_broadcast_keyboard(confirm=True)
+        )
+        save_chat_status(tmsg.identity, STATUSES['ADMIN_SECTION_BROADCAST_CONFIRM'])
+    elif chat_status == STATUSES['ADMIN_SECTION_BROADCAST_CONFIRM']:
+        save_chat_status(tmsg.identity, STATUSES['ADMIN_SECTION_HOME'])
+        try:
+            text = broadcast.pop_draft(tmsg.identity)
+            if tmsg.body != globalvars.lang.text('MENU_ADMIN_BROADCAST_SEND'):
+                message = globalvars.lang.text('MSG_REQUEST_CANCELED')
+            elif text is None:
+                message = globalvars.lang.text('MSG_ERROR')
+            else:
+                job_id = broadcast.start(
+                    token, tmsg.chat_id, globalvars.lang.language, text)
+                message = globalvars.lang.text('MSG_BROADCAST_STARTED').format(job_id)
+        except DBError:
+            message = globalvars.lang.text('MSG_ERROR')
+        telegram.send_keyboard(
+            token,
+            tmsg.chat_id,
+            message,
+            admin_keyboard
+        )
     elif chat_status == STATUSES['ADMIN_SECTION_TERMS_OF_SERVICE']:
         if(store_tos_link(tmsg.body)):
             message = globalvars.lang.text('MSG_LINK_SAVED')
         else:
             message = globalvars.lang.text('MSG_LINK_ERROR')
-        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])
+        save_chat_status(tmsg.identity, STATUSES['ADMIN_SECTION_HOME'])
         telegram.send_message(
             token,
             tmsg.chat_id,
@@ -319,7 +411,7 @@ def admin_menu(token, tmsg, chat_status):
             message = globalvars.lang.text('MSG_LINK_SAVED')
         else:
             message = globalvars.lang.text('MSG_LINK_ERROR')
-        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])
+        save_chat_status(tmsg.identity, STATUSES['ADMIN_SECTION_HOME'])
         telegram.send_message(
             token,
             tmsg.chat_id,
@@ -333,7 +425,7 @@ def admin_menu(token, tmsg, chat_status):
         )
         return True
     else:
-        save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+        save_chat_status(tmsg.identity, STATUSES['HOME'])
         return False
 
     return True
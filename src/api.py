@@ -12,11 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import csv
 import json
-from helpers import hash_str
+from identity import hash_str
 import requests
 from settings import CONFIG, API_ENDPOINTS
 from log import get_logger
+from tracing import API, traced
 
 
 logger = get_logger('BeePassBot', __name__)
@@ -24,6 +26,7 @@ USER_AGENT = 'BeePass Telegram Bot'
 AUTHORIZATION_HEADER = 'Token {}'
 
 
+@traced(API)
 def get_enrolled_users(blocked=False):
     """
     Get a list of enrolled users from server
@@ -54,6 +57,7 @@ def get_enrolled_users(blocked=False):
         req.raise_for_status()
 
 
+@traced(API)
 def get_banned_users():
     """
     Get a list of enrolled users from server
@@ -82,6 +86,7 @@ def get_banned_users():
         req.raise_for_status()
 
 
+@traced(API)
 def store_chatid(username, chatid):
     """
     Store the chat id on the server so we can send messages to the user
@@ -118,6 +123,7 @@ def store_chatid(username, chatid):
         req.raise_for_status()
 
 
+@traced(API)
 def ban_user(username, ban=True):
     """
     Ban user on the server
@@ -154,6 +160,7 @@ def ban_user(username, ban=True):
         req.raise_for_status()
 
 
+@traced(API)
 def get_user(user_id):
     """
     Getting user information from server
@@ -186,6 +193,7 @@ def get_user(user_id):
         req.raise_for_status()
 
 
+@traced(API)
 def create_user(user_id, chatid, channel='TG'):
     """
     Check whether the telegram user has a beepass account
@@ -228,6 +236,7 @@ def create_user(user_id, chatid, channel='TG'):
         req.raise_for_status()
 
 
+@traced(API)
 def get_outline_server_info(server_id):
     """
     Retrieve outline server info from the api server
@@ -260,6 +269,7 @@ def get_outline_server_info(server_id):
         req.raise_for_status()
 
 
+@traced(API)
 def get_outline_user(user_id):
     """
     Check whether the telegram user has a beepass account
@@ -291,6 +301,7 @@ def get_outline_user(user_id):
         req.raise_for_status()
 
 
+@traced(API)
 def get_new_key(user_id, user_issue=None):
     """
     Get a new key for the user
@@ -336,6 +347,7 @@ def get_new_key(user_id, user_issue=None):
         req.raise_for_status()
 
 
+@traced(API)
 def get_online_config(user_id):
     """
     Getting Online Config link for a user
@@ -367,6 +379,7 @@ def get_online_config(user_id):
         req.raise_for_status()
 
 
+@traced(API)
 def get_outline_sever_id(user_id):
     """
     Check whether the telegram user has a beepass account
@@ -381,6 +394,7 @@ def get_outline_sever_id(user_id):
         return user['server']
 
 
+@traced(API)
 def get_key(user_id, user_issue=None):
     """
     Check whether the telegram user has a beepass account
@@ -396,6 +410,7 @@ def get_key(user_id, user_issue=None):
         return user['outline_key']
 
 
+@traced(API)
 def delete_user(user_id, reason_id):
     """
     Delete the user's beepass account
@@ -433,6 +448,7 @@ def delete_user(user_id, reason_id):
         req.raise_for_status()
 
 
+@traced(API)
 def get_issues(lang):
     """
     Get the list of issues from landing page server
@@ -473,6 +489,7 @@ def get_issues(lang):
         req.raise_for_status()
 
 
+@traced(API)
 def get_delete_reasons(lang):
     """
     Get the list of delete reasons from landing page server
@@ -513,6 +530,7 @@ def get_delete_reasons(lang):
         req.raise_for_status()
 
 
+@traced(API)
 def users(banned=False):
     """
     Return the list of all users or banned users
@@ -544,3 +562,81 @@ def users(banned=False):
             'API call error during all_users. status: %s',
             str(req.status_code))
         req.raise_for_status()
+
+
+def stream_users(blocked=False):
+    """
+    Streams the users CSV. It is read as it arrives, so the whole list is
+    never held in memory.
+
+    :param blocked: only the users with a key on a blocked server, the
+        list of get_enrolled_users(blocked=True)
+    :return: generator of dictionaries of the columns of each user, in the
+        order of the list
+    """
+    logger.debug("streaming users from api server")
+    if blocked:
+        url = f"{CONFIG['API_URL']}{API_ENDPOINTS['LIST_USERS']}?format=csv&blocked=True"
+    else:
+        url = f"{CONFIG['API_URL']}{API_ENDPOINTS['USERS']}?format=csv"
+    headers = {
+        'User-Agent': USER_AGENT,
+        'Authorization': AUTHORIZATION_HEADER.format(CONFIG['API_KEY'])}
+    try:
+        req = requests.get(url, headers=headers, timeout=CONFIG['API_TIMEOUT'], stream=True)
+    except Exception as error:
+        logger.error('stream_users error: {}'.format(error))
+        raise
+    with req:
+        if req.status_code != requests.codes['ok']:
+            logger.error(
+                'API call error during stream_users. status: %s',
+                str(req.status_code))
+            req.raise_for_status()
+        req.encoding = 'utf-8'
+        for row in csv.DictReader(req.iter_lines(decode_unicode=True)):
+            yield row
+
+
+def stream_notification_chats():
+    """
+    Streams the chat ids users agreed to be notified on, see store_chatid
+
+    :return: generator of chat ids in the order of the list
+    """
+    for row in stream_users():
+        if row.get('userchat'):
+            yield row['userchat']
+
+
+@traced(API)
+def get_servers():
+    """
+    Retrieve the list of outline servers from the api server
+
+    :return: list of the servers' json objects
+    """
+    logger.debug("Get outline servers")
+    url = f"{CONFIG['API_URL']}{API_ENDPOINTS['SERVERS']}"
+    headers = {
+        'User-Agent': USER_AGENT,
+        'Authorization': AUTHORIZATION_HEADER.format(CONFIG['API_KEY'])}
+    servers = []
+    while url:
+        try:
+            req = requests.get(url, headers=headers, timeout=CONFIG['API_TIMEOUT'])
+        except Exception as error:
+            logger.error('get_servers error: {}'.format(error))
+            raise
+        if req.status_code != requests.codes['ok']:
+            logger.error(
+                'API call error during get_servers. status: %s',
+                str(req.status_code))
+            req.raise_for_status()
+        json_data = json.loads(req.text)
+        if isinstance(json_data, list):
+            return servers + json_data
+        # paginated list
+        servers.extend(json_data.get('results', []))
+        url = json_data.get('next')
+    return servers
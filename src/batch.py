@@ -0,0 +1,138 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Batch Module
+Lambda entry point handling a batch of updates per invocation, such as the
+records an SQS FIFO queue grouped by chat delivers, so the cold start, the
+clients and the caches are paid for once per batch.
+
+Every record body is the event outlinebot.bot_handler takes:
+{'token': TOKEN, 'lang': LANG, 'Input': update}. Records are grouped by
+their MessageGroupId, or by the chat of their update when they have none.
+Groups are handled concurrently by up to BATCH_WORKERS threads and the
+records of a group strictly in order.
+
+The reply lists the records to retry in SQS's partial batch response
+format. A record fails when its handler raises, and the records after it
+in its group fail with it so they are not handled out of order. Records
+not started BATCH_STOP_MARGIN seconds before the Lambda timeout are left
+for the retry as well.
+
+Set the handler of the queue's function to batch.batch_handler and enable
+ReportBatchItemFailures on its event source mapping.
+"""
+
+import json
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import outlinebot
+from log import flushed
+from settings import CONFIG
+
+logger = logging.getLogger()
+
+def chat_of(update):
+    """
+    Returns the id of the chat of an update without parsing all of it
+
+    :param update: Telegram update object
+    :return: chat id or None
+    """
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat:
+            return chat.get('id')
+        sender = value.get('from') or value.get('user')
+        if sender:
+            return sender.get('id')
+    return None
+
+
+def group_records(records):
+    """
+    Groups records by ordering key, keeping their order in each group
+
+    :param records: SQS records
+    :return: list of lists of (message id, event) tuples, the events of
+        records whose body is not JSON are None
+    """
+    groups = OrderedDict()
+    for record in records:
+        try:
+            event = json.loads(record['body'])
+        except (KeyError, TypeError, ValueError):
+            event = None
+        key = (record.get('attributes') or {}).get('MessageGroupId')
+        if key is None and event is not None:
+            key = chat_of(event.get('Input') or {})
+        if key is None:
+            key = record['messageId']
+        groups.setdefault(key, []).append((record['messageId'], event))
+    return list(groups.values())
+
+
+def handle_group(group, deadline):
+    """
+    Handles the records of one group in order, stopping at the first
+    failure
+
+    :param group: list of (message id, event) tuples
+    :param deadline: time.monotonic() after which no record is started
+    :return: list of the message ids to retry
+    """
+    for index, (message_id, event) in enumerate(group):
+        if time.monotonic() > deadline:
+            return [message_id for message_id, _ in group[index:]]
+        if event is None:
+            # retrying would not make it readable
+            logger.error('[batch] Dropped unreadable record {}'.format(message_id))
+            continue
+        try:
+            outlinebot.bot_handler(event, None)
+        except Exception as exc:
+            logger.exception('[batch] Record {} failed: {}'.format(message_id, exc))
+            return [message_id for message_id, _ in group[index:]]
+    return []
+
+
+@flushed
+def batch_handler(event, context):
+    """
+    Lambda entry point of batches of updates
+
+    :param event: SQS event
+    :param context: Lambda context, to leave time for the reply
+    :return: SQS partial batch response
+    """
+    groups = group_records(event.get('Records') or [])
+    budget = float('inf')
+    if context is not None:
+        budget = (context.get_remaining_time_in_millis() / 1000.0 -
+                  CONFIG.get('BATCH_STOP_MARGIN', 10))
+    deadline = time.monotonic() + budget
+
+    failures = []
+    workers = max(1, min(CONFIG.get('BATCH_WORKERS', 8), len(groups)))
+    with ThreadPoolExecutor(workers) as pool:
+        for failed in pool.map(lambda group: handle_group(group, deadline), groups):
+            failures.extend(failed)
+    logger.info('[batch] {} records in {} groups, {} to retry'.format(
+        sum(len(group) for group in groups), len(groups), len(failures)))
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failures]}
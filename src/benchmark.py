@@ -0,0 +1,201 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Micro-benchmarks
+Times the pure-Python code that runs on every update and compares the
+results with a saved baseline.
+
+Every case is calibrated with timeit's autorange so that one sample takes
+at least 0.2 seconds, then sampled REPEAT times with the garbage collector
+disabled. The fastest sample is used as the per-call cost since it is the
+one least disturbed by the rest of the machine. Run from the src directory:
+
+    python benchmark.py --save      # record the baseline
+    python benchmark.py             # compare, exit 1 on regression
+"""
+
+import argparse
+import json
+import logging
+import platform
+import sys
+import timeit
+
+import telegram
+from helpers import change_lang, hash_str
+from identity import Identity
+from log import CustomFormatter
+from settings import CONFIG
+from tmsg import TelegramMessage, update_type
+from translation import Translation
+
+BASELINE_FILE = 'benchmark_baseline.json'
+REPEAT = 7
+DEFAULT_THRESHOLD = 0.25
+
+SENDER = {'id': 123456789, 'is_bot': False, 'first_name': 'Bee', 'username': 'beepass'}
+CHAT = {'id': 123456789, 'type': 'private', 'first_name': 'Bee'}
+
+
+def make_message(**body):
+    """
+    Builds a private chat message with the given body fields
+
+    :param body: message specific fields, e.g. text or photo
+    :return: Telegram message object
+    """
+    message = {
+        'message_id': 42,
+        'date': 1700000000,
+        'chat': CHAT,
+        'from': SENDER
+    }
+    message.update(body)
+    return message
+
+
+UPDATES = {
+    'text': {'message': make_message(text='🌏 Get a key')},
+    'command': {'message': make_message(text='/start c29tZXRoaW5n')},
+    'document': {'message': make_message(
+        document={'file_id': 'BQACAgQAAxkBAAIB', 'mime_type': 'application/pdf'})},
+    'location': {'message': make_message(
+        location={'latitude': 35.6892, 'longitude': 51.3890})},
+    'photo': {'message': make_message(
+        photo=[{'file_id': 'AgACAgQAAxkBAAIC1'}, {'file_id': 'AgACAgQAAxkBAAIC2'}])},
+    'voice': {'message': make_message(voice={'file_id': 'AwACAgQAAxkBAAID'})},
+    'edited_message': {'edited_message': dict(
+        make_message(text='edited'), edit_date=1700000100)},
+    'inline_query': {'inline_query': {
+        'id': '4242', 'from': SENDER, 'query': 'beepass', 'offset': ''}},
+    'callback_query': {'callback_query': {
+        'id': '4343', 'from': SENDER, 'data': 'choice',
+        'message': {'message_id': 42, 'chat': CHAT}}},
+    'my_chat_member': {'my_chat_member': {
+        'chat': CHAT, 'from': SENDER, 'date': 1700000000,
+        'new_chat_member': {'status': 'kicked', 'user': SENDER}}},
+    'channel_post': {'channel_post': {
+        'message_id': 1, 'date': 1700000000,
+        'sender_chat': {'id': -100123, 'username': 'channel'},
+        'chat': {'id': -100123, 'type': 'channel'}, 'text': 'post'}},
+}
+
+
+def make_cases():
+    """
+    Builds the benchmark cases
+
+    :return: Dictionary of case names and zero argument callables
+    """
+    cases = {}
+
+    for kind, update in UPDATES.items():
+        event = {'Input': update}
+        cases['tmsg.{}'.format(kind)] = (lambda e=event: TelegramMessage(e, 'fa'))
+    cases['update_type'] = lambda: update_type(UPDATES['edited_message'])
+
+    short_items = ['1', '7', '12', '19']
+    long_items = ['Reason number {}'.format(i) for i in range(60)]
+    cases['make_keyboard.short'] = lambda: telegram.make_keyboard(short_items, 2, '')
+    cases['make_keyboard.long'] = lambda: telegram.make_keyboard(long_items, 3, 'Back')
+
+    for language in CONFIG['SUPPORTED_LANGUAGES']:
+        translation = Translation(language, CONFIG['LANGUAGE_FILE'])
+        cases['change_lang.{}'.format(language)] = (lambda l=language: change_lang(l))
+        cases['translation_text.{}'.format(language)] = (
+            lambda t=translation: t.text('MSG_HOME_ELSE'))
+
+    cases['hash_str'] = lambda: hash_str(123456789)
+    cases['identity'] = lambda: Identity(123456789, 123456789).log_id
+
+    record = logging.LogRecord(
+        'BeePassBot.outlinebot', logging.INFO, 'outlinebot.py', 42,
+        'User language is %s', ('fa',), None)
+    for style in ('NEUTRAL', 'COLORED'):
+        formatter = CustomFormatter(style)
+        cases['log_format.{}'.format(style.lower())] = (
+            lambda f=formatter: f.format(record))
+
+    return cases
+
+
+def measure(func):
+    """
+    Measures the per-call cost of a function
+
+    :param func: zero argument callable
+    :return: fastest per-call time in seconds
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=REPEAT, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BeePass bot micro-benchmarks')
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('--baseline', default=BASELINE_FILE,
+                        help='baseline file to read or write')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed slowdown over the baseline, 0.25 is 25%%')
+    parser.add_argument('--filter', default='',
+                        help='only run cases whose name contains this string')
+    args = parser.parse_args()
+
+    logging.getLogger('BeePassBot').setLevel(logging.WARNING)
+
+    baseline = {}
+    if not args.save:
+        try:
+            with open(args.baseline) as baseline_file:
+                baseline = json.load(baseline_file)['results']
+        except IOError:
+            print('No baseline at {}, run with --save first'.format(args.baseline))
+
+    results = {}
+    regressions = []
+    for name, func in make_cases().items():
+        if args.filter not in name:
+            continue
+        results[name] = measure(func)
+        line = '{:<28} {:>10.2f} us'.format(name, results[name] * 1e6)
+        if name in baseline:
+            change = results[name] / baseline[name] - 1
+            line += '   baseline {:>10.2f} us  {:+7.1%}'.format(baseline[name] * 1e6, change)
+            if change > args.threshold:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print(line)
+
+    if args.save:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': results
+            }, baseline_file, indent=2, sort_keys=True)
+        print('Baseline saved to {}'.format(args.baseline))
+        return 0
+
+    if regressions:
+        print('{} case(s) regressed more than {:.0%}: {}'.format(
+            len(regressions), args.threshold, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,281 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Broadcast Module
+Sends a message to every user who agreed to be notified, see
+api.store_chatid.
+
+A broadcast is a job (see jobs.py) whose record holds the text and the
+admin chat to report to. Recipients are streamed from the API in the order
+it lists them and sent to by a pool of workers taking from the bot's
+shared token bucket (see jobs.send_bucket) at BROADCAST_RATE messages per
+second, Telegram's global limit for bots, whatever else the bot sends.
+The message an admin enters is kept as a draft and only sent once they
+confirm it, see admin.admin_menu.
+
+Chats that blocked the bot or no longer exist are counted as blocked,
+never retried and recorded in the chat index (see chatindex.py). Chats the
+index already knows as blocked are skipped without a call. Rate limited
+calls wait for the retry_after Telegram gives.
+
+    python broadcast.py --status JOB
+    python broadcast.py --cancel JOB
+    python broadcast.py --resume JOB --token TOKEN   # after a crashed run
+"""
+
+import argparse
+import json
+import logging
+import threading
+import time
+
+import requests
+
+import api
+import chatindex
+import jobs
+import telegram
+from errors import DBError, TelegramError
+from identity import hashed_chat_id
+from statestore import get_store
+from translation import Translation
+from settings import CONFIG
+
+logger = logging.getLogger()
+
+JOB_KIND = 'broadcast'
+EVENT = 'Broadcast'
+
+# outcome of chats the chat index knows as blocked
+SKIPPED = 'skipped'
+
+MAX_ATTEMPTS = 3
+
+# message entered by an admin, until they send or cancel it
+DRAFT_KIND = 'broadcast-draft'
+DRAFT_TTL = 3600
+
+
+def deliver(token, chat_id, text, bucket, session, parse=None):
+    """
+    Sends the message to one chat, retrying rate limits and transient
+    failures
+
+    :return: telegram.DELIVERY_SENT, DELIVERY_BLOCKED or DELIVERY_FAILED
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        bucket.take()
+        outcome, retry_after = telegram.deliver_message(token, chat_id, text, session, parse)
+        if outcome != telegram.DELIVERY_RETRY:
+            return outcome
+        if retry_after:
+            logger.warning('[broadcast] Rate limited for {}s'.format(retry_after))
+            bucket.pause(retry_after)
+        else:
+            time.sleep(2 ** attempt)
+    return telegram.DELIVERY_FAILED
+
+
+def deliver_all(token, chat_id, messages, bucket, session):
+    """
+    Sends messages to one chat in order, stopping at the first that does
+    not go through. Chats found blocked are recorded in the chat index.
+
+    :param messages: list of (text, parse) tuples
+    :return: outcome of the last message sent
+    """
+    outcome = telegram.DELIVERY_SENT
+    for text, parse in messages:
+        outcome = deliver(token, chat_id, text, bucket, session, parse)
+        if outcome != telegram.DELIVERY_SENT:
+            break
+    if outcome == telegram.DELIVERY_BLOCKED:
+        try:
+            chatindex.mark_blocked(chat_id)
+        except DBError as error:
+            logger.warning('[broadcast] Unable to index a blocked chat: {}'.format(str(error)))
+    return outcome
+
+
+class Reporter(object):
+    """
+    Keeps the admin posted by editing one progress message, at most every
+    BROADCAST_REPORT_INTERVAL seconds
+    """
+
+    def __init__(self, token, kind, job_id, job):
+        self.token = token
+        self.kind = kind
+        self.job_id = job_id
+        self.chat_id = job['admin_chat_id']
+        self.lang = Translation(job.get('admin_lang', 'en'), CONFIG['LANGUAGE_FILE'])
+        self.message_id = job.get('report_message_id')
+        self.reported = 0.0
+
+    def format(self, name, job):
+        return self.lang.text(name).format(
+            self.job_id, job.get(telegram.DELIVERY_SENT, 0),
+            job.get(telegram.DELIVERY_BLOCKED, 0) + job.get(SKIPPED, 0),
+            job.get(telegram.DELIVERY_FAILED, 0), job.get('offset', 0))
+
+    def progress(self, job, force=False):
+        """ Edits the progress message, sending it the first time """
+        now = time.monotonic()
+        if not force and now - self.reported < CONFIG.get('BROADCAST_REPORT_INTERVAL', 30):
+            return
+        self.reported = now
+        text = self.format('MSG_BROADCAST_PROGRESS', job)
+        try:
+            if self.message_id is None:
+                response = telegram.send_message(self.token, self.chat_id, text)
+                self.message_id = response.json()['result']['message_id']
+                get_store().update_record(
+                    self.kind, self.job_id, values={'report_message_id': self.message_id})
+            else:
+                telegram.edit_message_text(self.token, self.chat_id, self.message_id, text)
+        except (TelegramError, ValueError, KeyError) as error:
+            logger.warning('[broadcast] Unable to report {}: {}'.format(self.job_id, str(error)))
+
+    def done(self, job):
+        """ Sends the final report """
+        try:
+            telegram.send_message(
+                self.token, self.chat_id, self.format('MSG_BROADCAST_DONE', job))
+        except TelegramError as error:
+            logger.warning('[broadcast] Unable to report {}: {}'.format(self.job_id, str(error)))
+
+
+class BroadcastJob(jobs.Job):
+    """
+    Sends the text of the job to every chat of the notification list
+    """
+
+    kind = JOB_KIND
+    event = EVENT
+
+    def __init__(self, token, context=None):
+        super(BroadcastJob, self).__init__(token, context)
+        self.workers = CONFIG.get('BROADCAST_WORKERS', 8)
+        self.page_size = CONFIG.get('BROADCAST_PAGE_SIZE', 100)
+        self.budget = CONFIG.get('BROADCAST_BUDGET', 600)
+        self.bucket = jobs.send_bucket(token)
+        self.sessions = threading.local()
+        self.blocked = set()
+        self.reporter = None
+
+    def prepare(self, job):
+        self.blocked = chatindex.blocked_chats()
+
+    def items(self, job):
+        return api.stream_notification_chats()
+
+    def session(self):
+        """ Returns the requests session of the worker """
+        if not hasattr(self.sessions, 'session'):
+            self.sessions.session = requests.Session()
+        return self.sessions.session
+
+    def handle(self, job, chat_id):
+        if hashed_chat_id(chat_id) in self.blocked:
+            return SKIPPED
+        return deliver_all(self.token, chat_id, [(job['text'], None)], self.bucket, self.session())
+
+    def progress(self, job_id, job, final=False):
+        if self.reporter is None:
+            self.reporter = Reporter(self.token, self.kind, job_id, job)
+        if final and job['status'] == jobs.DONE:
+            self.reporter.done(job)
+        else:
+            self.reporter.progress(job, force=final)
+
+
+def save_draft(identity, text):
+    """
+    Keeps the message an admin entered until they confirm it
+
+    :param identity: Identity of the admin chat
+    :raise: DBError: the draft could not be stored
+    """
+    get_store().put_record(DRAFT_KIND, identity.chat_hash, {'text': text}, ttl=DRAFT_TTL)
+
+
+def pop_draft(identity):
+    """
+    Removes the draft of an admin
+
+    :param identity: Identity of the admin chat
+    :return: text of the draft, or None if there is none or it expired
+    :raise: DBError: the state store failed
+    """
+    store = get_store()
+    draft = store.get_record(DRAFT_KIND, identity.chat_hash, consistent=True)
+    store.delete_record(DRAFT_KIND, identity.chat_hash)
+    return None if draft is None else draft['text']
+
+
+def start(token, admin_chat_id, admin_lang, text):
+    """
+    Creates a broadcast job and launches its first run
+
+    :param token: Telegram Bot Token
+    :param admin_chat_id: chat to report progress to
+    :param admin_lang: language of the reports
+    :param text: message to send
+    :return: job id
+    :raise: DBError: the job could not be stored
+    """
+    return BroadcastJob.create(token, {
+        'text': text,
+        'admin_chat_id': admin_chat_id,
+        'admin_lang': admin_lang
+    })
+
+
+def run(job_id, token, context=None):
+    """
+    Runs a broadcast from its checkpoint, see jobs.Job.run
+
+    :return: the job record, or None if the job is unknown
+    :raise: DBError: the state store failed
+    """
+    return BroadcastJob(token, context).run(job_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage broadcast jobs')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--status', metavar='JOB', help='print a job')
+    group.add_argument('--cancel', metavar='JOB', help='cancel a job')
+    group.add_argument('--resume', metavar='JOB',
+                       help='run a job from its checkpoint in the foreground')
+    parser.add_argument('--token', help='Telegram Bot Token, needed by --resume')
+    args = parser.parse_args()
+
+    if args.status:
+        job = get_store().get_record(JOB_KIND, args.status, consistent=True)
+    elif args.cancel:
+        job = BroadcastJob.cancel(args.cancel)
+    else:
+        if not args.token:
+            parser.error('--resume needs --token')
+        job = run(args.resume, args.token)
+    if job is None:
+        parser.exit(1, 'Unknown job\n')
+    job.pop('text', None)
+    print(json.dumps(job, indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
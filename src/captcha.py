@@ -12,43 +12,178 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import hashlib
+import hmac
 import logging
-from dynamodb import save_captcha, get_captcha
+import threading
+import time
+from collections import OrderedDict
+from statestore import get_store
+from identity import hashed_chat_id
 from random import randint
 import random
+from settings import CONFIG
 
 logger = logging.getLogger()
 
+# Captcha modes:
+#   stored: the operands are saved in the chat's DB item and read back
+#   signed: the answer, an expiry and a nonce, the time of the challenge,
+#           are bound with an HMAC that rides in the callback data of an
+#           inline keyboard, nothing is stored. Replays are bounded by the
+#           short CAPTCHA_TTL, and rejected within a process by an LRU of
+#           the last nonce of each chat.
+STORED_MODE = 'stored'
+SIGNED_MODE = 'signed'
+CALLBACK_PREFIX = 'cpt:'
+SIGNATURE_SIZE = 12
+NONCE_CACHE_SIZE = 10000
+
+# chat hash to the oldest nonce still accepted from the chat
+_nonces = OrderedDict()
+_nonces_lock = threading.Lock()
+
+
+def captcha_mode():
+    """
+    Returns the configured captcha mode
+    """
+    return CONFIG.get('CAPTCHA_MODE', STORED_MODE)
+
+
+def make_challenge():
+    """
+    Generate a simple addition test with 4 answers
+
+    :return: the two numbers to be added and 4 choices including the answer
+    """
+    a = randint(1, 10)
+    b = randint(1, 10)
+    choices = random.sample([n for n in range(0, 21) if n != a + b], 3)
+    choices.insert(randint(0, 3), a + b)
+    return a, b, choices
+
+
 def get_choice(table, chat_id):
     """
     Generate a simple addition test with 4 answers
 
     :param table: Table name to save the captcha to
-    :param chat_id: Telegram chat ID
+    :param chat_id: Telegram chat ID or its Identity
     :return: numbers to be added and 3 random numbers and the answer
     """
-    a = randint(1, 10)
-    b = randint(1, 10)
-    choices = random.sample(range(0, 20), 4)
-    x = randint(0, 3)
-    choices[x] = a + b
-    if save_captcha(table, chat_id, [str(a), str(b)]):
+    a, b, choices = make_challenge()
+    if get_store().save_captcha(table, chat_id, [str(a), str(b)]):
         strchoices = [str(x) for x in choices]
         return strchoices, str(a), str(b)
     return None, None, None
 
 
-def check_captcha(table, chat_id, sum):
+def check_captcha(table, chat_id, sum, choices=None):
     """
-    A simple test to check if the user is a bot
+    A simple test to check if the user is a bot. The captcha of the chat
+    state read for the update is the last one sent, a state without one was
+    read before it was saved and the captcha is read again.
 
     :param table: Table name to save the captcha to
-    :param chat_id: Telegram chat ID
+    :param chat_id: Telegram chat ID or its Identity
     :param sum: Sum of the numbers
+    :param choices: captcha of the chat state, see ChatState
     :return: True if it passed, False otherwise
     """
-    choices = get_captcha(table, chat_id)
+    if not choices:
+        choices = get_store().get_captcha(table, chat_id, consistent=True)
     if choices and sum == (int(choices[0]) + int(choices[1])):
         return True
     else:
         return False
+
+
+
+def sign_captcha(chat_id, answer, expires, nonce):
+    """
+    Signs a captcha answer for a chat
+
+    :param chat_id: Telegram chat ID or its Identity
+    :param answer: the answer to be signed
+    :param expires: unix time after which the signature is not accepted
+    :param nonce: number of the challenge, see get_signed_choice
+    :return: url-safe signature string
+    """
+    message = '{}:{}:{}:{}'.format(hashed_chat_id(chat_id), answer, expires, nonce)
+    digest = hmac.new(
+        CONFIG['CAPTCHA_SECRET'].encode('utf-8'),
+        message.encode('utf-8'),
+        hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:SIGNATURE_SIZE]).decode('ascii')
+
+
+def advance_nonce(chat_id, nonce, oldest):
+    """
+    Tells whether a nonce is still accepted from a chat and raises the
+    oldest one accepted, in the LRU of this process
+
+    :param chat_id: Telegram chat ID or its Identity
+    :param nonce: nonce of a challenge
+    :param oldest: oldest nonce to accept from now on
+    :return: False if the chat already had a newer one
+    """
+    chat_hash = hashed_chat_id(chat_id)
+    with _nonces_lock:
+        accepted = _nonces.pop(chat_hash, 0)
+        _nonces[chat_hash] = max(accepted, oldest)
+        if len(_nonces) > NONCE_CACHE_SIZE:
+            _nonces.popitem(last=False)
+    return nonce >= accepted
+
+
+def get_signed_choice(chat_id, now=None):
+    """
+    Generate a simple addition test with 4 answers and the signed callback
+    data of every answer. All the choices carry the signature of the right
+    answer and of a nonce, the time of the challenge in milliseconds, so
+    only that one verifies and older challenges of the chat are refused.
+
+    :param chat_id: Telegram chat ID or its Identity
+    :param now: current unix time, for testing
+    :return: choices, the numbers to be added and the callback data of each choice
+    """
+    a, b, choices = make_challenge()
+    now = now or time.time()
+    expires = int(now) + CONFIG['CAPTCHA_TTL']
+    nonce = int(now * 1000)
+    advance_nonce(chat_id, nonce, nonce)
+    signature = sign_captcha(chat_id, a + b, expires, nonce)
+    callbacks = [
+        '{}{}:{}:{}:{}'.format(CALLBACK_PREFIX, choice, expires, nonce, signature)
+        for choice in choices]
+    return [str(x) for x in choices], str(a), str(b), callbacks
+
+
+def check_signed_captcha(chat_id, data, now=None):
+    """
+    Verifies the callback data of a signed captcha locally. A passed
+    challenge, and the ones sent before it, are not accepted again by this
+    process.
+
+    :param chat_id: Telegram chat ID or its Identity
+    :param data: callback data of the pressed button
+    :param now: current unix time, for testing
+    :return: True if it passed, False otherwise
+    """
+    if not data or not data.startswith(CALLBACK_PREFIX):
+        return False
+    try:
+        choice, expires, nonce, signature = data[len(CALLBACK_PREFIX):].split(':')
+        choice = int(choice)
+        expires = int(expires)
+        nonce = int(nonce)
+    except ValueError:
+        return False
+    if expires < (now or time.time()):
+        return False
+    if not hmac.compare_digest(
+            sign_captcha(chat_id, choice, expires, nonce), signature):
+        return False
+    return advance_nonce(chat_id, nonce, nonce + 1)
@@ -0,0 +1,212 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Chat Index Module
+Tracks which chats can be reached, from the my_chat_member updates Telegram
+sends when a user blocks or unblocks the bot, and from the 403s of bulk
+sends. The language and opt-in flag of a chat are updated when the user
+changes them, see update.
+
+Chats are keyed by their hashed chat id and kept in state store records
+(see statestore.py):
+    chat-index                   one record per chat: active, language,
+                                 opted_in
+    chat-index:blocked:<shard>   the chats that blocked the bot
+    chat-index:<lang>:<shard>    the active chats of a language
+
+The last two only hold keys, so the chats of a language or the blocked
+chats are read with a paged query of each shard and never with a scan.
+A chat's shard is the first hex digit of its hash, which spreads every
+language over SHARDS partition keys instead of one.
+
+    python chatindex.py              # counts per language
+"""
+
+import argparse
+import logging
+import time
+
+from dynamodb import PRE_OPT_IN_STATUSES
+from errors import DBError
+from identity import hashed_chat_id
+from statestore import DEFAULT_LANGUAGE, get_store
+from settings import CONFIG
+
+logger = logging.getLogger()
+
+INDEX_KIND = 'chat-index'
+BLOCKED = 'blocked'
+SHARDS = '0123456789abcdef'
+
+# new_chat_member statuses of the bot in a private chat
+ACTIVE_MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+
+def partition(active, language, shard):
+    """ Returns the record kind listing the chats of a shard """
+    return '{}:{}:{}'.format(INDEX_KIND, language if active else BLOCKED, shard)
+
+
+def chat_partition(chat_hash, active, language):
+    """ Returns the record kind listing a chat """
+    return partition(active, language, chat_hash[0])
+
+
+def save(chat_hash, active, language, opted_in, previous):
+    """
+    Writes the entry of a chat and moves it between partitions
+
+    :param chat_hash: hashed chat id
+    :param active: the chat can be messaged
+    :param language: language of the chat
+    :param opted_in: the user accepted the terms
+    :param previous: entry of the chat as the caller read it, None if it
+        has none
+    :raise: DBError: the state store failed
+    """
+    store = get_store()
+    store.put_record(INDEX_KIND, chat_hash, {
+        'active': active,
+        'language': language,
+        'opted_in': opted_in,
+        'updated': int(time.time())
+    })
+    kind = chat_partition(chat_hash, active, language)
+    if previous is not None:
+        previous_kind = chat_partition(chat_hash, previous['active'], previous['language'])
+        if previous_kind == kind:
+            return
+        store.delete_record(previous_kind, chat_hash)
+    store.put_record(kind, chat_hash, {})
+
+
+def track(identity, member_status):
+    """
+    Records a my_chat_member update of a private chat. The language and
+    opt-in flag come from the chat state.
+
+    :param identity: Identity of the chat
+    :param member_status: new_chat_member status of the bot
+    :return: True if the index was written, False otherwise
+    """
+    store = get_store()
+    state = store.get_chat(CONFIG['DYNAMO_TABLE'], identity)
+    active = member_status in ACTIVE_MEMBER_STATUSES
+    try:
+        save(
+            identity.chat_hash,
+            active,
+            (state and state.language) or DEFAULT_LANGUAGE,
+            state is not None and state.status >= 0 and
+            state.status not in PRE_OPT_IN_STATUSES,
+            store.get_record(INDEX_KIND, identity.chat_hash, consistent=True))
+    except DBError as error:
+        logger.error('[chatindex] Unable to track {}: {}'.format(identity.log_id, str(error)))
+        return False
+    logger.info('[chatindex] {} is {}'.format(identity.log_id, 'active' if active else BLOCKED))
+    return True
+
+
+def update(identity, language=None, opted_in=None):
+    """
+    Records a change of the language or the opt-in flag of a chat. The chat
+    is active, its user is talking to the bot.
+
+    :param identity: Identity of the chat
+    :param language: new language of the chat, unchanged if None
+    :param opted_in: new opt-in flag of the chat, unchanged if None
+    :return: True if the index is up to date, False otherwise
+    """
+    store = get_store()
+    try:
+        previous = entry = store.get_record(INDEX_KIND, identity.chat_hash, consistent=True)
+        if entry is None:
+            state = store.get_chat(CONFIG['DYNAMO_TABLE'], identity)
+            entry = {
+                'active': True,
+                'language': (state and state.language) or DEFAULT_LANGUAGE,
+                'opted_in': (state is not None and state.status >= 0 and
+                             state.status not in PRE_OPT_IN_STATUSES)
+            }
+        values = (
+            True,
+            language or entry['language'],
+            entry['opted_in'] if opted_in is None else opted_in)
+        if previous is not None and values == (
+                entry['active'], entry['language'], entry['opted_in']):
+            return True
+        save(identity.chat_hash, *values, previous=previous)
+    except DBError as error:
+        logger.error('[chatindex] Unable to update {}: {}'.format(identity.log_id, str(error)))
+        return False
+    return True
+
+
+def mark_blocked(chat_id):
+    """
+    Records a chat whose messages are refused with a 403
+
+    :param chat_id: Telegram Chat ID
+    :raise: DBError: the state store failed
+    """
+    chat_hash = hashed_chat_id(chat_id)
+    entry = get_store().get_record(INDEX_KIND, chat_hash, consistent=True)
+    if entry is None:
+        save(chat_hash, False, DEFAULT_LANGUAGE, False, None)
+    elif entry['active']:
+        save(chat_hash, False, entry['language'], entry['opted_in'], entry)
+
+
+def chats(language=None, page_size=500):
+    """
+    Lists hashed chat ids from the index
+
+    :param language: list the active chats of this language, or the
+        blocked chats if None
+    :return: generator of hashed chat ids
+    :raise: DBError: the state store failed
+    """
+    for shard in SHARDS:
+        kind = partition(language is not None, language, shard)
+        start = None
+        while True:
+            records, start = get_store().query_records(kind, start, page_size)
+            for chat_hash, _ in records:
+                yield chat_hash
+            if start is None:
+                break
+
+
+def blocked_chats():
+    """
+    :return: set of the hashed ids of the chats that blocked the bot
+    :raise: DBError: the state store failed
+    """
+    return set(chats())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Count the chats in the chat index')
+    parser.add_argument('--languages', default=','.join(CONFIG['SUPPORTED_LANGUAGES']),
+                        help='comma separated languages to count active chats of')
+    args = parser.parse_args()
+
+    for language in args.languages.split(','):
+        print('{:<8} {:>10}'.format(language, sum(1 for _ in chats(language))))
+    print('{:<8} {:>10}'.format(BLOCKED, sum(1 for _ in chats())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Update Deduplication Module
+Telegram delivers a webhook update again when the bot is slow to answer
+it, which would issue keys and send messages twice.
+
+Every update_id is claimed before the update is parsed: first against the
+ids this process has seen, kept in an LRU of DEDUP_CACHE_SIZE entries, then
+with a write of an 'update' record (see statestore.py) that only succeeds
+if the record does not exist. The record lives DEDUP_TTL seconds, longer
+than Telegram keeps redelivering. A duplicate is dropped whether the first
+delivery is still in flight or done, since waiting for it would only make
+Telegram deliver it once more. An update whose handler raised is released,
+so its redelivery is handled.
+
+The state store failing does not stop updates: they are handled without
+the record. Deduplication is off while DEDUP_TTL is 0, the default, since
+the records table is not created by deploy.sh.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from errors import DBError
+from statestore import get_store
+from settings import CONFIG
+
+logger = logging.getLogger()
+
+UPDATE_KIND = 'update'
+
+_seen = OrderedDict()
+_seen_lock = threading.Lock()
+
+
+def remember(update_id):
+    """
+    Adds an update id to the LRU of this process
+
+    :return: True if the id was new to it
+    """
+    size = CONFIG.get('DEDUP_CACHE_SIZE', 10000)
+    with _seen_lock:
+        if update_id in _seen:
+            _seen.move_to_end(update_id)
+            return False
+        _seen[update_id] = None
+        if len(_seen) > size:
+            _seen.popitem(last=False)
+        return True
+
+
+def claim(update):
+    """
+    Claims an update for this delivery
+
+    :param update: Telegram update object
+    :return: True if the update has to be handled, False if it is a
+        duplicate
+    """
+    update_id = update.get('update_id')
+    ttl = CONFIG.get('DEDUP_TTL', 0)
+    if update_id is None or not ttl:
+        return True
+    update_id = str(update_id)
+    if not remember(update_id):
+        logger.info('[dedup] Dropped update {} seen by this process'.format(update_id))
+        return False
+    try:
+        claimed = get_store().put_record(
+            UPDATE_KIND, update_id, {'started': int(time.time())}, ttl=ttl, only_new=True)
+    except DBError as error:
+        logger.warning('[dedup] Unable to claim update {}: {}'.format(update_id, str(error)))
+        return True
+    if not claimed:
+        logger.info('[dedup] Dropped update {} claimed by another delivery'.format(update_id))
+    return claimed
+
+
+def release(update):
+    """
+    Forgets a claimed update, so its next delivery is handled
+
+    :param update: Telegram update object
+    """
+    update_id = update.get('update_id')
+    if update_id is None or not CONFIG.get('DEDUP_TTL', 0):
+        return
+    update_id = str(update_id)
+    with _seen_lock:
+        _seen.pop(update_id, None)
+    try:
+        get_store().delete_record(UPDATE_KIND, update_id)
+    except DBError as error:
+        logger.warning('[dedup] Unable to release update {}: {}'.format(update_id, str(error)))
@@ -12,13 +12,319 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import logging
+import threading
+import time
+from decimal import Decimal
+from functools import lru_cache
 import boto3
-from helpers import hash_str
+from botocore.config import Config
+from identity import hashed_chat_id, HASH_CACHE_SIZE
 from botocore.exceptions import ClientError
+from errors import DBError
+from log import log_payload
+from retry import AIMDLimiter, Retrier
+import tracing
+from settings import CONFIG, STATUSES
 
 logger = logging.getLogger()
 
+# Chat table key schemes:
+#   legacy:  chat_id is the SHA-512 hex string, status and captcha are strings
+#   compact: chat_id is a keyed BLAKE2 digest stored as binary, status and
+#            captcha are numbers
+#   dual:    like compact, but items missing from the compact table are read
+#            from LEGACY_DYNAMO_TABLE and lazily copied over
+LEGACY_SCHEME = 'legacy'
+COMPACT_SCHEME = 'compact'
+DUAL_SCHEME = 'dual'
+COMPACT_KEY_SIZE = 16
+
+# Info table item counting link changes, so caches can tell they are stale
+INFO_VERSION_KEY = {'language': '*', 'linktype': 'version'}
+INFO_BATCH_ATTEMPTS = 3
+
+# Chat items carry an expiry in `expires`, the table's TTL attribute. Chats
+# still in the onboarding funnel expire after CHAT_TTL_PRE_OPT_IN, the rest
+# after CHAT_TTL_POST_OPT_IN, counted from their last status write. The
+# horizon is stored next to it for the expiry index, see expiry_report.py.
+PRE_OPT_IN = 'pre'
+POST_OPT_IN = 'post'
+PRE_OPT_IN_STATUSES = frozenset(STATUSES[name] for name in (
+    'START', 'SET_LANGUAGE', 'FIRST_CAPTCHA', 'OPT_IN', 'OPT_IN_DECLINED'))
+
+_local = threading.local()
+
+# Throttled and transient failures are retried here within DB_RETRY_DEADLINE
+# seconds rather than by botocore, and raise DBError when that runs out.
+# Long-running processes can also cap the calls in flight with
+# DB_MAX_CONCURRENCY, which adapts to throttling.
+retrier = Retrier(
+    'dynamodb',
+    DBError,
+    deadline=CONFIG.get('DB_RETRY_DEADLINE', 3.0),
+    limiter=AIMDLimiter(CONFIG['DB_MAX_CONCURRENCY'])
+    if CONFIG.get('DB_MAX_CONCURRENCY') else None)
+
+
+def get_resource():
+    """
+    Returns the DynamoDB boto3 resource of the thread
+    """
+    if getattr(_local, 'resource', None) is None:
+        _local.resource = boto3.resource(
+            'dynamodb',
+            config=Config(retries={'mode': 'standard', 'max_attempts': 1}))
+    return _local.resource
+
+
+def call(operation, **kwargs):
+    """
+    Runs a DynamoDB operation through the retrier, timed as a span (see
+    tracing.py)
+
+    :param operation: bound boto3 method, e.g. table.get_item
+    :param kwargs: operation arguments
+    :return: operation response
+    :raise: DBError: throttled or unavailable until the deadline
+    :raise: ClientError: any other DynamoDB error
+    """
+    with tracing.Span(tracing.DYNAMODB, operation.__name__):
+        return retrier.call(operation, **kwargs)
+
+
+def throttle_stats():
+    """
+    Returns the DynamoDB call, throttle, retry and give-up counters of the
+    process
+    """
+    return retrier.stats()
+
+
+def get_table(table):
+    """
+    Returns a DynamoDB table, reusing the boto3 resource of the thread
+
+    :param table: DynamoDB Table Name
+    :return: boto3 Table resource
+    """
+    return get_resource().Table(table)
+
+
+def key_scheme():
+    """
+    Returns the configured key scheme of the chat table
+    """
+    return CONFIG.get('CHAT_KEY_SCHEME', LEGACY_SCHEME)
+
+
+@lru_cache(maxsize=HASH_CACHE_SIZE)
+def compact_chat_key(chat_hash):
+    """
+    Derives the compact key of a chat from its hashed id, so that
+    existing rows can be migrated without knowing the raw chat id.
+
+    :param chat_hash: SHA-512 hex string of the chat id
+    :return: binary key of COMPACT_KEY_SIZE bytes
+    """
+    return hashlib.blake2b(
+        chat_hash.encode('utf-8'),
+        key=CONFIG['CHAT_KEY_SECRET'].encode('utf-8'),
+        digest_size=COMPACT_KEY_SIZE).digest()
+
+
+def chat_key(chat_id, scheme=None):
+    """
+    Builds the DynamoDB key of a chat
+
+    :param chat_id: Telegram Chat ID or its Identity
+    :param scheme: key scheme, the configured one by default
+    :return: Key dictionary
+    """
+    chat_hash = hashed_chat_id(chat_id)
+    if (scheme or key_scheme()) == LEGACY_SCHEME:
+        return {'chat_id': str(chat_hash)}
+    return {'chat_id': compact_chat_key(chat_hash)}
+
+
+def status_value(status):
+    """ Returns chat status in the stored type of the key scheme """
+    if key_scheme() == LEGACY_SCHEME:
+        return str(status)
+    return int(status)
+
+
+def captcha_value(choices):
+    """ Returns captcha choices in the stored type of the key scheme """
+    if key_scheme() == LEGACY_SCHEME:
+        return [str(choice) for choice in choices]
+    return [int(choice) for choice in choices]
+
+
+def compact_item(item):
+    """
+    Converts a legacy chat item to the compact scheme
+
+    :param item: chat item read from the legacy table
+    :return: chat item for the compact table
+    """
+    converted = dict(item)
+    converted['chat_id'] = compact_chat_key(item['chat_id'])
+    if 'status' in item:
+        converted['status'] = int(item['status'])
+    if 'captcha' in item:
+        converted['captcha'] = [int(choice) for choice in item['captcha']]
+    return converted
+
+
+def chat_horizon(status):
+    """
+    Returns the expiry horizon of a chat status
+
+    :param status: chat status
+    :return: PRE_OPT_IN or POST_OPT_IN
+    """
+    return PRE_OPT_IN if int(status) in PRE_OPT_IN_STATUSES else POST_OPT_IN
+
+
+def horizon_ttl(horizon):
+    """ Returns the lifetime in seconds of chats in a horizon """
+    if horizon == PRE_OPT_IN:
+        return CONFIG.get('CHAT_TTL_PRE_OPT_IN', 30 * 86400)
+    return CONFIG.get('CHAT_TTL_POST_OPT_IN', 365 * 86400)
+
+
+def status_update(status, sets=(), adds=(), values=None, names=None):
+    """
+    Builds the update_item arguments of a status write. Besides the
+    status it renews the expiry of the chat and, unless the chat is
+    waiting for a captcha answer, drops the stored captcha.
+
+    :param status: chat status
+    :param sets: additional SET clauses
+    :param adds: ADD clauses
+    :param values: additional ExpressionAttributeValues
+    :param names: additional ExpressionAttributeNames
+    :return: dictionary of UpdateExpression, ExpressionAttributeValues and
+        ExpressionAttributeNames
+    """
+    horizon = chat_horizon(status)
+    expression = 'SET ' + ', '.join(
+        ['#st = :status', '#hz = :horizon', '#exp = :expires'] + list(sets))
+    values = dict(values or {}, **{
+        ':status': status_value(status),
+        ':horizon': horizon,
+        ':expires': int(time.time()) + horizon_ttl(horizon)
+    })
+    names = dict(names or {}, **{
+        '#st': 'status',
+        '#hz': 'horizon',
+        '#exp': 'expires'
+    })
+    if adds:
+        expression += ' ADD ' + ', '.join(adds)
+    if int(status) != STATUSES['FIRST_CAPTCHA']:
+        expression += ' REMOVE #cpt, #cptexp'
+        names.update({'#cpt': 'captcha', '#cptexp': 'captcha_expires'})
+    return {
+        'UpdateExpression': expression,
+        'ExpressionAttributeValues': values,
+        'ExpressionAttributeNames': names
+    }
+
+
+def chat_expired(item):
+    """ Tells whether a chat item outlived its expiry """
+    return 'expires' in item and int(item['expires']) < time.time()
+
+
+def get_chat_item(table, chat_id, consistent=True):
+    """
+    Reads the item of a chat. In dual mode an item missing from the
+    compact table is looked up in the legacy table and copied over.
+
+    :param table: DynamoDB Table Name
+    :param chat_id: Telegram Chat ID or its Identity
+    :param consistent: use a strongly consistent read
+    :return: chat item or None if there is no live item
+    :raise: ClientError: DynamoDB call failed
+    """
+    ddtable = get_table(table)
+    result = call(ddtable.get_item, ConsistentRead=consistent, Key=chat_key(chat_id))
+    if result.get('Item') and chat_expired(result['Item']):
+        # TTL deletes items up to days late, an expired chat is gone already
+        return None
+    if result.get('Item') or key_scheme() != DUAL_SCHEME:
+        return result.get('Item') or None
+
+    legacy = call(
+        get_table(CONFIG['LEGACY_DYNAMO_TABLE']).get_item,
+        ConsistentRead=consistent,
+        Key=chat_key(chat_id, LEGACY_SCHEME)).get('Item')
+    if not legacy:
+        return None
+
+    item = compact_item(legacy)
+    try:
+        call(
+            ddtable.put_item,
+            Item=item,
+            ConditionExpression='attribute_not_exists(chat_id)')
+    except ClientError as error:
+        if not is_condition_failure(error):
+            raise
+        # Migrated concurrently, the compact item is the newer one
+        return call(
+            ddtable.get_item,
+            ConsistentRead=True, Key=chat_key(chat_id)).get('Item')
+    return item
+
+
+def update_chat_item(table, chat_id, **kwargs):
+    """
+    Runs update_item on the item of a chat. In dual mode a chat that only
+    exists in the legacy table is migrated before it is updated, so the
+    update does not create a partial item.
+
+    :param table: DynamoDB Table Name
+    :param chat_id: Telegram Chat ID or its Identity
+    :param kwargs: update_item arguments other than Key
+    :return: update_item response
+    :raise: ClientError: DynamoDB call failed
+    """
+    ddtable = get_table(table)
+    if key_scheme() != DUAL_SCHEME:
+        return call(ddtable.update_item, Key=chat_key(chat_id), **kwargs)
+
+    condition = 'attribute_exists(chat_id)'
+    if 'ConditionExpression' in kwargs:
+        condition += ' AND ({})'.format(kwargs['ConditionExpression'])
+    try:
+        return call(
+            ddtable.update_item,
+            Key=chat_key(chat_id),
+            **dict(kwargs, ConditionExpression=condition))
+    except ClientError as error:
+        if not is_condition_failure(error):
+            raise
+        failure = error
+    if get_chat_item(table, chat_id) is None and 'ConditionExpression' in kwargs:
+        # Nothing to migrate, the caller's condition is what failed
+        raise failure
+    return call(ddtable.update_item, Key=chat_key(chat_id), **kwargs)
+
+
+def is_condition_failure(error):
+    """
+    Tells whether a ClientError is a failed ConditionExpression
+
+    :param error: ClientError
+    :return: True if the condition of the write did not hold
+    """
+    return error.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
+
 def save_info_link(
         table,
         link,
@@ -33,10 +339,10 @@ def save_info_link(
     :param linktype: What is the nature of link to save
     :return: True in case of success and False otherwise
     """
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
+    ddtable = get_table(table)
     try:
-        ddtable.update_item(
+        call(
+            ddtable.update_item,
             Key={
                 'language': language,
                 'linktype': linktype
@@ -50,9 +356,88 @@ def save_info_link(
             '[save_info_link] Unable to write to {}: {}'.format(table, str(error)))
         return False
 
+    try:
+        call(
+            ddtable.update_item,
+            Key=INFO_VERSION_KEY,
+            UpdateExpression='ADD #ver :one',
+            ExpressionAttributeNames={'#ver': 'version'},
+            ExpressionAttributeValues={':one': 1})
+    except ClientError as error:
+        # The link is saved, other containers pick it up when their cache expires
+        logger.warning(
+            '[save_info_link] Unable to bump version in {}: {}'.format(table, str(error)))
+
     return True
 
 
+def get_info_links(
+        table,
+        languages,
+        linktypes):
+    """
+    Reads the links of all given languages and link types and the
+    version stamp of the table in one batch.
+
+    :param table: DynamoDB Table Name
+    :param languages: languages to read
+    :param linktypes: link types to read
+    :return: tuple of a dictionary of (language, linktype) to link and the
+        version stamp, or None in case of error
+    """
+    keys = [INFO_VERSION_KEY] + [
+        {'language': language, 'linktype': linktype}
+        for language in languages for linktype in linktypes]
+    resource = get_resource()
+    request = {table: {'Keys': keys, 'ConsistentRead': True}}
+    items = []
+    try:
+        for _ in range(INFO_BATCH_ATTEMPTS):
+            result = call(resource.batch_get_item, RequestItems=request)
+            items.extend(result['Responses'].get(table, []))
+            request = result.get('UnprocessedKeys')
+            if not request:
+                break
+        else:
+            logger.error('[get_info_links] Unprocessed keys left in {}'.format(table))
+            return None
+    except ClientError as error:
+        logger.error(
+            '[get_info_links] Unable to read from {}: {}'.format(table, str(error)))
+        return None
+
+    links = {}
+    version = 0
+    for item in items:
+        if item['linktype'] == INFO_VERSION_KEY['linktype']:
+            version = int(item.get('version', 0))
+        elif 'link' in item:
+            links[(item['language'], item['linktype'])] = item['link']
+    return links, version
+
+
+def get_info_version(table):
+    """
+    Reads the version stamp of the info table, which changes on every
+    save_info_link
+
+    :param table: DynamoDB Table Name
+    :return: version number, 0 if never written, None in case of error
+    """
+    try:
+        result = call(
+            get_table(table).get_item,
+            Key=INFO_VERSION_KEY,
+            ProjectionExpression='#ver',
+            ExpressionAttributeNames={'#ver': 'version'})
+    except ClientError as error:
+        logger.error(
+            '[get_info_version] Unable to read from {}: {}'.format(table, str(error)))
+        return None
+
+    return int(result.get('Item', {}).get('version', 0))
+
+
 def get_info_link(
     table,
     language,
@@ -66,10 +451,10 @@ def get_info_link(
     :param linktype: What is the nature of link to return
     :return: Link or None in case of error
     """
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
+    ddtable = get_table(table)
     try:
-        result = ddtable.get_item(
+        result = call(
+            ddtable.get_item,
             ConsistentRead=True,
             Key={
                 'language': language,
@@ -80,7 +465,7 @@ def get_info_link(
             '[get_info_link] Unable to read from {}: {}'.format(table, str(error)))
         return None
 
-    logger.info('Result from Query is {}'.format(str(result)))
+    log_payload(logger, 'Result from Query is %s', result)
 
     if 'Item' not in result:
         return None
@@ -91,89 +476,37 @@ def get_info_link(
     return result['Item']['link']
 
 
-def save_user_lang(
-        table,
-        chat_id,
-        language):
-    """
-    Save the users' preferred language to the DB
-
-    :param table: DynamoDB Table Name
-    :param user_id: Telegram User ID
-    :param chat_id: Telegram Chat ID
-    :param language: User's preferred language
-    :return: True in case of success and False otherwise
-    """
-    chat_hash = hash_str(chat_id)
-
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
-    try:
-        ddtable.update_item(
-            Key={
-                'chat_id': str(chat_hash)
-            },
-            UpdateExpression='SET #lang = :element',
-            ExpressionAttributeValues={
-                ':element': str(language)},
-            ExpressionAttributeNames={
-                "#lang": "language"
-            })
-    except ClientError as error:
-        logger.error(
-            '[save_user_lang] Unable to read from {}: {}'.format(table, str(error)))
-        return False
-
-    return True
-
-
 def create_chat_status(
         table,
         chat_id,
         status):
     """
-    Save the users' preferred language to the DB
+    Sets the status of a chat in one upsert, creating the item with the
+    default language when it is absent. Repeating it, e.g. for a
+    redelivered /start, leaves the chat in the same state.
 
     :param table: DynamoDB Table Name
-    :param user_id: Telegram User ID
-    :param chat_id: Telegram Chat ID
+    :param chat_id: Telegram Chat ID or its Identity
     :param status: chat status
-    :return: True in case of success and False otherwise
+    :return: the chat item after the write, or None in case of error
     """
-    chat_hash = hash_str(chat_id)
-
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
-
     try:
-        result = ddtable.get_item(
-            ConsistentRead=True,
-            Key={
-                'chat_id': str(chat_hash)
-            })
+        result = update_chat_item(
+            table,
+            chat_id,
+            ReturnValues='ALL_NEW',
+            **status_update(
+                status,
+                sets=['#lang = if_not_exists(#lang, :lang)'],
+                adds=['#ver :one'],
+                values={':lang': 'en', ':one': 1},
+                names={'#lang': 'language', '#ver': 'version'}))
     except ClientError as error:
         logger.error(
-            '[get_chat_status] Unable to read from {}: {}'.format(table, str(error)))
+            '[create_chat_status] Unable to write to {}: {}'.format(table, str(error)))
         return None
 
-    if 'Item' not in result:
-        try:
-            ddtable.put_item(
-                Item={
-                    'chat_id': str(chat_hash),
-                    'status': str(status),
-                    'language': 'en',
-                    'captcha': ['1', '2']})
-        except ClientError as error:
-            logger.error(
-                '[create_chat_status] Unable to write to {}: {}'.format(table, str(error)))
-            return False
-        return True
-
-    saved = save_chat_status(table, chat_id, status)
-    if saved:
-        return True
-    return False
+    return result['Attributes']
 
 
 def save_chat_status(
@@ -181,30 +514,23 @@ def save_chat_status(
         chat_id,
         status):
     """
-    Retrieves the status of chat that is saved in the
-    DB and add a list of captcha choices.
+    Sets the status of a chat whatever its current state is, and bumps
+    its version so that pending transitions of the chat fail.
 
     :param table: DynamoDB Table Name
-    :param chat_id: Telegram Chat ID
+    :param chat_id: Telegram Chat ID or its Identity
     :param status: chat status
     :return: True or False in case of failure
     """
-    chat_hash = hash_str(chat_id)
-
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
     try:
-        ddtable.update_item(
-            Key={
-                'chat_id': str(chat_hash)
-            },
-            UpdateExpression='SET #st = :val',
-            ExpressionAttributeValues={
-                ':val': str(status)
-            },
-            ExpressionAttributeNames={
-                "#st": "status"
-            })
+        update_chat_item(
+            table,
+            chat_id,
+            **status_update(
+                status,
+                adds=['#ver :one'],
+                values={':one': 1},
+                names={'#ver': 'version'}))
     except ClientError as error:
         logger.error(
             '[save_chat_status] Unable to read from {}: {}'.format(table, str(error)))
@@ -213,6 +539,42 @@ def save_chat_status(
     return True
 
 
+def transition_chat_status(
+        table,
+        chat_id,
+        status,
+        from_status,
+        version):
+    """
+    Moves a chat to a new status if it is still in the status and version
+    it was read in.
+
+    :param table: DynamoDB Table Name
+    :param chat_id: Telegram Chat ID or its Identity
+    :param status: new chat status
+    :param from_status: status the chat was read in
+    :param version: version the chat was read in, 0 for items written
+        before versions were added
+    :raise: ClientError: DynamoDB call failed, see is_condition_failure
+    """
+    condition = '#st = :from AND #ver = :ver'
+    if version == 0:
+        condition = '#st = :from AND (attribute_not_exists(#ver) OR #ver = :ver)'
+    update_chat_item(
+        table,
+        chat_id,
+        ConditionExpression=condition,
+        **status_update(
+            status,
+            sets=['#ver = :next'],
+            values={
+                ':from': status_value(from_status),
+                ':ver': version,
+                ':next': version + 1
+            },
+            names={'#ver': 'version'}))
+
+
 def get_chat_status(
         table,
         chat_id):
@@ -222,35 +584,22 @@ def get_chat_status(
 
     :param table: DynamoDB Table Name
     :param user_id: Telegram User ID
-    :param chat_id: Telegram Chat ID
+    :param chat_id: Telegram Chat ID or its Identity
     :return: chat status or None in case of error
     """
-    chat_hash = hash_str(chat_id)
-
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
     try:
-        result = ddtable.get_item(
-            ConsistentRead=True,
-            Key={
-                'chat_id': str(chat_hash)
-            })
+        item = get_chat_item(table, chat_id, consistent=False)
     except ClientError as error:
         logger.error(
             '[get_chat_status] Unable to read from {}: {}'.format(table, str(error)))
         return -1
 
-    if 'Item' not in result:
-        logger.error(
-            '[get_chat_status] Empty response for {}'.format(chat_hash))
-        return -1
-
-    if len(result['Item']) == 0:
+    if item is None:
         logger.error(
-            '[get_chat_status] Item array as Item {}'.format(chat_hash))
+            '[get_chat_status] Empty response for {}'.format(hashed_chat_id(chat_id)))
         return -1
 
-    return result['Item']['status']
+    return item['status']
 
 
 def save_user_lang(
@@ -262,19 +611,14 @@ def save_user_lang(
 
     :param table: DynamoDB Table Name
     :param user_id: Telegram User ID
-    :param chat_id: Telegram Chat ID
+    :param chat_id: Telegram Chat ID or its Identity
     :param language: User's preferred language
     :return: True in case of success and False otherwise
     """
-    chat_hash = hash_str(chat_id)
-
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
     try:
-        ddtable.update_item(
-            Key={
-                'chat_id': str(chat_hash)
-            },
+        update_chat_item(
+            table,
+            chat_id,
             UpdateExpression='SET #lang = :element',
             ExpressionAttributeValues={
                 ':element': str(language)},
@@ -297,28 +641,20 @@ def get_user_lang(
 
     :param table: DynamoDB Table Name
     :param user_id: Telegram User ID
-    :param chat_id: Telegram Chat ID
+    :param chat_id: Telegram Chat ID or its Identity
     :return: Language or None in case of error
     """
-    chat_hash = hash_str(chat_id)
-
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
     try:
-        result = ddtable.get_item(
-            ConsistentRead=True,
-            Key={
-                'chat_id': str(chat_hash)
-            })
+        item = get_chat_item(table, chat_id, consistent=False)
     except ClientError as error:
         logger.error(
             '[get_user_lang] Unable to read from {}: {}'.format(table, str(error)))
         return None
 
-    logger.info('Result from Query is {}'.format(str(result)))
+    log_payload(logger, 'Result from Query is %s', item)
 
     try:
-        return result['Item']['language']
+        return item['language']
     except Exception as error:
         logger.error(
             '[get_user_lang] Unable to return Language'
@@ -335,24 +671,21 @@ def save_captcha(
     DB and add a list of captcha choices.
 
     :param table: DynamoDB Table Name
-    :param chat_id: Telegram Chat ID
+    :param chat_id: Telegram Chat ID or its Identity
     :param choices: Captcha numbers
     :return: True or False in case of failure
     """
-    chat_hash = hash_str(chat_id)
-
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
     try:
-        ddtable.update_item(
-            Key={
-                'chat_id': str(chat_hash)
-            },
-            UpdateExpression='SET #cpt = :element',
+        update_chat_item(
+            table,
+            chat_id,
+            UpdateExpression='SET #cpt = :element, #cptexp = :expires',
             ExpressionAttributeValues={
-                ':element': choices},
+                ':element': captcha_value(choices),
+                ':expires': int(time.time()) + CONFIG.get('CAPTCHA_STORE_TTL', 86400)},
             ExpressionAttributeNames={
-                "#cpt": "captcha"
+                "#cpt": "captcha",
+                "#cptexp": "captcha_expires"
             })
     except ClientError as error:
         logger.error(
@@ -364,36 +697,253 @@ def save_captcha(
 
 def get_captcha(
         table,
-        chat_id):
+        chat_id,
+        consistent=False):
     """
     Retrieves the status of chat that is saved in the DB.
 
     :param table: DynamoDB Table Name
     :param user_id: Telegram User ID
-    :param chat_id: Telegram Chat ID
+    :param chat_id: Telegram Chat ID or its Identity
+    :param consistent: use a strongly consistent read
     :return: Captcha choices or None in case of error
     """
-    chat_hash = hash_str(chat_id)
-
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
     try:
-        result = ddtable.get_item(
-            ConsistentRead=True,
-            Key={
-                'chat_id': str(chat_hash)
-            })
+        item = get_chat_item(table, chat_id, consistent)
     except ClientError as error:
         logger.error(
             '[get_captcha] Unable to read from {}: {}'.format(table, str(error)))
         return None
 
-    logger.info('Result from Query is {}'.format(str(result)))
+    log_payload(logger, 'Result from Query is %s', item)
 
-    if 'Item' not in result:
+    if item is None or 'captcha' not in item:
         return None
 
-    if len(result['Item']) == 0:
+    # The captcha outlives an abandoned challenge only until its own expiry
+    if int(item.get('captcha_expires', time.time())) < time.time():
+        return None
+
+    return item['captcha']
+
+
+def save_profile(
+        table,
+        chat_id,
+        profile,
+        expires=None):
+    """
+    Caches the flags of the user's account on the item of a chat. Chats
+    without an item are left alone.
+
+    :param table: DynamoDB Table Name
+    :param chat_id: Telegram Chat ID or its Identity
+    :param profile: dictionary of flags, or None to remove the cached ones
+    :param expires: epoch time the cached flags expire at
+    :return: True or False in case of failure
+    """
+    if profile is None:
+        update = {
+            'UpdateExpression': 'REMOVE #prf, #prfexp',
+            'ExpressionAttributeNames': {
+                "#prf": "profile",
+                "#prfexp": "profile_expires"
+            }}
+    else:
+        update = {
+            'UpdateExpression': 'SET #prf = :element, #prfexp = :expires',
+            'ExpressionAttributeValues': {
+                ':element': dict(profile),
+                ':expires': int(expires)},
+            'ExpressionAttributeNames': {
+                "#prf": "profile",
+                "#prfexp": "profile_expires"
+            }}
+    try:
+        update_chat_item(
+            table,
+            chat_id,
+            ConditionExpression='attribute_exists(chat_id)',
+            **update)
+    except ClientError as error:
+        if is_condition_failure(error):
+            return True
+        logger.error(
+            '[save_profile] Unable to write to {}: {}'.format(table, str(error)))
+        return False
+
+    return True
+
+
+def plain(value):
+    """
+    Converts the Decimals boto3 returns into int or float, recursively
+
+    :param value: value read from DynamoDB
+    :return: value with plain Python numbers
+    """
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return {name: plain(item) for name, item in value.items()}
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    return value
+
+
+def record_key(kind, key):
+    """ Returns the DynamoDB key of a record """
+    return {'kind': kind, 'key': str(key)}
+
+
+def record_values(item):
+    """ Returns the attributes of a record item without its keys and expiry """
+    return {name: plain(value) for name, value in item.items()
+            if name not in ('kind', 'key', 'expires')}
+
+
+def record_expired(item, now):
+    """ Tells whether a record item outlived its expiry """
+    return 'expires' in item and item['expires'] < now
+
+
+def get_record(kind, key, consistent=False):
+    """
+    Reads a record from RECORDS_DYNAMO_TABLE. Records hold job state,
+    checkpoints and markers that are not part of a chat.
+
+    :param kind: record kind, the partition key
+    :param key: record key within its kind
+    :param consistent: use a strongly consistent read
+    :return: record attributes, or None if it is missing or expired
+    :raise: ClientError: DynamoDB call failed
+    """
+    item = call(
+        get_table(CONFIG['RECORDS_DYNAMO_TABLE']).get_item,
+        ConsistentRead=consistent,
+        Key=record_key(kind, key)).get('Item')
+    if item is None or record_expired(item, time.time()):
         return None
+    return record_values(item)
+
 
-    return result['Item']['captcha']
+def put_record(kind, key, values, expires=None, only_new=False):
+    """
+    Writes a record
+
+    :param kind: record kind
+    :param key: record key within its kind
+    :param values: dictionary of attributes
+    :param expires: unix time after which the record is dropped
+    :param only_new: do not replace a live record
+    :return: True if written, False if only_new and the record exists
+    :raise: ClientError: DynamoDB call failed
+    """
+    item = dict(values, **record_key(kind, key))
+    if expires is not None:
+        item['expires'] = int(expires)
+    kwargs = {}
+    if only_new:
+        kwargs = {
+            'ConditionExpression': 'attribute_not_exists(#key) OR #exp < :now',
+            'ExpressionAttributeNames': {'#key': 'key', '#exp': 'expires'},
+            'ExpressionAttributeValues': {':now': int(time.time())}
+        }
+    try:
+        call(get_table(CONFIG['RECORDS_DYNAMO_TABLE']).put_item, Item=item, **kwargs)
+    except ClientError as error:
+        if only_new and is_condition_failure(error):
+            return False
+        raise
+    return True
+
+
+def update_record(kind, key, values=None, increments=None, expires=None):
+    """
+    Sets and increments attributes of a record, creating it if needed. A
+    record that outlived its expiry is started over.
+
+    :param kind: record kind
+    :param key: record key within its kind
+    :param values: dictionary of attributes to set
+    :param increments: dictionary of numeric attributes to add to
+    :param expires: unix time after which the record is dropped, unchanged
+        if None
+    :return: record attributes after the update
+    :raise: ClientError: DynamoDB call failed
+    """
+    names = {}
+    attribute_values = {}
+    clauses = {'SET': [], 'ADD': []}
+    fresh = dict(values or {}, **(increments or {}))
+    values = dict(values or {})
+    if expires is not None:
+        values['expires'] = int(expires)
+    for clause, attributes in (('SET', values), ('ADD', increments or {})):
+        for name, value in attributes.items():
+            index = len(names)
+            names['#a{}'.format(index)] = name
+            attribute_values[':a{}'.format(index)] = value
+            clauses[clause].append(
+                '#a{0} = :a{0}'.format(index) if clause == 'SET'
+                else '#a{0} :a{0}'.format(index))
+    expression = ' '.join(
+        '{} {}'.format(clause, ', '.join(parts))
+        for clause, parts in clauses.items() if parts)
+    names['#exp'] = 'expires'
+    while True:
+        attribute_values[':now'] = int(time.time())
+        try:
+            result = call(
+                get_table(CONFIG['RECORDS_DYNAMO_TABLE']).update_item,
+                Key=record_key(kind, key),
+                UpdateExpression=expression,
+                ConditionExpression='attribute_not_exists(#exp) OR #exp >= :now',
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=attribute_values,
+                ReturnValues='ALL_NEW')
+            return record_values(result['Attributes'])
+        except ClientError as error:
+            if not is_condition_failure(error):
+                raise
+        # Expired but not deleted by TTL yet. Replaced unless another
+        # writer started it over first, then updated again.
+        if put_record(kind, key, fresh, expires, only_new=True):
+            return fresh
+
+
+def delete_record(kind, key):
+    """
+    Deletes a record
+
+    :raise: ClientError: DynamoDB call failed
+    """
+    call(get_table(CONFIG['RECORDS_DYNAMO_TABLE']).delete_item, Key=record_key(kind, key))
+
+
+def query_records(kind, start=None, limit=100):
+    """
+    Reads a page of the records of a kind in key order
+
+    :param kind: record kind
+    :param start: key to continue after, as returned by the previous page
+    :param limit: maximum number of records
+    :return: list of (key, attributes) and the key to continue after, or
+        None on the last page
+    :raise: ClientError: DynamoDB call failed
+    """
+    kwargs = {
+        'KeyConditionExpression': '#kind = :kind',
+        'ExpressionAttributeNames': {'#kind': 'kind'},
+        'ExpressionAttributeValues': {':kind': kind},
+        'Limit': limit
+    }
+    if start is not None:
+        kwargs['ExclusiveStartKey'] = record_key(kind, start)
+    page = call(get_table(CONFIG['RECORDS_DYNAMO_TABLE']).query, **kwargs)
+    now = time.time()
+    records = [
+        (item['key'], record_values(item)) for item in page.get('Items', [])
+        if not record_expired(item, now)]
+    last = page.get('LastEvaluatedKey')
+    return records, (last['key'] if last else None)
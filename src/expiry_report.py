@@ -0,0 +1,149 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Chat Expiry Report
+Counts the chat items each expiry horizon reclaims, see dynamodb.py.
+
+The counts come from queries on CHAT_EXPIRY_INDEX, a keys-only global
+secondary index on (horizon, expires), so the table is never scanned.
+Items whose expiry has passed but are still counted are waiting for
+DynamoDB TTL, which deletes them within a few days. Items written before
+expiries were introduced get one on their next status write.
+
+    python expiry_report.py --setup        # enable TTL, create the index
+    python expiry_report.py --days 1,7,30
+"""
+
+import argparse
+import time
+
+import dynamodb
+from settings import CONFIG
+
+EXPIRES_ATTRIBUTE = 'expires'
+HORIZON_ATTRIBUTE = 'horizon'
+
+
+def setup(table, capacity):
+    """
+    Enables TTL on the chat table and creates the expiry index if they are
+    missing
+
+    :param table: DynamoDB Table Name
+    :param capacity: read and write capacity of the index on provisioned
+        tables
+    """
+    client = dynamodb.get_resource().meta.client
+    ttl = client.describe_time_to_live(TableName=table)['TimeToLiveDescription']
+    if ttl['TimeToLiveStatus'] in ('ENABLED', 'ENABLING'):
+        print('TTL is {} on {}'.format(ttl['TimeToLiveStatus'].lower(), table))
+    else:
+        client.update_time_to_live(
+            TableName=table,
+            TimeToLiveSpecification={'Enabled': True, 'AttributeName': EXPIRES_ATTRIBUTE})
+        print('Enabled TTL on {}.{}'.format(table, EXPIRES_ATTRIBUTE))
+
+    description = client.describe_table(TableName=table)['Table']
+    index_name = CONFIG['CHAT_EXPIRY_INDEX']
+    if any(index['IndexName'] == index_name
+           for index in description.get('GlobalSecondaryIndexes', [])):
+        print('Index {} exists'.format(index_name))
+        return
+
+    index = {
+        'IndexName': index_name,
+        'KeySchema': [
+            {'AttributeName': HORIZON_ATTRIBUTE, 'KeyType': 'HASH'},
+            {'AttributeName': EXPIRES_ATTRIBUTE, 'KeyType': 'RANGE'}
+        ],
+        'Projection': {'ProjectionType': 'KEYS_ONLY'}
+    }
+    billing = description.get('BillingModeSummary', {}).get('BillingMode', 'PROVISIONED')
+    if billing == 'PROVISIONED':
+        index['ProvisionedThroughput'] = {
+            'ReadCapacityUnits': capacity, 'WriteCapacityUnits': capacity}
+    client.update_table(
+        TableName=table,
+        AttributeDefinitions=[
+            {'AttributeName': HORIZON_ATTRIBUTE, 'AttributeType': 'S'},
+            {'AttributeName': EXPIRES_ATTRIBUTE, 'AttributeType': 'N'}
+        ],
+        GlobalSecondaryIndexUpdates=[{'Create': index}])
+    print('Creating index {}, it backfills in the background'.format(index_name))
+
+
+def count(table, horizon, start, end):
+    """
+    Counts the chats of a horizon expiring in [start, end)
+
+    :param table: DynamoDB Table Name
+    :param horizon: dynamodb.PRE_OPT_IN or dynamodb.POST_OPT_IN
+    :param start: unix time
+    :param end: unix time
+    :return: number of items
+    """
+    ddtable = dynamodb.get_table(table)
+    kwargs = {
+        'IndexName': CONFIG['CHAT_EXPIRY_INDEX'],
+        'Select': 'COUNT',
+        'KeyConditionExpression': '#hz = :horizon AND #exp BETWEEN :start AND :end',
+        'ExpressionAttributeNames': {
+            '#hz': HORIZON_ATTRIBUTE,
+            '#exp': EXPIRES_ATTRIBUTE
+        },
+        'ExpressionAttributeValues': {
+            ':horizon': horizon,
+            ':start': int(start),
+            ':end': int(end) - 1
+        }
+    }
+    total = 0
+    while True:
+        page = ddtable.query(**kwargs)
+        total += page['Count']
+        if 'LastEvaluatedKey' not in page:
+            return total
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report chat expiry per horizon')
+    parser.add_argument('--days', default='1,7,30',
+                        help='comma separated windows to count upcoming expiries in')
+    parser.add_argument('--setup', action='store_true',
+                        help='enable TTL and create the expiry index')
+    parser.add_argument('--index-capacity', type=int, default=5,
+                        help='index capacity units on provisioned tables')
+    args = parser.parse_args()
+
+    table = CONFIG['DYNAMO_TABLE']
+    if args.setup:
+        setup(table, args.index_capacity)
+        return
+
+    now = int(time.time())
+    windows = [int(days) for days in args.days.split(',')]
+    print('{:<6} {:>12} {:>12}'.format('', 'ttl (days)', 'overdue') + ''.join(
+        '{:>12}'.format('{}d'.format(days)) for days in windows))
+    for horizon in (dynamodb.PRE_OPT_IN, dynamodb.POST_OPT_IN):
+        overdue = count(table, horizon, 0, now)
+        upcoming = [count(table, horizon, now, now + days * 86400) for days in windows]
+        print('{:<6} {:>12} {:>12}'.format(
+            horizon, dynamodb.horizon_ttl(horizon) // 86400, overdue) + ''.join(
+                '{:>12}'.format(number) for number in upcoming))
+
+
+if __name__ == '__main__':
+    main()
@@ -12,10 +12,48 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-lang = None
-HOME_KEYBOARD = []
-BACK_TO_HOME_KEYBOARD = []
-OPT_IN_KEYBOARD = []
-OPT_IN_DECLINED_KEYBOARD = []
-REMOVE_OLD_KEY_KEYBOARD = []
-NOTIFICATION_KEYBOARD = []
+"""
+Global Variables Module
+Language and keyboards of the update being handled, read as
+globalvars.lang, globalvars.HOME_KEYBOARD and so on.
+
+helpers.change_lang sets them in a context variable instead of on this
+module, so the updates handled at the same time on different threads or
+asyncio tasks of a process each read their own.
+"""
+
+import contextvars
+
+
+class UpdateContext(object):
+    """
+    Language and keyboards of one update
+    """
+    __slots__ = ('lang', 'HOME_KEYBOARD', 'BACK_TO_HOME_KEYBOARD', 'OPT_IN_KEYBOARD',
+                 'OPT_IN_DECLINED_KEYBOARD', 'REMOVE_OLD_KEY_KEYBOARD',
+                 'NOTIFICATION_KEYBOARD')
+
+    def __init__(self, lang=None, **keyboards):
+        """
+        :param lang: Translation of the update
+        :param keyboards: keyboards by name, the ones missing are empty
+        """
+        self.lang = lang
+        for name in self.__slots__[1:]:
+            setattr(self, name, keyboards.pop(name, []))
+        if keyboards:
+            raise TypeError('Unknown keyboards: {}'.format(', '.join(keyboards)))
+
+
+_context = contextvars.ContextVar('update_context', default=UpdateContext())
+
+
+def set_context(context):
+    """ Makes context the one of the update being handled """
+    _context.set(context)
+
+
+def __getattr__(name):
+    if name in UpdateContext.__slots__:
+        return getattr(_context.get(), name)
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
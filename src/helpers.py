@@ -12,33 +12,99 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import dynamodb
-import hashlib
+import threading
+import time
+from statestore import get_store
 import telegram
 from translation import Translation
 from settings import CONFIG, STATUSES
 import globalvars
 from log import get_logger
+from identity import hash_str
+from errors import DBError
 
 
 logger = get_logger('BeePassBot', __name__)
 
+TOS_LINK = 'termsofservice'
+PP_LINK = 'privacypolicy'
+INFO_LINK_TYPES = (TOS_LINK, PP_LINK)
+
+# Links of all languages, reloaded after INFO_CACHE_TTL seconds or when the
+# version stamp of the info table, checked every INFO_VERSION_CHECK
+# seconds, changes. The lock guards the cache only: one thread at a time
+# reads the table, flagged by refreshing, while the others keep serving
+# the cached links.
+_info_cache = {'links': None, 'version': None, 'loaded': 0, 'checked': 0,
+               'refreshing': False, 'retry_at': 0, 'generation': 0}
+_info_lock = threading.Lock()
+# notified when a refresh ends
+_info_refreshed = threading.Condition(_info_lock)
+
+# seconds before a failed reload of the links is tried again
+INFO_RETRY_DELAY = 30
+# seconds a lookup waits for the first load of the links in another thread
+INFO_LOAD_WAIT = 10
+
+# menu key of every menu text, by language
+_menu_keys = {}
+
 
 def save_chat_status(chat_id, status):
     """
-    Saves chat state
+    Saves chat state. If the chat was read for this update, the write is
+    a transition from that state and is dropped when another update has
+    moved the chat in the meantime.
 
-    :param chat_id: Telegram Chat ID
+    :param chat_id: Telegram Chat ID or its Identity
     :param status: state
     :return: True if stored, False otherwise
     """
-    return dynamodb.save_chat_status(
+    return get_store().save_chat_status(
         table=CONFIG['DYNAMO_TABLE'],
         chat_id=chat_id,
-        status=status
+        status=status,
+        expected=getattr(chat_id, 'state', None)
     )
 
 
+def profile_flags(vpnuser, config_link=None):
+    """
+    Derives the profile flags cached on a chat from a user of the API
+
+    :param vpnuser: user json object from the API, {} or None if the user
+        has no account
+    :param config_link: ss_link of the user's key, if known
+    :return: dictionary of flags
+    """
+    profile = {
+        'registered': bool(vpnuser and vpnuser.get('username')),
+        'banned': bool(vpnuser and vpnuser.get('banned')),
+        'has_key': bool(vpnuser and vpnuser.get('outline_key'))
+    }
+    if config_link is not None:
+        profile['config_link'] = config_link
+    return profile
+
+
+def remember_profile(chat_id, profile):
+    """
+    Caches the profile flags of a user on their chat for PROFILE_TTL
+    seconds, and on the chat state read for this update. Failures are only
+    logged, the flags are read from the API again.
+
+    :param chat_id: Telegram Chat ID or its Identity
+    :param profile: dictionary of flags, or None to drop the cached ones
+    """
+    state = getattr(chat_id, 'state', None)
+    if state is not None:
+        state.profile = profile
+    try:
+        get_store().save_profile(CONFIG['DYNAMO_TABLE'], chat_id, profile)
+    except DBError as error:
+        logger.warning('Unable to cache the profile: {}'.format(str(error)))
+
+
 def make_language_keyboard():
     """
     Create language selection keyboard
@@ -65,17 +131,118 @@ def represents_int(s):
         return False
 
 
+def load_info_links():
+    """
+    Reloads the link cache with one batch read of the info table
+
+    :return: True if the cache was reloaded, False otherwise
+    """
+    with _info_lock:
+        generation = _info_cache['generation']
+    try:
+        result = get_store().get_info_links(
+            CONFIG['INFO_DYNAMO_TABLE'],
+            CONFIG['SUPPORTED_LANGUAGES'],
+            INFO_LINK_TYPES)
+    except DBError as exc:
+        logger.error('Unable to load info links: {}'.format(str(exc)))
+        result = None
+    if result is None:
+        return False
+    now = time.monotonic()
+    with _info_lock:
+        # links read before an invalidation are stale already
+        if generation == _info_cache['generation']:
+            _info_cache['links'], _info_cache['version'] = result
+            _info_cache['loaded'] = _info_cache['checked'] = now
+    return True
+
+
+def refresh_info_links(check_version):
+    """
+    Reloads the link cache, or only checks its version first, outside the
+    lock. Called by the one thread that set refreshing.
+
+    :param check_version: reload only if the version stamp changed
+    """
+    loaded = False
+    try:
+        if check_version:
+            try:
+                version = get_store().get_info_version(CONFIG['INFO_DYNAMO_TABLE'])
+            except DBError as exc:
+                logger.error('Unable to check info links: {}'.format(str(exc)))
+                version = None
+            with _info_lock:
+                _info_cache['checked'] = time.monotonic()
+                changed = version is not None and version != _info_cache['version']
+            if not changed:
+                loaded = True
+                return
+            logger.info('Info links changed, reloading')
+        loaded = load_info_links()
+    finally:
+        with _info_lock:
+            _info_cache['refreshing'] = False
+            if not loaded:
+                _info_cache['retry_at'] = time.monotonic() + INFO_RETRY_DELAY
+            _info_refreshed.notify_all()
+
+
+def invalidate_info_links():
+    """
+    Drops the cached links so the next lookup reads the info table
+    """
+    with _info_lock:
+        _info_cache['links'] = None
+        _info_cache['retry_at'] = 0
+        _info_cache['generation'] += 1
+
+
+def get_info_link(linktype):
+    """
+    Returns a link of the current language from the link cache. Until the
+    links are first loaded, a lookup waits for the load of another thread,
+    or reads its link from the info table when loading fails.
+
+    :param linktype: TOS_LINK or PP_LINK
+    :return: Link or None if it is not set or cannot be read
+    """
+    language = globalvars.lang.language
+    refresh = None
+    with _info_lock:
+        now = time.monotonic()
+        if not _info_cache['refreshing'] and now >= _info_cache['retry_at']:
+            if (_info_cache['links'] is None or
+                    now - _info_cache['loaded'] > CONFIG.get('INFO_CACHE_TTL', 3600)):
+                refresh = 'load'
+            elif now - _info_cache['checked'] > CONFIG.get('INFO_VERSION_CHECK', 60):
+                refresh = 'check'
+            _info_cache['refreshing'] = refresh is not None
+    if refresh is not None:
+        refresh_info_links(refresh == 'check')
+    with _info_lock:
+        if _info_cache['links'] is None:
+            _info_refreshed.wait_for(
+                lambda: not _info_cache['refreshing'], INFO_LOAD_WAIT)
+        links = _info_cache['links']
+    if links is None:
+        try:
+            return get_store().get_info_link(CONFIG['INFO_DYNAMO_TABLE'], language, linktype)
+        except DBError as exc:
+            logger.error('Unable to read the {} link: {}'.format(linktype, str(exc)))
+            return None
+    # A failed reload, or one in another thread, serves the stale links
+    return links.get((language, linktype))
+
+
 def get_tos_link():
     """
     Returns Terms of Service link
 
     :return: A string containing TOS link
     """
-    return dynamodb.get_info_link(
-        CONFIG['INFO_DYNAMO_TABLE'],
-        globalvars.lang.language,
-        'termsofservice'
-    )
+    return get_info_link(TOS_LINK)
 
 
 def get_pp_link():
@@ -84,98 +251,105 @@ def get_pp_link():
 
     :return: A string containing privacy policy link
     """
-    return dynamodb.get_info_link(
-        CONFIG['INFO_DYNAMO_TABLE'],
-        globalvars.lang.language,
-        'privacypolicy'
-    )
+    return get_info_link(PP_LINK)
 
 
 def change_lang(new_lang):
     """
-    Change langiage of the user and apply the required changes
+    Change langiage of the user and apply the required changes, for the
+    update being handled only (see globalvars.py)
 
     :param new_lang: New language to be stored
     """
     try:
-        globalvars.lang = Translation(new_lang, CONFIG['LANGUAGE_FILE'])
+        lang = Translation(new_lang, CONFIG['LANGUAGE_FILE'])
     except Exception as exc:
         logger.error("Error in Language file!")
         return None
 
-    globalvars.HOME_KEYBOARD = [
+    home_keyboard = [
         [
-            globalvars.lang.text('MENU_HOME_NEW_KEY')
+            lang.text('MENU_HOME_NEW_KEY')
         ],
         [
-            globalvars.lang.text('MENU_HOME_FAQ'),
-            globalvars.lang.text('MENU_HOME_INSTRUCTION')
+            lang.text('MENU_HOME_FAQ'),
+            lang.text('MENU_HOME_INSTRUCTION')
         ],
         [
-            globalvars.lang.text('MENU_HOME_SUPPORT'),
-            globalvars.lang.text('MENU_CHECK_STATUS')
+            lang.text('MENU_HOME_SUPPORT'),
+            lang.text('MENU_CHECK_STATUS')
         ],
         [
-            globalvars.lang.text('MENU_HOME_DELETE_ACCOUNT'),
-            globalvars.lang.text('MENU_HOME_PRIVACY_POLICY')
+            lang.text('MENU_HOME_DELETE_ACCOUNT'),
+            lang.text('MENU_HOME_PRIVACY_POLICY')
         ],
         [
-            globalvars.lang.text('MENU_HOME_CHANGE_LANGUAGE')
+            lang.text('MENU_HOME_CHANGE_LANGUAGE')
         ]
     ]
 
-    globalvars.BACK_TO_HOME_KEYBOARD = [
-        [globalvars.lang.text('MENU_BACK_HOME')]
+    back_to_home_keyboard = [
+        [lang.text('MENU_BACK_HOME')]
     ]
 
     if new_lang in ['fa', 'ar']:
-        globalvars.OPT_IN_KEYBOARD = [
+        opt_in_keyboard = [
             [
-                globalvars.lang.text('MENU_PRIVACY_POLICY_DECLINE'),
-                globalvars.lang.text('MENU_PRIVACY_POLICY_CONFIRM')
+                lang.text('MENU_PRIVACY_POLICY_DECLINE'),
+                lang.text('MENU_PRIVACY_POLICY_CONFIRM')
             ]
         ]
     else:
-        globalvars.OPT_IN_KEYBOARD = [
+        opt_in_keyboard = [
             [
-                globalvars.lang.text('MENU_PRIVACY_POLICY_CONFIRM'),
-                globalvars.lang.text('MENU_PRIVACY_POLICY_DECLINE')
+                lang.text('MENU_PRIVACY_POLICY_CONFIRM'),
+                lang.text('MENU_PRIVACY_POLICY_DECLINE')
             ]
         ]
 
-    globalvars.OPT_IN_DECLINED_KEYBOARD = [
+    opt_in_declined_keyboard = [
         [
-            globalvars.lang.text('MENU_BACK_PRIVACY_POLICY'),
-            globalvars.lang.text('MENU_HOME_CHANGE_LANGUAGE')
+            lang.text('MENU_BACK_PRIVACY_POLICY'),
+            lang.text('MENU_HOME_CHANGE_LANGUAGE')
         ]
     ]
 
-    globalvars.REMOVE_OLD_KEY_KEYBOARD = [
+    remove_old_key_keyboard = [
         [
-            globalvars.lang.text('MENU_REMOVE_OLD_CONFIRM'),
-            globalvars.lang.text('MENU_REMOVE_OLD_CANCEL')
+            lang.text('MENU_REMOVE_OLD_CONFIRM'),
+            lang.text('MENU_REMOVE_OLD_CANCEL')
         ]
     ]
 
-    globalvars.NOTIFICATION_KEYBOARD = [
+    notification_keyboard = [
         [
-            globalvars.lang.text('MSG_YES'),
-            globalvars.lang.text('MSG_NO')
+            lang.text('MSG_YES'),
+            lang.text('MSG_NO')
         ]
     ]
 
+    globalvars.set_context(globalvars.UpdateContext(
+        lang,
+        HOME_KEYBOARD=home_keyboard,
+        BACK_TO_HOME_KEYBOARD=back_to_home_keyboard,
+        OPT_IN_KEYBOARD=opt_in_keyboard,
+        OPT_IN_DECLINED_KEYBOARD=opt_in_declined_keyboard,
+        REMOVE_OLD_KEY_KEYBOARD=remove_old_key_keyboard,
+        NOTIFICATION_KEYBOARD=notification_keyboard))
 
-def hash_str(s: str) -> str:
-    '''
-        Hash a string
-
-        Args:
-        s: a string
-
-        Returns:
-        hashed string
-    '''
 
-    hashed = hashlib.sha512(str(s).encode('utf-8')).hexdigest()
+def menu_key(text):
+    """
+    Returns the key of the menu item of a text, in the language of the
+    update being handled
 
-    return hashed
+    :param text: text sent by the user
+    :return: MENU_* key, or None if the text is not a menu item
+    """
+    lang = globalvars.lang
+    keys = _menu_keys.get(lang.language)
+    if keys is None:
+        keys = _menu_keys[lang.language] = {
+            texts[lang.language]: key for key, texts in lang.texts.items()
+            if key.startswith('MENU_') and isinstance(texts.get(lang.language), str)}
+    return keys.get(text)
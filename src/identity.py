@@ -0,0 +1,102 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Identity Module
+Holds the hashed forms of Telegram chat and user ids
+"""
+
+import hashlib
+from functools import lru_cache
+
+# Warm containers see the same few thousand chats over and over
+HASH_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=HASH_CACHE_SIZE)
+def hash_str(s: str) -> str:
+    '''
+        Hash a string
+
+        Args:
+        s: a string
+
+        Returns:
+        hashed string
+    '''
+
+    hashed = hashlib.sha512(str(s).encode('utf-8')).hexdigest()
+
+    return hashed
+
+
+class Identity(object):
+    """
+    Raw and hashed ids of the chat and the user of one update, and the
+    state of the chat as read for the update (see statestore.ChatState)
+    """
+
+    __slots__ = ('chat_id', 'user_uid', 'chat_hash', 'user_hash', '_log_id', 'state')
+
+    def __init__(self, chat_id, user_uid=None):
+        self.chat_id = chat_id
+        self.user_uid = user_uid
+        self.chat_hash = hash_str(chat_id)
+        self.user_hash = None if user_uid is None else hash_str(user_uid)
+        self._log_id = None
+        self.state = None
+
+    @classmethod
+    def from_hash(cls, user_hash):
+        """
+        Identity of the private chat of a user known by the hashed user id
+        of the API. The id of a private chat is the id of the user, so
+        their hashes are the same.
+
+        :param user_hash: hashed Telegram User ID
+        :return: Identity without raw ids
+        """
+        identity = cls.__new__(cls)
+        identity.chat_id = None
+        identity.user_uid = None
+        identity.chat_hash = user_hash
+        identity.user_hash = user_hash
+        identity._log_id = None
+        identity.state = None
+        return identity
+
+    @property
+    def log_id(self):
+        """
+        Id of the user as it is written to the logs, the hash of the id
+        known to the API server
+        """
+        if self._log_id is None:
+            self._log_id = hash_str(self.user_hash)
+        return self._log_id
+
+    def __repr__(self):
+        return 'Identity({})'.format(self.chat_hash[:16])
+
+
+def hashed_chat_id(chat_id):
+    """
+    Returns the hashed chat id used as the DB key
+
+    :param chat_id: Telegram Chat ID or an Identity
+    :return: hashed chat id
+    """
+    if isinstance(chat_id, Identity):
+        return chat_id.chat_hash
+    return hash_str(chat_id)
@@ -0,0 +1,453 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Jobs Module
+Runs long jobs over a stream of items, such as broadcasts (broadcast.py)
+and key migrations (keymigration.py), across Lambda invocations.
+
+A job is a record in the state store (see statestore.py) holding its
+status, the number of items handled so far and a counter per outcome.
+Items are handled a page at a time by a pool of workers and the job is
+checkpointed after every page, so at most one page is handled twice after
+a crash. A run stops STOP_MARGIN seconds before the Lambda timeout, or
+after its budget elsewhere, and launches the job again: on Lambda by
+invoking the function asynchronously with {<event>: job_id, 'token':
+token}, which outlinebot.bot_handler hands back to the job, elsewhere on a
+thread. A lease record keeps two runs of the same job from overlapping.
+The messages of every job of a bot are sent through one SharedTokenBucket,
+see send_bucket.
+
+A run that fails launches the job again, up to MAX_FAILURES times in a row
+before the job is marked failed. Runs killed before they could relaunch,
+such as by a Lambda timeout, are picked up by resume_stalled, which a
+scheduled {RESUME_EVENT: true, 'token': token} event runs.
+"""
+
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+from statestore import get_store
+from settings import CONFIG
+
+logger = logging.getLogger()
+
+JOB_TTL = 30 * 86400
+
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+
+# seconds kept free before the Lambda timeout to checkpoint and relaunch
+STOP_MARGIN = 30
+# failed runs in a row after which a job is given up
+MAX_FAILURES = 3
+# seconds without a checkpoint or a lease after which a running job is
+# resumed, longer than the longest Lambda run
+STALL_AFTER = 900 + STOP_MARGIN
+
+# Lambda event resuming the stalled jobs, see resume_stalled
+RESUME_EVENT = 'ResumeJobs'
+
+# records of the tokens taken from shared buckets, one per bucket and second
+RATE_KIND = 'rate'
+RATE_TTL = 60
+# longest pause of a shared bucket passed on to the other takers
+MAX_SHARED_PAUSE = 60
+
+_send_buckets = {}
+_send_buckets_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """
+    Rate limit shared by the workers. A pause stops every worker, as a 429
+    from Telegram applies to the bot and not to one chat.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+        self.lock = threading.Lock()
+
+    def take(self):
+        """ Waits for a token """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.resume_at:
+                    self.tokens = min(
+                        self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.resume_at - now
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """ Holds every taker back for seconds and empties the bucket """
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = self.resume_at
+
+
+class SharedTokenBucket(object):
+    """
+    Rate limit shared by every run, process and Lambda instance taking from
+    a bucket of the same name. Each second of the clock is a record of the
+    tokens taken in it (see statestore.py): a process reserves tokens from
+    it a chunk at a time and only spends them within that second, so the
+    takers together take at most rate tokens a second.
+    """
+
+    def __init__(self, name, rate, chunk=None):
+        """
+        :param name: name of the bucket, the same for all the takers
+        :param rate: tokens per second
+        :param chunk: tokens reserved per write, a fifth of rate by default
+        """
+        self.name = name
+        self.rate = max(1, int(rate))
+        self.chunk = chunk or max(1, self.rate // 5)
+        self.window = None
+        self.tokens = 0
+        self.full = False
+        self.resume_at = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, window, count):
+        """
+        Takes up to count tokens of a second
+
+        :return: number of tokens taken
+        :raise: DBError: the state store failed
+        """
+        taken = get_store().update_record(
+            RATE_KIND, '{}:{}'.format(self.name, window),
+            increments={'taken': count}, ttl=RATE_TTL)['taken']
+        return max(0, min(count, self.rate - (taken - count)))
+
+    def take(self):
+        """
+        Waits for a token
+
+        :raise: DBError: the state store failed
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                if now >= self.resume_at:
+                    window = int(now)
+                    if window != self.window:
+                        # tokens of a past second are not spent
+                        self.window = window
+                        self.tokens = 0
+                        self.full = False
+                    if not self.tokens and not self.full:
+                        self.tokens = self.reserve(window, self.chunk)
+                        self.full = self.tokens < self.chunk
+                    if self.tokens:
+                        self.tokens -= 1
+                        return
+                    wait = window + 1 - now
+                else:
+                    wait = self.resume_at - now
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Holds every taker back for seconds, by taking all the tokens of the
+        seconds of the pause
+
+        :raise: DBError: the state store failed
+        """
+        with self.lock:
+            now = time.time()
+            self.resume_at = max(self.resume_at, now + seconds)
+            self.tokens = 0
+            for window in range(int(now), int(now + min(seconds, MAX_SHARED_PAUSE)) + 1):
+                self.reserve(window, self.rate)
+
+
+def send_bucket(token):
+    """
+    Returns the bucket of the Telegram messages jobs send for a bot, shared
+    by all its jobs at BROADCAST_RATE, Telegram's global limit for bots
+
+    :param token: Telegram Bot Token
+    """
+    bot_id = token.split(':', 1)[0]
+    with _send_buckets_lock:
+        if bot_id not in _send_buckets:
+            _send_buckets[bot_id] = SharedTokenBucket(
+                'telegram:{}'.format(bot_id), CONFIG.get('BROADCAST_RATE', 30))
+        return _send_buckets[bot_id]
+
+
+def pages(items, size):
+    """ Yields lists of up to size items """
+    iterator = iter(items)
+    while True:
+        page = list(itertools.islice(iterator, size))
+        if not page:
+            return
+        yield page
+
+
+def lambda_function():
+    """ Returns the name of the Lambda function running, or None """
+    return os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+
+
+def invoke(payload, target, *args):
+    """
+    Runs work in the background: an asynchronous invocation of the
+    function with payload on Lambda, target(*args) on a thread elsewhere
+
+    :param payload: event handled by outlinebot.bot_handler
+    :raise: botocore.exceptions.ClientError: the function could not be
+        invoked
+    """
+    function = lambda_function()
+    if function:
+        boto3.client('lambda').invoke(
+            FunctionName=function,
+            InvocationType='Event',
+            Payload=json.dumps(payload))
+    else:
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+
+class Job(object):
+    """
+    Base of the jobs. Subclasses set kind and event and implement items
+    and handle, and may report progress.
+    """
+
+    # record kind of the jobs, the lease kind is derived from it
+    kind = None
+    # key of the Lambda event that runs a job
+    event = None
+    workers = 8
+    page_size = 100
+    budget = 600
+
+    def __init__(self, token, context=None):
+        """
+        :param token: Telegram Bot Token
+        :param context: Lambda context, to stop before the function times out
+        """
+        self.token = token
+        self.context = context
+        self.job_id = None
+
+    def items(self, job):
+        """ :return: iterable of every item of the job, in a stable order """
+        raise NotImplementedError
+
+    def handle(self, job, item):
+        """
+        Handles one item, called from the workers
+
+        :return: name of the outcome, counted in the job record
+        """
+        raise NotImplementedError
+
+    def prepare(self, job):
+        """ Called before a run handles its first page """
+
+    def progress(self, job_id, job, final=False):
+        """ Called after every page, and with final when the run ends """
+
+    @classmethod
+    def create(cls, token, values, launch=True):
+        """
+        Stores a new job and launches its first run
+
+        :param values: attributes of the job record
+        :param launch: launch the first run in the background
+        :return: job id
+        :raise: DBError: the job could not be stored
+        """
+        job_id = uuid.uuid4().hex[:8]
+        now = int(time.time())
+        get_store().put_record(cls.kind, job_id, dict(
+            values, status=RUNNING, created=now, updated=now, offset=0), ttl=JOB_TTL)
+        logger.info('[{}] Created {}'.format(cls.kind, job_id))
+        if launch:
+            cls.launch(job_id, token)
+        return job_id
+
+    @classmethod
+    def launch(cls, job_id, token):
+        """
+        Runs a job in the background, see invoke
+        """
+        invoke({cls.event: job_id, 'token': token}, cls(token).run, job_id)
+
+    @classmethod
+    def cancel(cls, job_id):
+        """
+        Cancels a job, its run stops before its next page
+
+        :return: the job record, or None if the job is unknown
+        """
+        store = get_store()
+        if store.get_record(cls.kind, job_id, consistent=True) is None:
+            return None
+        return store.update_record(cls.kind, job_id, values={'status': CANCELLED})
+
+    @classmethod
+    def resume_stalled(cls, token):
+        """
+        Launches the running jobs that have neither a lease nor a
+        checkpoint in the last STALL_AFTER seconds
+
+        :return: ids of the jobs launched
+        :raise: DBError: the state store failed
+        """
+        store = get_store()
+        lease_kind = '{}-lease'.format(cls.kind)
+        stalled_at = time.time() - STALL_AFTER
+        resumed = []
+        start = None
+        while True:
+            records, start = store.query_records(cls.kind, start=start)
+            for job_id, job in records:
+                if job.get('status') != RUNNING:
+                    continue
+                if job.get('updated', job.get('created', 0)) > stalled_at:
+                    continue
+                if store.get_record(lease_kind, job_id, consistent=True) is not None:
+                    continue
+                logger.warning('[{}] {} stalled at {}, resuming'.format(
+                    cls.kind, job_id, job.get('offset', 0)))
+                cls.launch(job_id, token)
+                resumed.append(job_id)
+            if start is None:
+                return resumed
+
+    def fail(self, job_id, error):
+        """
+        Counts a failed run and launches the job again, or gives it up
+        after MAX_FAILURES failures in a row
+
+        :return: the job record
+        :raise: DBError: the state store failed
+        """
+        logger.error('[{}] {} failed: {}'.format(self.kind, job_id, str(error)))
+        store = get_store()
+        job = store.update_record(
+            self.kind, job_id, values={'updated': int(time.time())},
+            increments={'failures': 1})
+        if job['status'] == RUNNING and job['failures'] < MAX_FAILURES:
+            self.launch(job_id, self.token)
+            return job
+        if job['status'] == RUNNING:
+            job = store.update_record(
+                self.kind, job_id, values={'status': FAILED, 'finished': int(time.time())})
+        self.progress(job_id, job, final=True)
+        return job
+
+    def run_pages(self, job_id, job, deadline):
+        """
+        Handles the pages of a job from its checkpoint, see run
+
+        :return: the job record and whether the run ran out of time
+        """
+        store = get_store()
+        self.prepare(job)
+        items = itertools.islice(self.items(job), job['offset'], None)
+        with ThreadPoolExecutor(self.workers) as pool:
+            for page in pages(items, self.page_size):
+                job = store.get_record(self.kind, job_id, consistent=True)
+                if job['status'] != RUNNING:
+                    logger.info('[{}] {} was cancelled'.format(self.kind, job_id))
+                    return job, False
+                outcomes = list(pool.map(lambda item: self.handle(job, item), page))
+                increments = {'offset': len(page)}
+                for outcome in outcomes:
+                    increments[outcome] = increments.get(outcome, 0) + 1
+                job = store.update_record(
+                    self.kind, job_id, values={'updated': int(time.time()), 'failures': 0},
+                    increments=increments)
+                self.progress(job_id, job)
+                if time.monotonic() > deadline:
+                    return job, True
+        return store.update_record(
+            self.kind, job_id, values={'status': DONE, 'finished': int(time.time())}), False
+
+    def run(self, job_id):
+        """
+        Handles a job from its checkpoint until it is done, cancelled or
+        out of time, in which case it is launched again. A run that fails
+        launches it again too, see fail.
+
+        :return: the job record, or None if the job is unknown
+        :raise: DBError: the state store failed and the failure could not
+            be recorded, the run stops at its last checkpoint
+        """
+        store = get_store()
+        job = store.get_record(self.kind, job_id, consistent=True)
+        if job is None or job['status'] != RUNNING:
+            return job
+        self.job_id = job_id
+
+        budget = self.budget
+        if self.context is not None:
+            budget = min(
+                budget, self.context.get_remaining_time_in_millis() / 1000.0 - STOP_MARGIN)
+        if budget <= 0:
+            logger.warning('[{}] {} has no time left, relaunching'.format(self.kind, job_id))
+            self.launch(job_id, self.token)
+            return job
+        lease_kind = '{}-lease'.format(self.kind)
+        if not store.put_record(
+                lease_kind, job_id, {'started': int(time.time())},
+                ttl=budget + STOP_MARGIN, only_new=True):
+            logger.warning('[{}] {} is already running'.format(self.kind, job_id))
+            return job
+        deadline = time.monotonic() + budget
+
+        try:
+            job, relaunch = self.run_pages(job_id, job, deadline)
+        except Exception as error:
+            store.delete_record(lease_kind, job_id)
+            return self.fail(job_id, error)
+        store.delete_record(lease_kind, job_id)
+
+        if relaunch:
+            logger.info('[{}] {} paused at {}, relaunching'.format(
+                self.kind, job_id, job['offset']))
+            self.launch(job_id, self.token)
+        else:
+            logger.info('[{}] {} done: {}'.format(self.kind, job_id, job))
+            self.progress(job_id, job, final=True)
+        return job
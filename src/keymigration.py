@@ -0,0 +1,335 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Key Migration Module
+Moves users off Outline servers as soon as they are blocked, instead of
+waiting for each user to notice and ask for a new key.
+
+detect() lists the servers and starts a migration job (see jobs.py) for
+the servers that were blocked since its last call. It runs on a schedule,
+from a {'DetectBlockedServers': true, 'token': TOKEN} event. The job
+streams the list of users with a key on a blocked server, filtered by the
+API, and, for every user with a chat and a key on one of its servers,
+requests a new key with api.get_new_key and sends it to the chat in the
+chat's language. Users are told apart by the server column of the list
+when it has one, by api.get_user otherwise. Calls to the API are limited to
+KEY_MIGRATION_API_RATE per second, and messages are sent through the
+bot's shared token bucket, with the broadcasts, at BROADCAST_RATE in all
+(see jobs.send_bucket).
+
+Every migrated user gets a marker record for the job: it is claimed before
+the key is requested, and written again once the key is issued and once it
+is delivered, so a page handled twice after a crash neither issues a second
+key nor sends it twice. A user left claimed is looked up with api.get_user:
+one with a key on another server was issued it and is sent the link of
+api.get_online_config, the others are issued a key.
+
+    python keymigration.py --detect --token TOKEN
+    python keymigration.py --servers 12,13 --token TOKEN
+    python keymigration.py --status JOB
+"""
+
+import argparse
+import json
+import logging
+import threading
+
+import requests
+
+import api
+import broadcast
+import chatindex
+import jobs
+import keyqueue
+import telegram
+from identity import hashed_chat_id
+from statestore import DEFAULT_LANGUAGE, get_store
+from translation import Translation
+from settings import CONFIG
+
+logger = logging.getLogger()
+
+JOB_KIND = 'key-migration'
+EVENT = 'KeyMigration'
+DETECT_EVENT = 'DetectBlockedServers'
+# servers known to be blocked, so each block starts one job
+BLOCKED_SERVER_KIND = 'blocked-server'
+
+CLAIMED = 'claimed'
+ISSUED = 'issued'
+DELIVERED = 'delivered'
+
+# outcomes besides the telegram.DELIVERY_* ones
+MIGRATED = 'migrated'
+UNAFFECTED = 'unaffected'
+NO_CHAT = 'no_chat'
+SKIPPED = broadcast.SKIPPED
+NO_KEY = 'no_key'
+
+
+def affected(vpnuser, servers):
+    """
+    Tells whether a user has a key on one of the servers
+
+    :param vpnuser: user json object from api.get_user
+    :param servers: set of server ids as strings
+    """
+    if not vpnuser or vpnuser.get('banned'):
+        return False
+    return any(
+        str(outline_key.get('server')) in servers
+        for outline_key in vpnuser.get('outline_key') or [])
+
+
+def migrated(vpnuser, servers):
+    """
+    Tells whether a user has a key on a server other than the blocked ones
+
+    :param vpnuser: user json object from api.get_user
+    :param servers: set of server ids as strings
+    """
+    return any(
+        str(outline_key.get('server')) not in servers
+        for outline_key in (vpnuser or {}).get('outline_key') or [])
+
+
+def listed_servers(row):
+    """
+    Returns the servers a row of the users list has keys on
+
+    :param row: dictionary of the columns of a user, see api.stream_users
+    :return: set of server ids as strings, or None if the list does not
+        tell them
+    """
+    if not row.get('server'):
+        return None
+    return set(server.strip() for server in row['server'].split(','))
+
+
+class KeyMigrationJob(jobs.Job):
+    """
+    Issues and delivers new keys to the users of the blocked servers of
+    the job
+    """
+
+    kind = JOB_KIND
+    event = EVENT
+
+    def __init__(self, token, context=None):
+        super(KeyMigrationJob, self).__init__(token, context)
+        self.workers = CONFIG.get('BROADCAST_WORKERS', 8)
+        self.page_size = CONFIG.get('BROADCAST_PAGE_SIZE', 100)
+        self.budget = CONFIG.get('BROADCAST_BUDGET', 600)
+        self.bucket = jobs.send_bucket(token)
+        self.api_bucket = jobs.TokenBucket(CONFIG.get('KEY_MIGRATION_API_RATE', 10))
+        self.sessions = threading.local()
+        self.translations = {}
+        self.blocked = set()
+        self.servers = set()
+
+    def prepare(self, job):
+        self.blocked = chatindex.blocked_chats()
+        self.servers = set(str(server) for server in job['servers'])
+
+    def items(self, job):
+        return api.stream_users(blocked=True)
+
+    def session(self):
+        """ Returns the requests session of the worker """
+        if not hasattr(self.sessions, 'session'):
+            self.sessions.session = requests.Session()
+        return self.sessions.session
+
+    def translation(self, chat_id):
+        """ Returns the Translation of the language of a chat """
+        state = get_store().get_chat(CONFIG['DYNAMO_TABLE'], chat_id)
+        language = (state and state.language) or DEFAULT_LANGUAGE
+        if language not in self.translations:
+            self.translations[language] = Translation(language, CONFIG['LANGUAGE_FILE'])
+        return self.translations[language]
+
+    def messages(self, chat_id, link):
+        """ Returns the messages carrying a new key, see create_new_key """
+        lang = self.translation(chat_id)
+        awsurl = CONFIG['OUTLINE_AWS_URL'].format(lang.language, link)
+        return [
+            (lang.text('MSG_KEY_MIGRATED'), None),
+            (lang.text('MSG_NEW_KEY_A').format(f"{awsurl}#BeePass"), 'MARKDOWN'),
+            (lang.text('MSG_NEW_KEY_B'), 'MARKDOWN'),
+            (f"{link}#BeePass", None)
+        ]
+
+    def handle(self, job, row):
+        user, chat_id = row.get('username'), row.get('userchat')
+        if not user or not chat_id:
+            return NO_CHAT
+        if hashed_chat_id(chat_id) in self.blocked:
+            return SKIPPED
+        store = get_store()
+        marker_kind = '{}:{}'.format(JOB_KIND, self.job_id)
+        marker = store.get_record(marker_kind, user, consistent=True)
+        try:
+            if marker is None:
+                servers = listed_servers(row)
+                if servers is not None:
+                    if not servers & self.servers:
+                        return UNAFFECTED
+                else:
+                    self.api_bucket.take()
+                    if not affected(api.get_user(user), self.servers):
+                        return UNAFFECTED
+                # claimed before the call: a key requested by a run that
+                # crashed before recording it is looked up, not issued again
+                if not store.put_record(
+                        marker_kind, user, {'state': CLAIMED}, ttl=jobs.JOB_TTL, only_new=True):
+                    marker = store.get_record(marker_kind, user, consistent=True)
+            if marker is not None and marker['state'] == CLAIMED:
+                # the run that claimed the user may have stopped before or
+                # after the key was issued
+                self.api_bucket.take()
+                if migrated(api.get_user(user), self.servers):
+                    store.put_record(marker_kind, user, {'state': ISSUED}, ttl=jobs.JOB_TTL)
+                    marker = {'state': ISSUED}
+                else:
+                    marker = None
+            if marker is None:
+                self.api_bucket.take()
+                new_keys, link = api.get_new_key(user_id=user, user_issue=job.get('issue'))
+                if not new_keys:
+                    store.delete_record(marker_kind, user)
+                    return NO_KEY
+                keyqueue.remember_key(chat_id, link)
+                store.put_record(marker_kind, user, {'state': ISSUED}, ttl=jobs.JOB_TTL)
+            elif marker['state'] == ISSUED:
+                self.api_bucket.take()
+                link = api.get_online_config(user_id=user)['ss_link']
+            else:
+                return MIGRATED
+        except Exception as exc:
+            logger.error('[key-migration] Unable to issue a key for {}: {}'.format(
+                hashed_chat_id(user), exc))
+            return telegram.DELIVERY_FAILED
+
+        outcome = broadcast.deliver_all(
+            self.token, chat_id, self.messages(chat_id, link), self.bucket, self.session())
+        if outcome != telegram.DELIVERY_SENT:
+            return outcome
+        store.put_record(marker_kind, user, {'state': DELIVERED}, ttl=jobs.JOB_TTL)
+        return MIGRATED
+
+
+def start(token, servers, launch=True):
+    """
+    Creates a migration job for blocked servers
+
+    :param token: Telegram Bot Token
+    :param servers: ids of the blocked servers
+    :param launch: launch the first run in the background
+    :return: job id
+    :raise: DBError: the job could not be stored
+    """
+    return KeyMigrationJob.create(token, {
+        'servers': [str(server) for server in servers],
+        'issue': CONFIG.get('KEY_MIGRATION_ISSUE') or None
+    }, launch)
+
+
+def detect(token, launch=True):
+    """
+    Starts a migration job for the servers blocked since the last call.
+    Servers that are no longer blocked are forgotten, so a new block
+    starts a new job.
+
+    :param token: Telegram Bot Token
+    :param launch: launch the first run in the background
+    :return: job id, or None if no server was newly blocked
+    :raise: DBError: the state store failed
+    """
+    store = get_store()
+    blocked = set(
+        str(server['id']) for server in api.get_servers() if server.get('is_blocked'))
+    known = set()
+    start_key = None
+    while True:
+        records, start_key = store.query_records(BLOCKED_SERVER_KIND, start_key)
+        known.update(server for server, _ in records)
+        if start_key is None:
+            break
+    for server in known - blocked:
+        store.delete_record(BLOCKED_SERVER_KIND, server)
+    new = sorted(
+        server for server in blocked - known
+        if store.put_record(BLOCKED_SERVER_KIND, server, {}, only_new=True))
+    if not new:
+        return None
+    logger.warning('[key-migration] Servers blocked: {}'.format(', '.join(new)))
+    try:
+        job_id = start(token, new, launch=False)
+    except Exception:
+        # forgotten, so the next call starts the job again
+        for server in new:
+            store.delete_record(BLOCKED_SERVER_KIND, server)
+        raise
+    if launch:
+        KeyMigrationJob.launch(job_id, token)
+    return job_id
+
+
+def run(job_id, token, context=None):
+    """
+    Runs a migration from its checkpoint, see jobs.Job.run
+
+    :return: the job record, or None if the job is unknown
+    :raise: DBError: the state store failed
+    """
+    return KeyMigrationJob(token, context).run(job_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move users off blocked servers')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--detect', action='store_true',
+                       help='migrate the users of newly blocked servers')
+    group.add_argument('--servers', help='comma separated ids of servers to migrate off')
+    group.add_argument('--status', metavar='JOB', help='print a job')
+    group.add_argument('--cancel', metavar='JOB', help='cancel a job')
+    group.add_argument('--resume', metavar='JOB',
+                       help='run a job from its checkpoint in the foreground')
+    parser.add_argument('--token', help='Telegram Bot Token, needed to run jobs')
+    args = parser.parse_args()
+
+    if (args.detect or args.servers or args.resume) and not args.token:
+        parser.error('--token is needed to run jobs')
+    if args.status:
+        job = get_store().get_record(JOB_KIND, args.status, consistent=True)
+    elif args.cancel:
+        job = KeyMigrationJob.cancel(args.cancel)
+    else:
+        job_id = args.resume
+        if args.detect:
+            job_id = detect(args.token, launch=False)
+            if job_id is None:
+                print('No newly blocked server')
+                return
+        elif args.servers:
+            job_id = start(args.token, args.servers.split(','), launch=False)
+        job = run(job_id, args.token)
+    if job is None:
+        parser.exit(1, 'Unknown job\n')
+    print(json.dumps(job, indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
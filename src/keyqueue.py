@@ -0,0 +1,238 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Key Queue Module
+Issues new keys outside the update that asked for them, so a slow API
+does not hold the handler for up to API_TIMEOUT seconds.
+
+With CONFIG['KEY_ISSUE_MODE'] set to async, create_new_key enqueues a
+request and returns. The request is handled in the background (see
+jobs.invoke) by work(), which calls api.get_new_key and sends the key to
+the chat. A pending record per user, written only if none exists, keeps a
+user from queueing a second key while one is on its way. A request that
+cannot be handed to a worker drops its record, and create_new_key issues
+the key in the update instead.
+
+Calls that fail are retried up to KEY_ISSUE_ATTEMPTS times. Outside Lambda
+a retry runs on a timer, KEY_ISSUE_RETRY_DELAY seconds later, the delay
+growing with each attempt. On Lambda the worker fails its invocation
+instead of waiting in it, and Lambda invokes it again with the same event
+after its own retry delays, at most LAMBDA_RETRIES times.
+
+The chat id travels in the invocation payload and is never stored.
+"""
+
+import logging
+import threading
+import time
+
+import api
+import jobs
+import telegram
+from errors import AWSError, TelegramError, ValidationError
+from helpers import remember_profile
+from identity import hash_str
+from statestore import get_store
+from translation import Translation
+from settings import CONFIG
+
+logger = logging.getLogger()
+
+SYNC_MODE = 'sync'
+ASYNC_MODE = 'async'
+
+EVENT = 'IssueKey'
+REQUEST_KIND = 'key-request'
+
+# retries and their delays in seconds of a failed asynchronous invocation,
+# Lambda's defaults
+LAMBDA_RETRIES = 2
+LAMBDA_RETRY_DELAYS = (60, 120)
+
+
+def key_issue_mode():
+    """ Returns the configured key issue mode """
+    return CONFIG.get('KEY_ISSUE_MODE', SYNC_MODE)
+
+
+def remember_key(chat_id, online_config_link):
+    """
+    Caches on the chat of a user that they hold the key just issued,
+    replacing the profile read before, see helpers.remember_profile
+
+    :param chat_id: Telegram Chat ID or its Identity
+    :param online_config_link: ss_link of the key
+    """
+    remember_profile(chat_id, {
+        'registered': True,
+        'banned': False,
+        'has_key': True,
+        'config_link': online_config_link
+    })
+
+
+def send_new_key(token, chat_id, lang, url_lang, online_config_link):
+    """
+    Sends a new key and its instructions, and caches its link
+
+    :param token: Telegram Bot Token
+    :param chat_id: Telegram Chat ID
+    :param lang: Translation of the chat
+    :param url_lang: language of the invitation page
+    :param online_config_link: ss_link of the key
+    :raise: TelegramError: Telegram API call failed
+    """
+    remember_key(chat_id, online_config_link)
+    telegram.send_message(
+        token,
+        chat_id,
+        lang.text('MSG_OUTLINE_SSL_CONF'),
+        parse='MARKDOWN')
+
+    awsurl = (CONFIG['OUTLINE_AWS_URL'].format(
+        url_lang,
+        online_config_link))
+
+    telegram.send_message(
+        token,
+        chat_id,
+        lang.text('MSG_NEW_KEY_A').format(f"{awsurl}#BeePass"),
+        parse='MARKDOWN')
+    telegram.send_message(
+        token,
+        chat_id,
+        lang.text('MSG_NEW_KEY_B'),
+        parse='MARKDOWN')
+    telegram.send_message(
+        token,
+        chat_id,
+        f"{online_config_link}#BeePass")
+
+
+def max_attempts():
+    """ Returns the attempts a request gets """
+    attempts = CONFIG.get('KEY_ISSUE_ATTEMPTS', 3)
+    if jobs.lambda_function():
+        attempts = min(attempts, LAMBDA_RETRIES + 1)
+    return attempts
+
+
+def retry_delays():
+    """ Returns the seconds waited before each retry of a request """
+    if jobs.lambda_function():
+        return LAMBDA_RETRY_DELAYS[:max_attempts() - 1]
+    delay = CONFIG.get('KEY_ISSUE_RETRY_DELAY', 10)
+    return tuple(delay * attempt for attempt in range(1, max_attempts()))
+
+
+def enqueue(token, user_uid, chat_id, language, url_lang, issue_id=None):
+    """
+    Queues a key request unless the user has one pending
+
+    :param token: Telegram Bot Token
+    :param user_uid: hashed user id known to the API
+    :param chat_id: Telegram Chat ID to send the key to
+    :param language: language of the messages
+    :param url_lang: language of the invitation page
+    :param issue_id: User's issue connecting to server
+    :return: True if queued, False if a request is already pending
+    :raise: DBError: the request could not be stored
+    :raise: AWSError: the request could not be handed to a worker, it is
+        not pending anymore
+    """
+    store = get_store()
+    # the record outlives every attempt, and frees the user if a worker dies
+    ttl = max_attempts() * CONFIG['API_TIMEOUT'] + sum(retry_delays())
+    if not store.put_record(
+            REQUEST_KIND, user_uid, {'attempts': 0, 'queued': int(time.time())},
+            ttl=ttl, only_new=True):
+        logger.info('[keyqueue] A key is already pending for {}'.format(hash_str(user_uid)))
+        return False
+    try:
+        launch(token, {
+            'user': user_uid,
+            'chat_id': chat_id,
+            'language': language,
+            'url_lang': url_lang,
+            'issue': issue_id
+        })
+    except Exception as exc:
+        store.delete_record(REQUEST_KIND, user_uid)
+        raise AWSError('Unable to launch a key worker: {}'.format(exc))
+    return True
+
+
+def launch(token, request, delay=0):
+    """
+    Hands a request to a worker, see jobs.invoke
+
+    :param delay: seconds to wait before, outside Lambda
+    """
+    if delay and not jobs.lambda_function():
+        timer = threading.Timer(delay, work, (request, token))
+        timer.daemon = True
+        timer.start()
+        return
+    jobs.invoke({EVENT: request, 'token': token}, work, request, token)
+
+
+def work(request, token):
+    """
+    Issues and sends the key of a queued request
+
+    :param request: request as built by enqueue
+    :param token: Telegram Bot Token
+    :return: True if the key was sent
+    :raise: DBError: the state store failed
+    :raise: Exception: the API call failed and is retried by Lambda, which
+        invokes the function again with the same request
+    """
+    store = get_store()
+    user = request['user']
+    pending = store.get_record(REQUEST_KIND, user, consistent=True)
+    if pending is None:
+        logger.warning('[keyqueue] Request of {} expired'.format(hash_str(user)))
+        return False
+    lang = Translation(request['language'], CONFIG['LANGUAGE_FILE'])
+
+    try:
+        new_keys, online_config_link = api.get_new_key(
+            user_id=user, user_issue=request.get('issue'))
+    except Exception as exc:
+        attempts = store.update_record(
+            REQUEST_KIND, user, increments={'attempts': 1})['attempts']
+        if attempts < max_attempts():
+            logger.warning('[keyqueue] Attempt {} failed, retrying: {}'.format(attempts, exc))
+            if jobs.lambda_function():
+                # the invocation ends now, Lambda retries it later
+                raise
+            launch(token, request, retry_delays()[attempts - 1])
+            return False
+        logger.error(f'Error in creating new key {exc}')
+        store.delete_record(REQUEST_KIND, user)
+        telegram.send_message(token, request['chat_id'], lang.text('MSG_ERROR'))
+        return False
+
+    try:
+        if not new_keys:
+            telegram.send_message(token, request['chat_id'], lang.text('MSG_ERROR_NO_KEY'))
+        else:
+            send_new_key(
+                token, request['chat_id'], lang, request['url_lang'], online_config_link)
+    except (TelegramError, ValidationError) as error:
+        logger.error('[keyqueue] Unable to send the key: {}'.format(str(error)))
+    finally:
+        store.delete_record(REQUEST_KIND, user)
+    return bool(new_keys)
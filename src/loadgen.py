@@ -0,0 +1,526 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Load Generator
+Simulates concurrent virtual users walking the onboarding funnel
+(/start, SET_LANGUAGE, FIRST_CAPTCHA, OPT_IN, MENU_HOME_NEW_KEY) through
+bot_handler, against a local stand-in for the Telegram and BeePass APIs
+and a local DynamoDB-compatible store.
+
+Point boto3 at the local store with the AWS_ENDPOINT_URL_DYNAMODB
+environment variable (DynamoDB Local, LocalStack, ...), then run from the
+src directory:
+
+    AWS_ENDPOINT_URL_DYNAMODB=http://localhost:8000 \\
+        python loadgen.py --create-tables --concurrency 1,10,50,100
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+from botocore.exceptions import ClientError
+
+import dynamodb
+import statestore
+import outlinebot
+import telegram
+import tracing
+from settings import CONFIG, API_ENDPOINTS
+from translation import Translation
+
+TOKEN = 'loadgen'
+CHAT_ID_BASE = 7000000000
+# Telegram's update ids only grow, and the bot drops ids it has seen (see
+# dedup.py), so every run continues from the clock
+UPDATE_IDS = itertools.count(int(time.time() * 1000))
+CAPTCHA_PATTERN = re.compile(r'(\d+) \+ (\d+):\s*$')
+HISTOGRAM_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class StandIn(object):
+    """
+    In-process stand-in for the Telegram Bot API and the BeePass API.
+    It records the last reply sent to every chat so that virtual users
+    can read their prompts (e.g. the captcha) back.
+    """
+
+    def __init__(self, telegram_latency=0.0, api_latency=0.0):
+        self.telegram_latency = telegram_latency
+        self.api_latency = api_latency
+        self.lock = threading.Lock()
+        self.replies = {}
+        self.users = {}
+        self.server = None
+
+    def last_reply(self, chat_id):
+        """
+        Returns the last message sent to a chat
+
+        :param chat_id: Telegram Chat ID
+        :return: Dictionary of the posted message or None
+        """
+        with self.lock:
+            return self.replies.get(int(chat_id))
+
+    def telegram_call(self, method, data):
+        """
+        Handles a Telegram Bot API call
+
+        :param method: Bot API method name
+        :param data: Posted data
+        :return: Telegram API response body
+        """
+        if self.telegram_latency:
+            time.sleep(self.telegram_latency)
+        if method in ('sendMessage', 'sendPhoto', 'sendVideo', 'sendDocument'):
+            with self.lock:
+                self.replies[int(data['chat_id'])] = data
+        return 200, {'ok': True, 'result': {}}
+
+    def api_call(self, verb, path, data):
+        """
+        Handles a BeePass API call
+
+        :param verb: HTTP verb
+        :param path: Request path, without the query string
+        :param data: Request json body or None
+        :return: status code and response body
+        """
+        if self.api_latency:
+            time.sleep(self.api_latency)
+        user_path = API_ENDPOINTS['USER']
+        config_path = API_ENDPOINTS['OUTLINE_CONFIG']
+        key_path = API_ENDPOINTS['OUTLINE_KEY']
+
+        with self.lock:
+            if verb == 'GET' and path.startswith(user_path + '/'):
+                username = path[len(user_path) + 1:]
+                if username not in self.users:
+                    return 404, {}
+                return 200, self.users[username]
+            if verb == 'PUT' and path == user_path:
+                username = data['username']
+                if username in self.users:
+                    return 409, {}
+                self.users[username] = {
+                    'username': username,
+                    'banned': False,
+                    'outline_key': []}
+                return 200, self.users[username]
+            if verb == 'PUT' and path == key_path:
+                user = self.users.get(data['user'])
+                if user is None:
+                    return 400, {}
+                outline_key = {
+                    'server': 1,
+                    'outline_key': 'ss://loadgen-{}'.format(len(user['outline_key']))}
+                user['outline_key'].append(outline_key)
+                return 200, {
+                    'created_keys': [outline_key],
+                    'ss_link': 'ssconf://loadgen/{}'.format(data['user'][:16])}
+            if verb == 'GET' and path.startswith(config_path + '/'):
+                return 200, {'ss_link': 'ssconf://loadgen/{}'.format(
+                    path[len(config_path) + 1:][:16])}
+        return 404, {}
+
+    def start(self):
+        """
+        Starts the stand-in HTTP server on a free local port and points the
+        bot's Telegram and BeePass API clients to it
+
+        :return: Base URL of the stand-in
+        """
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def _handle(self, verb):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                try:
+                    data = json.loads(body) if body else None
+                except ValueError:
+                    data = None
+                path = self.path.split('?', 1)[0]
+                if path.startswith('/bot'):
+                    status, reply = standin.telegram_call(
+                        path.rsplit('/', 1)[-1], data or {})
+                else:
+                    status, reply = standin.api_call(verb, path, data)
+                payload = json.dumps(reply).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def do_PUT(self):
+                self._handle('PUT')
+
+            def do_PATCH(self):
+                self._handle('PATCH')
+
+            def do_DELETE(self):
+                self._handle('DELETE')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        telegram.TELEGRAM_HOSTNAME = url
+        CONFIG['API_URL'] = url
+        return url
+
+    def stop(self):
+        """ Stops the stand-in HTTP server """
+        if self.server is not None:
+            self.server.shutdown()
+
+
+class Stats(object):
+    """
+    Thread-safe collector of per-update latencies and errors
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = {}
+        self.completed = 0
+
+    def record(self, latency):
+        """ Records the latency of one processed update in seconds """
+        with self.lock:
+            self.latencies.append(latency)
+
+    def error(self, step):
+        """ Records a failed funnel step """
+        with self.lock:
+            self.errors[step] = self.errors.get(step, 0) + 1
+
+    def done(self):
+        """ Records a virtual user that finished the whole funnel """
+        with self.lock:
+            self.completed += 1
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a sorted list
+
+    :param values: sorted list of numbers
+    :param pct: percentile between 0 and 100
+    :return: the percentile or 0 for an empty list
+    """
+    if not values:
+        return 0
+    rank = max(int(math.ceil(pct / 100.0 * len(values))) - 1, 0)
+    return values[rank]
+
+
+def think(distribution, mean):
+    """
+    Sleeps for a random think time
+
+    :param distribution: 'exp', 'uniform' or 'none'
+    :param mean: mean think time in seconds
+    """
+    if distribution == 'none' or mean <= 0:
+        return
+    if distribution == 'exp':
+        time.sleep(random.expovariate(1.0 / mean))
+    else:
+        time.sleep(random.uniform(0, 2 * mean))
+
+
+class VirtualUser(object):
+    """
+    A single user walking the onboarding funnel
+    """
+
+    def __init__(self, chat_id, language, standin, stats, distribution, think_mean):
+        self.chat_id = chat_id
+        self.language = language
+        self.standin = standin
+        self.stats = stats
+        self.distribution = distribution
+        self.think_mean = think_mean
+        self.lang = Translation(language, CONFIG['LANGUAGE_FILE'])
+        self.message_id = 0
+
+    def send(self, text, callback_data=None):
+        """
+        Sends a text message, or presses an inline button when callback_data
+        is given, from this user through bot_handler
+
+        :param text: message text
+        :param callback_data: callback data of the pressed inline button
+        :return: True if bot_handler did not raise
+        """
+        self.message_id += 1
+        sender = {'id': self.chat_id, 'is_bot': False, 'first_name': 'loadgen'}
+        chat = {'id': self.chat_id, 'type': 'private'}
+        if callback_data is None:
+            update = {'message': {
+                'message_id': self.message_id,
+                'date': int(time.time()),
+                'text': text,
+                'chat': chat,
+                'from': sender}}
+        else:
+            update = {'callback_query': {
+                'id': str(self.message_id),
+                'from': sender,
+                'data': callback_data,
+                'message': {'message_id': self.message_id, 'chat': chat}}}
+        update['update_id'] = next(UPDATE_IDS)
+        event = {
+            'token': TOKEN,
+            'lang': self.language,
+            'Input': update
+        }
+        start = time.perf_counter()
+        try:
+            outlinebot.bot_handler(event, None)
+        except Exception:
+            return False
+        finally:
+            self.stats.record(time.perf_counter() - start)
+        return True
+
+    def step(self, name, text, prefix, callback_data=None):
+        """
+        Sends one message and checks the reply of the bot
+
+        :param name: name of the funnel step for error reporting
+        :param text: message text
+        :param prefix: expected beginning of the reply text
+        :param callback_data: callback data of the pressed inline button
+        :return: reply or None if the step failed
+        """
+        if not self.send(text, callback_data):
+            self.stats.error(name)
+            return None
+        reply = self.standin.last_reply(self.chat_id)
+        if reply is None or not str(reply.get('text', '')).startswith(prefix):
+            self.stats.error(name)
+            return None
+        return reply
+
+    def run(self):
+        """ Walks the funnel, stopping at the first failed step """
+        lang = self.lang
+        language_button = lang.text('SUPPORTED_LANGUAGES')[
+            CONFIG['SUPPORTED_LANGUAGES'].index(self.language)]
+
+        if self.step('start', '/start', lang.text('MSG_SELECT_LANGUAGE')) is None:
+            return
+        think(self.distribution, self.think_mean)
+
+        prompt = self.step('set_language', language_button, lang.text('MSG_ASK_CAPTCHA'))
+        match = CAPTCHA_PATTERN.search(prompt['text'] if prompt else '')
+        if match is None:
+            return
+        think(self.distribution, self.think_mean)
+
+        # Signed captchas come as an inline keyboard
+        answer = str(int(match.group(1)) + int(match.group(2)))
+        callback_data = None
+        for row in prompt.get('reply_markup', {}).get('inline_keyboard', []):
+            for button in row:
+                if button['text'] == answer:
+                    callback_data = button['callback_data']
+        if self.step('captcha', answer, lang.text('MSG_OPT_IN'), callback_data) is None:
+            return
+        think(self.distribution, self.think_mean)
+
+        if self.step('opt_in', lang.text('MENU_PRIVACY_POLICY_CONFIRM'),
+                     lang.text('MSG_HOME')) is None:
+            return
+        think(self.distribution, self.think_mean)
+
+        if self.step('new_key', lang.text('MENU_HOME_NEW_KEY'),
+                     lang.text('MSG_HOME_ELSE')) is None:
+            return
+        self.stats.done()
+
+
+def create_tables():
+    """
+    Creates the chat, info and records tables on the configured DynamoDB endpoint
+    if they do not exist yet
+    """
+    resource = boto3.resource('dynamodb')
+    chat_key_type = 'S' if dynamodb.key_scheme() == dynamodb.LEGACY_SCHEME else 'B'
+    definitions = [
+        (CONFIG['DYNAMO_TABLE'], [('chat_id', 'HASH', chat_key_type)]),
+        (CONFIG['INFO_DYNAMO_TABLE'], [
+            ('language', 'HASH', 'S'), ('linktype', 'RANGE', 'S')]),
+        (CONFIG['RECORDS_DYNAMO_TABLE'], [
+            ('kind', 'HASH', 'S'), ('key', 'RANGE', 'S')])
+    ]
+    for name, keys in definitions:
+        try:
+            resource.create_table(
+                TableName=name,
+                KeySchema=[
+                    {'AttributeName': key, 'KeyType': key_type}
+                    for key, key_type, _ in keys],
+                AttributeDefinitions=[
+                    {'AttributeName': key, 'AttributeType': attribute_type}
+                    for key, _, attribute_type in keys],
+                BillingMode='PAY_PER_REQUEST').wait_until_exists()
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ResourceInUseException':
+                raise
+
+
+def run_stage(concurrency, users, languages, standin, distribution, think_mean, first_chat_id):
+    """
+    Runs one load stage
+
+    :param concurrency: number of concurrent virtual users
+    :param users: number of virtual users to run in this stage
+    :param languages: list of languages virtual users pick from
+    :param standin: running StandIn
+    :param distribution: think time distribution
+    :param think_mean: mean think time in seconds
+    :param first_chat_id: chat id of the first virtual user
+    :return: Stats and wall clock duration of the stage
+    """
+    stats = Stats()
+    virtual_users = [
+        VirtualUser(first_chat_id + i, random.choice(languages), standin,
+                    stats, distribution, think_mean)
+        for i in range(users)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in pool.map(lambda user: user.run(), virtual_users):
+            pass
+    return stats, time.perf_counter() - start
+
+
+def report(concurrency, users, stats, elapsed):
+    """
+    Prints the result of one stage
+
+    :param concurrency: number of concurrent virtual users
+    :param users: number of virtual users in the stage
+    :param stats: Stats of the stage
+    :param elapsed: wall clock duration in seconds
+    """
+    latencies = sorted(stats.latencies)
+    failed = sum(stats.errors.values())
+    print('concurrency={} users={} completed={} updates={} '
+          'updates/s={:.1f} error_rate={:.2%}'.format(
+              concurrency, users, stats.completed, len(latencies),
+              len(latencies) / elapsed if elapsed else 0,
+              failed / users if users else 0))
+    print('  latency ms: p50={:.1f} p95={:.1f} p99={:.1f} max={:.1f}'.format(
+        percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+        percentile(latencies, 99) * 1000, (latencies[-1] if latencies else 0) * 1000))
+    if stats.errors:
+        print('  errors: {}'.format(', '.join(
+            '{}={}'.format(step, count) for step, count in sorted(stats.errors.items()))))
+    for dependency, spans in sorted(tracing.percentiles().items()):
+        print('  {}: calls={} p50={:.1f} p95={:.1f} p99={:.1f} ms'.format(
+            dependency, spans['count'], spans['p50'], spans['p95'], spans['p99']))
+    throttling = dynamodb.throttle_stats()
+    if throttling['calls']:
+        print('  dynamodb: {}'.format(', '.join(
+            '{}={}'.format(name, value) for name, value in sorted(throttling.items()))))
+
+    counts = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+    for latency in latencies:
+        ms = latency * 1000
+        index = next((i for i, bound in enumerate(HISTOGRAM_BUCKETS_MS) if ms <= bound),
+                     len(HISTOGRAM_BUCKETS_MS))
+        counts[index] += 1
+    widest = max(counts) or 1
+    for i, count in enumerate(counts):
+        label = ('<= {}'.format(HISTOGRAM_BUCKETS_MS[i]) if i < len(HISTOGRAM_BUCKETS_MS)
+                 else '>  {}'.format(HISTOGRAM_BUCKETS_MS[-1]))
+        print('  {:>9} ms | {:<40} {}'.format(label, '#' * int(40 * count / widest), count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BeePass bot onboarding load generator')
+    parser.add_argument('--concurrency', default='1,10,50',
+                        help='comma separated concurrency levels, one stage each')
+    parser.add_argument('--users', type=int, default=0,
+                        help='virtual users per stage (default: 5 x concurrency)')
+    parser.add_argument('--languages', default=','.join(CONFIG['SUPPORTED_LANGUAGES']),
+                        help='comma separated languages virtual users pick from')
+    parser.add_argument('--think', choices=['exp', 'uniform', 'none'], default='exp',
+                        help='think time distribution between steps')
+    parser.add_argument('--think-mean', type=float, default=0.5,
+                        help='mean think time in seconds')
+    parser.add_argument('--telegram-latency', type=float, default=0.0,
+                        help='simulated Telegram API latency in seconds')
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help='simulated BeePass API latency in seconds')
+    parser.add_argument('--create-tables', action='store_true',
+                        help='create the DynamoDB tables on the local endpoint')
+    parser.add_argument('--backend', choices=sorted(statestore.BACKENDS),
+                        default=CONFIG.get('STATE_BACKEND', statestore.DYNAMODB_BACKEND),
+                        help='state store backend, see statestore.py')
+    args = parser.parse_args()
+
+    logging.getLogger('BeePassBot').setLevel(logging.WARNING)
+    # the span percentiles are reported instead of a line per update
+    CONFIG['TRACE_SUMMARY'] = False
+    CONFIG['TRACE_STATS_INTERVAL'] = 0
+    CONFIG['STATE_BACKEND'] = args.backend
+    if args.create_tables and args.backend == statestore.DYNAMODB_BACKEND:
+        create_tables()
+
+    standin = StandIn(args.telegram_latency, args.api_latency)
+    standin.start()
+    languages = args.languages.split(',')
+    chat_id = CHAT_ID_BASE + int(time.time()) % 100000 * 10000
+    try:
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            users = args.users or 5 * concurrency
+            stats, elapsed = run_stage(
+                concurrency, users, languages, standin,
+                args.think, args.think_mean, chat_id)
+            chat_id += users
+            report(concurrency, users, stats, elapsed)
+    finally:
+        standin.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,29 @@
+"""
+Log Module
+Sets up the BeePassBot logger.
+
+Records are handed to a QueueHandler and written by the handlers of a
+QueueListener on a background thread, so an update does not wait for its
+log lines to be written. On Lambda, call flush before an invocation returns:
+the process is frozen afterwards, with the records still queued, see
+flushed.
+
+Verbose payloads, such as updates and query results, go through
+log_payload, which writes LOG_PAYLOAD_SAMPLE of them.
+"""
+
+import atexit
+import copy
+import functools
 import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+from settings import CONFIG
+
+# running listeners by logger name
+_listeners = {}
 
 
 def is_true(s) -> bool:
@@ -20,10 +45,6 @@ def is_true(s) -> bool:
     return False
 
 
-class Empty(object):
-    """An empty class used to copy :class:`~logging.LogRecord` objects without reinitializing them."""
-
-
 class CustomFormatter(logging.Formatter):
 
     def __init__(self, style='NEUTRAL', *args, **kwargs):
@@ -46,47 +67,61 @@ class CustomFormatter(logging.Formatter):
             logging.CRITICAL: f"{bold_red}{self.fmt}{reset}"
         }
 
+        # one formatter per level, built once
+        self.default = logging.Formatter(self.fmt)
+        self.formatters = {}
+        if self.style == 'COLORED':
+            self.formatters = {
+                level: logging.Formatter(log_fmt)
+                for level, log_fmt in self.colored_format.items()}
+
     def format(self, record):
-        # Due to the way that Python's logging module is structured and
-        # documented the only (IMHO) clean way to customize its behavior is
-        # to change incoming LogRecord objects before they get to the base
-        # formatter. However we don't want to break other formatters and
-        # handlers, so we copy the log record.
-        copy = Empty()
-        copy.__class__ = record.__class__
-        copy.__dict__.update(record.__dict__)
-        if self.style == 'NEUTRAL':
-            formatter = logging.Formatter(self.fmt)
-        elif self.style == 'COLORED':
-            log_fmt = self.colored_format.get(copy.levelno)
-            formatter = logging.Formatter(log_fmt)
-        record = formatter.format(copy)
+        return self.formatters.get(record.levelno, self.default).format(record)
+
 
+class RecordQueueHandler(QueueHandler):
+    """
+    QueueHandler keeping the traceback of a record apart from its message,
+    so it is written after the line as by the other handlers
+    """
+
+    def prepare(self, record):
+        # the arguments may change once the call returns, the traceback
+        # object keeps frames alive: both are rendered here
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatter.formatException(record.exc_info)
+            record.exc_info = None
         return record
 
 
 def Log(logger_name,
         style='NEUTRAL',
         is_debug=True,
-        fname=None):
+        fname=None,
+        queued=True):
     logger = logging.getLogger(logger_name)
-    # set the logger's level to the "lowest"
-    logger.setLevel(logging.DEBUG)
     logger.propagate = False
     formatter = CustomFormatter(style)
     # Clear the custom logger's handlers
     logger.handlers.clear()
     # Clear the custom logger's handlers
     logging.getLogger().handlers.clear()
+    listener = _listeners.pop(logger_name, None)
+    if listener is not None:
+        listener.stop()
 
+    handlers = []
     if fname is not None:
         # create file handler which logs even debug messages
         fh = logging.FileHandler(fname)
         fh.setLevel(logging.DEBUG)
         # Set formatter
         fh.setFormatter(formatter)
-        # add the handlers to logger
-        logger.addHandler(fh)
+        handlers.append(fh)
 
     # create console handler with a higher log level
     ch = logging.StreamHandler()
@@ -94,11 +129,67 @@ def Log(logger_name,
     ch.setLevel(logging.DEBUG if is_true(is_debug) else logging.INFO)
     # Set formatter
     ch.setFormatter(formatter)
-    # add the handlers to logger
-    logger.addHandler(ch)
+    handlers.append(ch)
+
+    # the logger drops what no handler writes before a record is made
+    logger.setLevel(min(handler.level for handler in handlers))
+
+    if queued:
+        listener = QueueListener(queue.Queue(), *handlers, respect_handler_level=True)
+        listener.start()
+        _listeners[logger_name] = listener
+        handler = RecordQueueHandler(listener.queue)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
 
     return logger
 
 
+def flush():
+    """ Waits until the queued records are written """
+    for listener in list(_listeners.values()):
+        listener.queue.join()
+
+
+def flushed(handler):
+    """
+    Makes a Lambda entry point flush the queued records before it returns,
+    when it is called with a Lambda context
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            if context is not None:
+                flush()
+    return wrapper
+
+
+@atexit.register
+def _stop_listeners():
+    while _listeners:
+        _listeners.popitem()[1].stop()
+
+
+def log_payload(logger, msg, *args):
+    """
+    Logs a verbose payload at DEBUG, for a sample of LOG_PAYLOAD_SAMPLE of
+    the calls (1: all, 0: none)
+
+    :param logger: logger to write to
+    :param msg: message, formatted with args only if it is written
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    rate = CONFIG.get('LOG_PAYLOAD_SAMPLE', 1)
+    if rate < 1 and random.random() >= rate:
+        return
+    logger.debug(msg, *args, stacklevel=2)
+
+
 def get_logger(logger_name, module_name):
     return logging.getLogger(logger_name).getChild(module_name)
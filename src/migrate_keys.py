@@ -0,0 +1,151 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Chat Key Migration
+Copies the chat table from the legacy key scheme (SHA-512 hex keys, string
+status and captcha) to the compact one (keyed BLAKE2 binary keys, numeric
+status and captcha) with a parallel scan.
+
+Run it while the bot is in the dual key scheme. Items the bot has already
+migrated lazily are left untouched. Progress of every scan segment is
+saved to a checkpoint file after each page, so an interrupted run resumes
+where it stopped:
+
+    python migrate_keys.py --segments 8 --checkpoint migrate_keys.json
+"""
+
+import argparse
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+import dynamodb
+from settings import CONFIG
+
+DONE = 'done'
+
+
+class Checkpoint(object):
+    """
+    Thread-safe scan progress, persisted as JSON
+    """
+
+    def __init__(self, path, segments):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {'segments': segments, 'positions': {}}
+        if os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self.state = json.load(checkpoint_file)
+            if self.state['segments'] != segments:
+                raise SystemExit(
+                    'Checkpoint {} was made with {} segments'.format(
+                        path, self.state['segments']))
+
+    def position(self, segment):
+        """ Returns the saved ExclusiveStartKey, DONE or None """
+        with self.lock:
+            return self.state['positions'].get(str(segment))
+
+    def save(self, segment, position):
+        """ Saves the position of a segment and writes the file """
+        with self.lock:
+            self.state['positions'][str(segment)] = position
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as checkpoint_file:
+                json.dump(self.state, checkpoint_file)
+            os.replace(tmp_path, self.path)
+
+
+def migrate_segment(segment, segments, checkpoint, page_size, counters, lock):
+    """
+    Migrates one scan segment of the legacy table
+
+    :param segment: segment number
+    :param segments: total number of segments
+    :param checkpoint: Checkpoint of the run
+    :param page_size: items per scan page
+    :param counters: shared dictionary of copied/skipped counts
+    :param lock: lock guarding counters
+    """
+    start_key = checkpoint.position(segment)
+    if start_key == DONE:
+        return
+
+    legacy = dynamodb.get_table(CONFIG['LEGACY_DYNAMO_TABLE'])
+    compact = dynamodb.get_table(CONFIG['DYNAMO_TABLE'])
+    while True:
+        kwargs = {
+            'Segment': segment,
+            'TotalSegments': segments,
+            'Limit': page_size
+        }
+        if start_key:
+            kwargs['ExclusiveStartKey'] = start_key
+        page = legacy.scan(**kwargs)
+
+        copied = skipped = 0
+        for item in page.get('Items', []):
+            try:
+                compact.put_item(
+                    Item=dynamodb.compact_item(item),
+                    ConditionExpression='attribute_not_exists(chat_id)')
+                copied += 1
+            except ClientError as error:
+                if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                skipped += 1
+        with lock:
+            counters['copied'] += copied
+            counters['skipped'] += skipped
+
+        start_key = page.get('LastEvaluatedKey')
+        checkpoint.save(segment, start_key or DONE)
+        if not start_key:
+            return
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate chat table keys')
+    parser.add_argument('--segments', type=int, default=8,
+                        help='number of parallel scan segments')
+    parser.add_argument('--page-size', type=int, default=500,
+                        help='items per scan page')
+    parser.add_argument('--checkpoint', default='migrate_keys.json',
+                        help='file used to resume an interrupted run')
+    args = parser.parse_args()
+
+    if dynamodb.key_scheme() != dynamodb.DUAL_SCHEME:
+        raise SystemExit('Set CHAT_KEY_SCHEME to dual before migrating')
+
+    checkpoint = Checkpoint(args.checkpoint, args.segments)
+    counters = {'copied': 0, 'skipped': 0}
+    lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=args.segments) as pool:
+        futures = [
+            pool.submit(migrate_segment, segment, args.segments, checkpoint,
+                        args.page_size, counters, lock)
+            for segment in range(args.segments)]
+        for future in futures:
+            future.result()
+
+    print('Copied {copied} items, {skipped} were already migrated'.format(**counters))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,14 +13,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import time
 import base64
-from tmsg import TelegramMessage
+import contextvars
+from tmsg import TelegramMessage, update_kind, update_type
 import telegram
-from errors import ValidationError
-import dynamodb
-from captcha import get_choice, check_captcha
+from errors import AWSError, DBError, ValidationError
+from statestore import ChatState, get_store
+from captcha import (
+    get_choice,
+    check_captcha,
+    get_signed_choice,
+    check_signed_captcha,
+    captcha_mode,
+    STORED_MODE,
+    CALLBACK_PREFIX)
 import api
+import broadcast
+import chatindex
+import dedup
+import jobs
+import keymigration
+import keyqueue
+import tracing
+from keyqueue import ASYNC_MODE, key_issue_mode
 from admin import admin_menu
 from helpers import (
     save_chat_status,
@@ -29,20 +44,27 @@ from helpers import (
     change_lang,
     get_pp_link,
     get_tos_link,
-    hash_str)
+    menu_key,
+    profile_flags,
+    remember_profile)
+from identity import Identity
 import globalvars
 
 from settings import CONFIG, STATUSES
 import urllib.parse
-from log import Log
+from log import Log, flushed, log_payload
 
 
-logger = Log("BeePassBot", is_debug=CONFIG['IS_DEBUG'])
+# status names by value, to tag traces
+STATUS_NAMES = {value: name for name, value in STATUSES.items()}
+
+logger = Log("BeePassBot", is_debug=CONFIG['IS_DEBUG'], queued=CONFIG.get('LOG_QUEUE', True))
 
 
 def create_new_key(tmsg, token, issue_id=None) -> bool:
     """
-    Creates and sends new key for the user and
+    Creates and sends new key for the user. In async key issue mode the
+    request is queued and the key is sent when it is ready, see keyqueue.py
 
     :param tmsg: Telegram message
     :param token: Telegram bot token
@@ -53,6 +75,15 @@ def create_new_key(tmsg, token, issue_id=None) -> bool:
         tmsg.chat_id,
         globalvars.lang.text('MSG_WAIT'))
 
+    if key_issue_mode() == ASYNC_MODE:
+        try:
+            keyqueue.enqueue(
+                token, tmsg.user_uid, tmsg.chat_id,
+                globalvars.lang.language, tmsg.lang, issue_id)
+            return True
+        except (DBError, AWSError) as exc:
+            logger.error(f'Unable to queue a new key, creating it now: {exc}')
+
     try:
         new_keys, online_config_link = api.get_new_key(user_id=tmsg.user_uid, user_issue=issue_id)
     except Exception as exc:
@@ -69,32 +100,134 @@ def create_new_key(tmsg, token, issue_id=None) -> bool:
             globalvars.lang.text('MSG_ERROR_NO_KEY'))
         return False
     else:
-        telegram.send_message(
-            token,
-            tmsg.chat_id,
-            globalvars.lang.text('MSG_OUTLINE_SSL_CONF'),
-            parse='MARKDOWN')
+        keyqueue.send_new_key(
+            token, tmsg.chat_id, globalvars.lang, tmsg.lang, online_config_link)
+        return True
 
-        awsurl = (CONFIG['OUTLINE_AWS_URL'].format(
-            tmsg.lang,
-            online_config_link))
 
-        telegram.send_message(
+def user_profile(tmsg):
+    """
+    Returns the profile flags of the user, cached on the chat while they
+    are fresh and read from the API otherwise, see helpers.profile_flags
+
+    :param tmsg: Telegram message
+    :return: dictionary of flags
+    :raise: Exception: the API call failed, see api.get_user
+    """
+    state = tmsg.identity.state
+    if state is not None and state.profile is not None:
+        return state.profile
+    profile = profile_flags(api.get_user(tmsg.user_uid))
+    remember_profile(tmsg.identity, profile)
+    return profile
+
+
+def send_existing_key(tmsg, token, online_config_link):
+    """
+    Sends a returning user the key they already have
+
+    :param tmsg: Telegram message
+    :param token: Telegram bot token
+    :param online_config_link: ss_link of the user's key
+    """
+    telegram.send_message(
+        token,
+        tmsg.chat_id,
+        globalvars.lang.text('MSG_OUTLINE_RETURNING_USER'))
+
+    awsurl = (CONFIG['OUTLINE_AWS_URL'].format(
+        tmsg.lang,
+        online_config_link))
+    telegram.send_message(
+        token,
+        tmsg.chat_id,
+        globalvars.lang.text(
+            'MSG_EXISTING_KEY_A').format(f"{awsurl}#BeePass"),
+        parse='MARKDOWN')
+    telegram.send_message(
+        token,
+        tmsg.chat_id,
+        globalvars.lang.text('MSG_EXISTING_KEY_B'),
+        parse='MARKDOWN')
+    telegram.send_message(
+        token,
+        tmsg.chat_id,
+        f"{online_config_link}#BeePass")
+
+
+def send_captcha(tmsg, token):
+    """
+    Sends a new captcha to the user. In signed mode the choices are sent as
+    an inline keyboard carrying the signed answer, otherwise the operands
+    are stored in the DB.
+
+    :param tmsg: Telegram message
+    :param token: Telegram bot token
+    """
+    inline = captcha_mode() != STORED_MODE
+    if inline:
+        choices, a, b, callbacks = get_signed_choice(tmsg.identity)
+        keyboard = telegram.make_keyboard(
+            [{'text': choice, 'callback_data': data}
+             for choice, data in zip(choices, callbacks)], 2, '')
+    else:
+        choices, a, b = get_choice(
+            table=CONFIG["DYNAMO_TABLE"],
+            chat_id=tmsg.identity)
+        if choices:
+            keyboard = telegram.make_keyboard(choices, 2, '')
+    if choices:
+        telegram.send_keyboard(
             token,
             tmsg.chat_id,
-            globalvars.lang.text('MSG_NEW_KEY_A').format(f"{awsurl}#BeePass"),
-            parse='MARKDOWN')
+            "{}\n{} + {}:".format(
+                globalvars.lang.text("MSG_ASK_CAPTCHA"), a, b),
+            keyboard,
+            inline=inline)
+
+
+def captcha_passed(tmsg, token):
+    """
+    Sends the terms and asks the user to opt in
+
+    :param tmsg: Telegram message
+    :param token: Telegram bot token
+    """
+    tos = get_tos_link()
+    pp = get_pp_link()
+    if tos is not None:
         telegram.send_message(
             token,
             tmsg.chat_id,
-            globalvars.lang.text('MSG_NEW_KEY_B'),
-            parse='MARKDOWN')
+            tos
+        )
+    if pp is not None:
         telegram.send_message(
             token,
             tmsg.chat_id,
-            f"{online_config_link}#BeePass")
+            pp
+        )
+    telegram.send_keyboard(
+        token,
+        tmsg.chat_id,
+        globalvars.lang.text("MSG_OPT_IN"),
+        globalvars.OPT_IN_KEYBOARD)
+    save_chat_status(tmsg.identity, STATUSES['OPT_IN'])
 
-        return True
+
+def captcha_failed(tmsg, token):
+    """
+    Tells the user the answer was wrong and sends a new captcha
+
+    :param tmsg: Telegram message
+    :param token: Telegram bot token
+    """
+    telegram.send_message(
+        token,
+        tmsg.chat_id,
+        globalvars.lang.text('MSG_WRONG_CAPTCHA'))
+    send_captcha(tmsg, token)
+    save_chat_status(tmsg.identity, STATUSES['FIRST_CAPTCHA'])
 
 
 def unsupported_message(tmsg, token) -> bool:
@@ -105,41 +238,54 @@ def unsupported_message(tmsg, token) -> bool:
         globalvars.lang.text("MSG_UNSUPPORTED_COMMAND"))
 
     try:
-        vpnuser = api.get_user(tmsg.user_uid)
+        profile = user_profile(tmsg)
     except Exception as exc:
         logger.error('Could not get user profile: {}'.format(exc))
         return False
 
-    if not vpnuser or not vpnuser['username']:  # start from First step
+    if not profile['registered']:  # start from First step
         keyboard = make_language_keyboard()
         telegram.send_keyboard(
             token,
             tmsg.chat_id,
             globalvars.lang.text('MSG_SELECT_LANGUAGE'),
             keyboard)
-        save_chat_status(tmsg.chat_id, STATUSES['SET_LANGUAGE'])
+        save_chat_status(tmsg.identity, STATUSES['SET_LANGUAGE'])
     else:
         telegram.send_keyboard(
             token,
             tmsg.chat_id,
             globalvars.lang.text('MSG_HOME_ELSE'),
             globalvars.HOME_KEYBOARD)
-        save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+        save_chat_status(tmsg.identity, STATUSES['HOME'])
     return True
 
 
-def bot_handler(event, _):
+@flushed
+def bot_handler(event, context):
     """
     Main entry point to handle the bot
 
-    param event: information about the chat
-    :param _: information about the telegram message (unused)
+    param event: information about the chat, or a job to run
+    :param context: Lambda context, used by job runs
     """
-    logger.debug(
-        "%s:%s Request received:%s",
-        __name__,
-        str(time.time()),
-        str(event))
+    log_payload(logger, 'Request received: %s', event)
+
+    if broadcast.EVENT in event:
+        broadcast.run(event[broadcast.EVENT], event['token'], context)
+        return True
+    if keymigration.EVENT in event:
+        keymigration.run(event[keymigration.EVENT], event['token'], context)
+        return True
+    if keymigration.DETECT_EVENT in event:
+        keymigration.detect(event['token'])
+        return True
+    if jobs.RESUME_EVENT in event:
+        for job in (broadcast.BroadcastJob, keymigration.KeyMigrationJob):
+            job.resume_stalled(event['token'])
+        return True
+    if keyqueue.EVENT in event:
+        return keyqueue.work(event[keyqueue.EVENT], event['token'])
 
     try:
         default_language = event["lang"]
@@ -154,15 +300,49 @@ def bot_handler(event, _):
         logger.error("Token is not defined!")
         return None
 
+    # Kinds of updates the bot does not answer are dropped before any
+    # other work, then redelivered updates
+    update = event.get('Input') or {}
+    message_type = update_type(update)
+    if (message_type != 'MEMBER_UPDATE' and
+            message_type not in CONFIG['SUPPORTED_MESSAGE_TYPES']):
+        logger.info('Not supported update kind: {}'.format(update_kind(update)))
+        return None
+    if not dedup.claim(update):
+        return True
+    try:
+        # a context of its own, so the language set by change_lang is
+        # neither left over from the last update on this thread nor seen
+        # by the updates handled alongside
+        return contextvars.Context().run(
+            tracing.run, handle_update, event, token, default_language)
+    except Exception:
+        dedup.release(update)
+        raise
+
+
+def handle_update(event, token, default_language):
+    """
+    Parses a Telegram update and answers it
+
+    :param event: information about the chat
+    :param token: Telegram bot token
+    :param default_language: language of chats without a stored one
+    """
     try:
         tmsg = TelegramMessage(event, default_language)
-        tmsg.user_uid = hash_str(tmsg.user_uid)
-        logger.debug("TMSG object: {}".format(tmsg))
+        tmsg.identity = Identity(tmsg.chat_id, tmsg.user_uid)
+        tmsg.user_uid = tmsg.identity.user_hash
+        log_payload(logger, 'Parsed %s update of %r', tmsg.type, tmsg.identity)
     except Exception as exc:
         logger.error(
             'Error in Telegram Message parsing {} {}'.format(event, str(exc)))
         return None
 
+    tracing.tag(type=tmsg.type)
+    if tmsg.type == 'MEMBER_UPDATE' and tmsg.chat_id != 0:
+        return chatindex.track(tmsg.identity, tmsg.status)
+
     if tmsg.type not in CONFIG['SUPPORTED_MESSAGE_TYPES']:
         logger.info('Not supported message type: {}'.format(tmsg.type))
         return None
@@ -172,14 +352,62 @@ def bot_handler(event, _):
             'This message type has no chat_id: {}'.format(tmsg.type))
         return True
 
-    preferred_lang = None
     try:
-        preferred_lang = dynamodb.get_user_lang(
+        return handle_message(tmsg, token, default_language)
+    except DBError as exc:
+        # Guessing the chat state would route the user to the wrong step
+        logger.error('Chat state unavailable for {}: {}'.format(
+            tmsg.identity.log_id, str(exc)))
+        change_lang(tmsg.lang)
+        telegram.send_message(
+            token,
+            tmsg.chat_id,
+            globalvars.lang.text('MSG_ERROR'))
+        return None
+
+
+def update_action(tmsg):
+    """
+    Names what an update asks for, to tag its trace: a command, a menu
+    item, a captcha answer, or text
+
+    :param tmsg: Telegram message
+    :return: action name, from a bounded set
+    """
+    if tmsg.command:
+        if tmsg.command in (CONFIG['TELEGRAM_START_COMMAND'], CONFIG['TELEGRAM_ADMIN_COMMAND']):
+            return tmsg.command
+        return 'command'
+    if tmsg.type == 'CALLBACK':
+        return 'captcha' if tmsg.body.startswith(CALLBACK_PREFIX) else 'callback'
+    return menu_key(tmsg.body) or 'text'
+
+
+def handle_message(tmsg, token, default_language):
+    """
+    Answers a parsed update according to the state of its chat
+
+    :param tmsg: Telegram message
+    :param token: Telegram bot token
+    :param default_language: language of chats without a stored one
+    :raise: DBError: the chat state could not be read or written
+    """
+    # One eventually consistent read per update, status writes are
+    # conditional on it and re-read consistently when it was stale
+    chat_state = None
+    try:
+        chat_state = get_store().get_chat(
             table=CONFIG["DYNAMO_TABLE"],
-            chat_id=tmsg.chat_id)
+            chat_id=tmsg.identity)
+    except DBError:
+        raise
     except Exception as exc:
         logger.error(
-            'Can not find preferred_lang for {}: {}'.format(tmsg, str(exc)))
+            'Can not read chat state for {}: {}'.format(tmsg, str(exc)))
+    tmsg.identity.state = chat_state
+    if chat_state is None:
+        chat_state = ChatState()
+    preferred_lang = chat_state.language
 
     if (preferred_lang is None or
             preferred_lang not in CONFIG['SUPPORTED_LANGUAGES']):
@@ -189,6 +417,7 @@ def bot_handler(event, _):
 
     change_lang(preferred_lang)
     tmsg.lang = preferred_lang
+    tracing.tag(state=STATUS_NAMES.get(chat_state.status, 'none'), action=update_action(tmsg))
 
     if tmsg.body == globalvars.lang.text('MENU_BACK_HOME'):
         telegram.send_keyboard(
@@ -196,7 +425,7 @@ def bot_handler(event, _):
             tmsg.chat_id,
             globalvars.lang.text('MSG_HOME_ELSE'),
             globalvars.HOME_KEYBOARD)
-        save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+        save_chat_status(tmsg.identity, STATUSES['HOME'])
         return
 
     if tmsg.command == CONFIG['TELEGRAM_START_COMMAND'] and len(tmsg.command_arg) > 0:
@@ -205,8 +434,8 @@ def bot_handler(event, _):
 
     # Check for commands (starts with /)
     if tmsg.command == CONFIG["TELEGRAM_START_COMMAND"]:
-        dynamodb.create_chat_status(
-            CONFIG['DYNAMO_TABLE'], tmsg.chat_id, STATUSES['START'])
+        get_store().create_chat_status(
+            CONFIG['DYNAMO_TABLE'], tmsg.identity, STATUSES['START'])
         telegram.send_message(
             token,
             tmsg.chat_id,
@@ -217,12 +446,10 @@ def bot_handler(event, _):
             tmsg.chat_id,
             globalvars.lang.text('MSG_SELECT_LANGUAGE'),
             keyboard)
-        save_chat_status(tmsg.chat_id, STATUSES['SET_LANGUAGE'])
+        save_chat_status(tmsg.identity, STATUSES['SET_LANGUAGE'])
         return None
     elif tmsg.command == CONFIG['TELEGRAM_ADMIN_COMMAND']:
-        chat_status = int(dynamodb.get_chat_status(
-            table=CONFIG["DYNAMO_TABLE"],
-            chat_id=tmsg.chat_id))
+        chat_status = chat_state.status
         if not admin_menu(token, tmsg, chat_status):
             telegram.send_keyboard(
                 token,
@@ -234,9 +461,7 @@ def bot_handler(event, _):
 
     # non-command texts, a message not started with /
     elif tmsg.type == 'MESSAGE':
-        chat_status = int(dynamodb.get_chat_status(
-            table=CONFIG["DYNAMO_TABLE"],
-            chat_id=tmsg.chat_id))
+        chat_status = chat_state.status
 
         if chat_status >= STATUSES['ADMIN_SECTION_HOME']:
             if not admin_menu(token, tmsg, chat_status):
@@ -255,10 +480,11 @@ def bot_handler(event, _):
             else:
                 new_lang = CONFIG['SUPPORTED_LANGUAGES'][globalvars.lang.text(
                     'SUPPORTED_LANGUAGES').index(tmsg.body)]
-                dynamodb.save_user_lang(
+                get_store().save_user_lang(
                     table=CONFIG["DYNAMO_TABLE"],
-                    chat_id=tmsg.chat_id,
+                    chat_id=tmsg.identity,
                     language=new_lang)
+                chatindex.update(tmsg.identity, language=new_lang)
                 change_lang(new_lang)
                 message = globalvars.lang.text(
                     'MSG_LANGUAGE_CHANGED').format(tmsg.body)
@@ -268,7 +494,7 @@ def bot_handler(event, _):
                 message)
 
             try:
-                vpnuser = api.get_user(tmsg.user_uid)
+                profile = user_profile(tmsg)
             except Exception as exc:
                 logger.error(f'Error in getting user info: {exc}')
                 telegram.send_message(
@@ -277,84 +503,42 @@ def bot_handler(event, _):
                     globalvars.lang.text('MSG_ERROR'))
                 return None
 
-            if not vpnuser or not vpnuser['username']:
-                choices, a, b = get_choice(
-                    table=CONFIG["DYNAMO_TABLE"],
-                    chat_id=tmsg.chat_id)
-                if choices:
-                    keyboard = telegram.make_keyboard(choices, 2, '')
-                    telegram.send_keyboard(
-                        token,
-                        tmsg.chat_id,
-                        "{}\n{} + {}:".format(
-                            globalvars.lang.text("MSG_ASK_CAPTCHA"), a, b),
-                        keyboard)
-                save_chat_status(tmsg.chat_id, STATUSES['FIRST_CAPTCHA'])
+            if not profile['registered']:
+                send_captcha(tmsg, token)
+                save_chat_status(tmsg.identity, STATUSES['FIRST_CAPTCHA'])
             else:
                 telegram.send_keyboard(
                     token,
                     tmsg.chat_id,
                     globalvars.lang.text('MSG_HOME_ELSE'),
                     globalvars.HOME_KEYBOARD)
-                save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+                save_chat_status(tmsg.identity, STATUSES['HOME'])
             return None
 
         elif chat_status == STATUSES['FIRST_CAPTCHA']:
-            try:
-                check = check_captcha(
-                    table=CONFIG["DYNAMO_TABLE"],
-                    chat_id=tmsg.chat_id,
-                    sum=int(tmsg.body))
-            except Exception as exc:
-                check = False
-                logger.error(
-                    "Wrong First captcha from {} - error: {}".format(
-                        hash_str(tmsg.user_uid), str(exc)))
+            check = False
+            if captcha_mode() == STORED_MODE:
+                try:
+                    check = check_captcha(
+                        table=CONFIG["DYNAMO_TABLE"],
+                        chat_id=tmsg.identity,
+                        sum=int(tmsg.body),
+                        choices=chat_state.captcha)
+                except Exception as exc:
+                    logger.error(
+                        "Wrong First captcha from {} - error: {}".format(
+                            tmsg.identity.log_id, str(exc)))
 
             if check:
-                tos = get_tos_link()
-                pp = get_pp_link()
-                if tos is not None:
-                    telegram.send_message(
-                        token,
-                        tmsg.chat_id,
-                        tos
-                    )
-                if pp is not None:
-                    telegram.send_message(
-                        token,
-                        tmsg.chat_id,
-                        pp
-                    )
-                telegram.send_keyboard(
-                    token,
-                    tmsg.chat_id,
-                    globalvars.lang.text("MSG_OPT_IN"),
-                    globalvars.OPT_IN_KEYBOARD)
-                save_chat_status(tmsg.chat_id, STATUSES['OPT_IN'])
+                captcha_passed(tmsg, token)
             else:
-                telegram.send_message(
-                    token,
-                    tmsg.chat_id,
-                    globalvars.lang.text('MSG_WRONG_CAPTCHA'))
-                choices, a, b = get_choice(
-                    table=CONFIG["DYNAMO_TABLE"],
-                    chat_id=tmsg.chat_id)
-                if choices:
-                    keyboard = telegram.make_keyboard(choices, 2, '')
-                    telegram.send_keyboard(
-                        token,
-                        tmsg.chat_id,
-                        "{}\n{} + {}:".format(
-                            globalvars.lang.text("MSG_ASK_CAPTCHA"), a, b),
-                        keyboard)
-                save_chat_status(tmsg.chat_id, STATUSES['FIRST_CAPTCHA'])
+                captcha_failed(tmsg, token)
             return None
 
         elif chat_status == STATUSES['OPT_IN']:
             if tmsg.body == globalvars.lang.text('MENU_PRIVACY_POLICY_CONFIRM'):
                 try:
-                    api.create_user(user_id=tmsg.user_uid, chatid=tmsg.chat_id)
+                    vpnuser = api.create_user(user_id=tmsg.user_uid, chatid=tmsg.chat_id)
                 except Exception as exc:
                     logger.error(f'Error in creating new user: {exc}')
                     telegram.send_message(
@@ -362,19 +546,22 @@ def bot_handler(event, _):
                         tmsg.chat_id,
                         globalvars.lang.text('MSG_ERROR'))
                     return None
+                remember_profile(
+                    tmsg.identity, profile_flags(vpnuser) if vpnuser else None)
+                chatindex.update(tmsg.identity, opted_in=True)
                 telegram.send_keyboard(
                     token,
                     tmsg.chat_id,
                     globalvars.lang.text('MSG_HOME'),
                     globalvars.HOME_KEYBOARD)
-                save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+                save_chat_status(tmsg.identity, STATUSES['HOME'])
             else:
                 telegram.send_keyboard(
                     token,
                     tmsg.chat_id,
                     globalvars.lang.text('MSG_PRIVACY_POLICY_DECLINE'),
                     globalvars.OPT_IN_DECLINED_KEYBOARD)
-                save_chat_status(tmsg.chat_id, STATUSES['OPT_IN_DECLINED'])
+                save_chat_status(tmsg.identity, STATUSES['OPT_IN_DECLINED'])
             return None
 
         elif chat_status == STATUSES['OPT_IN_DECLINED']:
@@ -384,7 +571,7 @@ def bot_handler(event, _):
                     tmsg.chat_id,
                     globalvars.lang.text("MSG_OPT_IN"),
                     globalvars.OPT_IN_KEYBOARD)
-                save_chat_status(tmsg.chat_id, STATUSES['OPT_IN'])
+                save_chat_status(tmsg.identity, STATUSES['OPT_IN'])
             elif tmsg.body == globalvars.lang.text('MENU_HOME_CHANGE_LANGUAGE'):
                 keyboard = make_language_keyboard()
                 telegram.send_keyboard(
@@ -392,7 +579,7 @@ def bot_handler(event, _):
                     tmsg.chat_id,
                     globalvars.lang.text('MSG_SELECT_LANGUAGE'),
                     keyboard)
-                save_chat_status(tmsg.chat_id, STATUSES['SET_LANGUAGE'])
+                save_chat_status(tmsg.identity, STATUSES['SET_LANGUAGE'])
             return None
 
         elif chat_status == STATUSES['HOME']:
@@ -404,7 +591,7 @@ def bot_handler(event, _):
                     # user_info = api.get_outline_user(tmsg.user_uid)
                     vpnuser = api.get_user(tmsg.user_uid)
                     if not vpnuser:
-                        logger.debug("New user: {}".format(hash_str(tmsg.user_uid)))
+                        logger.debug("New user: {}".format(tmsg.identity.log_id))
                         telegram.send_message(
                             token,
                             tmsg.chat_id,
@@ -471,8 +658,10 @@ def bot_handler(event, _):
                     globalvars.HOME_KEYBOARD)
                 return None
             elif tmsg.body == globalvars.lang.text('MENU_HOME_NEW_KEY'):
+                # Returning users are answered from the profile cached on
+                # their chat, with no API call while it is fresh
                 try:
-                    vpnuser = api.get_user(tmsg.user_uid)
+                    profile = user_profile(tmsg)
                 except Exception as exc:
                     logger.error(f'Error in getting user info: {exc}')
                     telegram.send_message(
@@ -481,8 +670,8 @@ def bot_handler(event, _):
                         globalvars.lang.text('MSG_ERROR'))
                     return None
 
-                if not vpnuser or not vpnuser['username']:
-                    logger.debug("New user: {}".format(hash_str(tmsg.user_uid)))
+                if not profile['registered']:
+                    logger.debug("New user: {}".format(tmsg.identity.log_id))
                     telegram.send_message(
                         token,
                         tmsg.chat_id,
@@ -493,7 +682,7 @@ def bot_handler(event, _):
                         tmsg.chat_id,
                         '/start')
                     return None
-                elif 'banned' in vpnuser and vpnuser['banned']:
+                elif profile['banned']:
                     telegram.send_message(
                         token,
                         tmsg.chat_id,
@@ -503,9 +692,9 @@ def bot_handler(event, _):
                         tmsg.chat_id,
                         globalvars.lang.text('MSG_HOME_ELSE'),
                         globalvars.HOME_KEYBOARD)
-                    save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+                    save_chat_status(tmsg.identity, STATUSES['HOME'])
                     return None
-                elif not vpnuser['outline_key'] or len(vpnuser['outline_key'])==0:
+                elif not profile['has_key']:
                     new_key_created = create_new_key(tmsg, token)
                     if not new_key_created:
                         telegram.send_message(
@@ -518,42 +707,23 @@ def bot_handler(event, _):
                         tmsg.chat_id,
                         globalvars.lang.text('MSG_HOME_ELSE'),
                         globalvars.HOME_KEYBOARD)
-                    save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+                    save_chat_status(tmsg.identity, STATUSES['HOME'])
                     return None
                 else:
-                    telegram.send_message(
-                        token,
-                        tmsg.chat_id,
-                        globalvars.lang.text('MSG_OUTLINE_RETURNING_USER'))
-
-                    online_config_object = api.get_online_config(user_id=tmsg.user_uid)
-                    online_config_link = online_config_object['ss_link']
-
-                    awsurl = (CONFIG['OUTLINE_AWS_URL'].format(
-                        tmsg.lang,
-                        online_config_link))
-                    telegram.send_message(
-                        token,
-                        tmsg.chat_id,
-                        globalvars.lang.text(
-                            'MSG_EXISTING_KEY_A').format(f"{awsurl}#BeePass"),
-                        parse='MARKDOWN')
-                    telegram.send_message(
-                        token,
-                        tmsg.chat_id,
-                        globalvars.lang.text('MSG_EXISTING_KEY_B'),
-                        parse='MARKDOWN')
-                    telegram.send_message(
-                        token,
-                        tmsg.chat_id,
-                        f"{online_config_link}#BeePass")
-
+                    online_config_link = profile.get('config_link')
+                    if online_config_link is None:
+                        online_config_object = api.get_online_config(user_id=tmsg.user_uid)
+                        online_config_link = online_config_object['ss_link']
+                        remember_profile(
+                            tmsg.identity, dict(profile, config_link=online_config_link))
+
+                    send_existing_key(tmsg, token, online_config_link)
                     telegram.send_keyboard(
                         token,
                         tmsg.chat_id,
                         globalvars.lang.text('MSG_HOME_ELSE'),
                         globalvars.HOME_KEYBOARD)
-                    save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+                    save_chat_status(tmsg.identity, STATUSES['HOME'])
                     return None
 
             elif tmsg.body == globalvars.lang.text('MENU_HOME_FAQ'):
@@ -597,7 +767,7 @@ def bot_handler(event, _):
                     tmsg.chat_id,
                     globalvars.lang.text('MSG_SELECT_LANGUAGE'),
                     keyboard)
-                save_chat_status(tmsg.chat_id, STATUSES['SET_LANGUAGE'])
+                save_chat_status(tmsg.identity, STATUSES['SET_LANGUAGE'])
                 return None
 
             elif tmsg.body == globalvars.lang.text('MENU_HOME_PRIVACY_POLICY'):
@@ -637,7 +807,7 @@ def bot_handler(event, _):
                     globalvars.lang.text("MSG_ASK_DELETE_REASONS"),
                     keyboard)
                 save_chat_status(
-                    tmsg.chat_id, STATUSES['DELETE_ACCOUNT_REASON'])
+                    tmsg.identity, STATUSES['DELETE_ACCOUNT_REASON'])
                 return None
 
             # unsupported message from user
@@ -655,7 +825,7 @@ def bot_handler(event, _):
                 return None
 
             logger.debug('user {} wants to delete her account because {}'.format(
-                hash_str(tmsg.user_uid),
+                tmsg.identity.log_id,
                 tmsg.body
             ))
             try:
@@ -669,13 +839,28 @@ def bot_handler(event, _):
                     globalvars.HOME_KEYBOARD)
                 return None
             if deleted:
+                remember_profile(tmsg.identity, profile_flags(None))
+                chatindex.update(tmsg.identity, opted_in=False)
                 telegram.send_keyboard(
                     token, tmsg.chat_id,
                     globalvars.lang.text("MSG_DELETED_ACCOUNT"),
                     globalvars.BACK_TO_HOME_KEYBOARD)
                 save_chat_status(
-                    tmsg.chat_id, STATUSES['DELETE_ACCOUNT_CONFIRM'])
+                    tmsg.identity, STATUSES['DELETE_ACCOUNT_CONFIRM'])
             return None
 
         else:  # unsupported message from user
             unsupported_message(tmsg, token)
+
+    elif tmsg.type == 'CALLBACK':
+        telegram.send_answer_callbackquery(token, tmsg.id, '', False)
+        if not tmsg.body.startswith(CALLBACK_PREFIX):
+            return None
+        chat_status = chat_state.status
+        if chat_status != STATUSES['FIRST_CAPTCHA']:
+            return None
+        if check_signed_captcha(tmsg.identity, tmsg.body):
+            captcha_passed(tmsg, token)
+        else:
+            captcha_failed(tmsg, token)
+        return None
@@ -0,0 +1,213 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Poller Module
+Runs the bot as a long-lived worker that long polls Telegram with
+getUpdates, for self-hosting on a single machine instead of Lambda.
+
+Updates are handed to outlinebot.bot_handler on a pool of POLL_WORKERS
+threads, the updates of a chat one at a time and in order. Polling waits
+while POLL_MAX_PENDING updates are queued.
+
+The offset of the first update not yet handled is kept in a state store
+record per bot, so a restarted worker continues where the last one
+stopped. Telegram forgets updates once a later poll confirms them, so the
+updates queued when a worker dies are lost, while the ones handled twice
+after a restart are dropped by dedup.py.
+
+SIGINT and SIGTERM stop polling once the poll in progress returns, let
+the queued updates finish and save the offset.
+
+    python poller.py --token TOKEN [--lang fa] [--delete-webhook]
+"""
+
+import argparse
+import logging
+import signal
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import batch
+import outlinebot
+import telegram
+from errors import DBError, TelegramError
+from statestore import get_store
+from settings import CONFIG
+
+logger = logging.getLogger()
+
+OFFSET_KIND = 'poller-offset'
+
+# seconds to wait before polling again after a failed poll
+RETRY_DELAY = 5
+
+class ChatExecutor(object):
+    """
+    Thread pool running the tasks of a chat one at a time and in order,
+    and the tasks of different chats concurrently
+    """
+
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(workers)
+        self.lock = threading.Condition()
+        self.queues = {}
+        self.pending = 0
+
+    def submit(self, chat, func, *args):
+        """ Queues func(*args) after the tasks of chat """
+        with self.lock:
+            self.pending += 1
+            if chat in self.queues:
+                self.queues[chat].append((func, args))
+                return
+            self.queues[chat] = deque()
+        self.pool.submit(self.drain, chat, func, args)
+
+    def drain(self, chat, func, args):
+        """ Runs the tasks of a chat until its queue is empty """
+        while True:
+            try:
+                func(*args)
+            except Exception as exc:
+                logger.exception('[poller] Task of chat failed: {}'.format(exc))
+            with self.lock:
+                self.pending -= 1
+                self.lock.notify_all()
+                if not self.queues[chat]:
+                    del self.queues[chat]
+                    return
+                func, args = self.queues[chat].popleft()
+
+    def wait(self, limit=0):
+        """ Waits until at most limit tasks are pending """
+        with self.lock:
+            while self.pending > limit:
+                self.lock.wait()
+
+    def shutdown(self):
+        """ Waits for every task and stops the threads """
+        self.wait()
+        self.pool.shutdown()
+
+
+class Poller(object):
+    """
+    getUpdates loop of one bot
+    """
+
+    def __init__(self, token, default_language):
+        self.token = token
+        self.default_language = default_language
+        # the bot id part of the token names the offset record
+        self.bot_id = token.split(':')[0]
+        self.executor = ChatExecutor(CONFIG.get('POLL_WORKERS', 8))
+        self.session = requests.Session()
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        self.offset = None
+        self.saved = None
+
+    def load_offset(self):
+        """ Reads the saved offset, None to start from Telegram's """
+        try:
+            record = get_store().get_record(OFFSET_KIND, self.bot_id, consistent=True)
+        except DBError as error:
+            logger.warning('[poller] Unable to read the offset: {}'.format(str(error)))
+            return None
+        return None if record is None else record['offset']
+
+    def save_offset(self):
+        """ Saves the offset of the first update not handled yet """
+        with self.lock:
+            offset = min(self.in_flight) if self.in_flight else self.offset
+        if offset is None or offset == self.saved:
+            return
+        try:
+            get_store().put_record(OFFSET_KIND, self.bot_id, {'offset': offset})
+            self.saved = offset
+        except DBError as error:
+            logger.warning('[poller] Unable to save the offset: {}'.format(str(error)))
+
+    def handle(self, update):
+        """ Hands one update to the bot, called on the pool """
+        event = {'token': self.token, 'lang': self.default_language, 'Input': update}
+        try:
+            outlinebot.bot_handler(event, None)
+        finally:
+            with self.lock:
+                self.in_flight.discard(update['update_id'])
+
+    def poll(self):
+        """ Fetches one batch of updates and queues them """
+        updates = telegram.get_updates(
+            self.token, self.offset, CONFIG.get('POLL_TIMEOUT', 30), self.session)
+        for update in updates:
+            with self.lock:
+                self.in_flight.add(update['update_id'])
+            self.offset = update['update_id'] + 1
+            chat = batch.chat_of(update)
+            self.executor.submit(
+                update['update_id'] if chat is None else chat, self.handle, update)
+
+    def run(self):
+        """ Polls until stop is called, then drains the queued updates """
+        self.offset = self.saved = self.load_offset()
+        logger.info('[poller] Polling from offset {}'.format(self.offset))
+        max_pending = CONFIG.get('POLL_MAX_PENDING', 100)
+        try:
+            while not self.stopping.is_set():
+                self.executor.wait(max_pending)
+                try:
+                    self.poll()
+                except (TelegramError, requests.RequestException, ValueError) as error:
+                    # ValueError: a reply that is not the JSON of updates
+                    logger.error('[poller] Unable to get updates: {}'.format(str(error)))
+                    self.stopping.wait(RETRY_DELAY)
+                self.save_offset()
+        finally:
+            # the queued updates are finished and the offset saved whatever
+            # stopped the loop
+            logger.info('[poller] Stopping, waiting for {} updates'.format(
+                self.executor.pending))
+            self.executor.shutdown()
+            self.save_offset()
+
+    def stop(self, *args):
+        """ Stops polling, usable as a signal handler """
+        self.stopping.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the bot with getUpdates')
+    parser.add_argument('--token', required=True, help='Telegram Bot Token')
+    parser.add_argument('--lang', default='fa', help='language of new chats')
+    parser.add_argument('--delete-webhook', action='store_true',
+                        help='remove the webhook first, getUpdates does not run with one')
+    args = parser.parse_args()
+
+    if args.delete_webhook:
+        telegram.delete_webhook(args.token)
+    poller = Poller(args.token, args.lang)
+    signal.signal(signal.SIGINT, poller.stop)
+    signal.signal(signal.SIGTERM, poller.stop)
+    poller.run()
+
+
+if __name__ == '__main__':
+    main()
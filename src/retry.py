@@ -0,0 +1,195 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Retry Module
+Retries AWS calls that were throttled or failed transiently, with
+decorrelated jitter inside a deadline, and optionally bounds the number of
+calls in flight with an AIMD limit that halves on throttling and grows
+back by one per round of successful calls.
+"""
+
+import logging
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError
+
+logger = logging.getLogger()
+
+THROTTLING_CODES = frozenset([
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'ThrottlingException',
+    'Throttling',
+    'TooManyRequestsException'
+])
+TRANSIENT_CODES = frozenset([
+    'InternalServerError',
+    'InternalFailure',
+    'ServiceUnavailable'
+])
+
+
+def error_code(error):
+    """
+    Returns the AWS error code of a ClientError
+    """
+    return error.response.get('Error', {}).get('Code', '')
+
+
+def is_throttle(error):
+    """
+    Tells whether an exception is AWS throttling
+
+    :param error: exception raised by a boto3 call
+    """
+    return isinstance(error, ClientError) and error_code(error) in THROTTLING_CODES
+
+
+def is_retryable(error):
+    """
+    Tells whether a failed call can be retried: throttling, transient
+    server errors, or a request that never reached the endpoint
+
+    :param error: exception raised by a boto3 call
+    """
+    if isinstance(error, BotoConnectionError):
+        return True
+    if isinstance(error, ClientError):
+        code = error_code(error)
+        return code in THROTTLING_CODES or code in TRANSIENT_CODES
+    return False
+
+
+class AIMDLimiter(object):
+    """
+    Concurrency limit that grows by one after `limit` successful calls and
+    is multiplied by `decrease` on a throttled call
+    """
+
+    def __init__(self, maximum, minimum=1, decrease=0.5):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease = decrease
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, deadline):
+        """
+        Waits for a free slot
+
+        :param deadline: time.monotonic() value to give up at
+        :return: True if a slot was taken, False on timeout
+        """
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def release(self, throttled):
+        """
+        Frees a slot and adapts the limit
+
+        :param throttled: the call was throttled
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self.condition.notify()
+
+
+class Retrier(object):
+    """
+    Runs calls with retries and keeps throttling counters
+    """
+
+    def __init__(self, name, error, deadline=3.0, base=0.025, cap=1.0, limiter=None):
+        """
+        :param name: name used in logs and counters
+        :param error: exception class raised when a call cannot be completed
+        :param deadline: seconds a call may take including retries
+        :param base: shortest sleep between attempts
+        :param cap: longest sleep between attempts
+        :param limiter: optional AIMDLimiter
+        """
+        self.name = name
+        self.error = error
+        self.deadline = deadline
+        self.base = base
+        self.cap = cap
+        self.limiter = limiter
+        self.lock = threading.Lock()
+        self.counters = {'calls': 0, 'throttled': 0, 'retries': 0, 'exhausted': 0}
+
+    def count(self, name):
+        """ Increments a counter """
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        """
+        :return: copy of the counters, with the current limit if any
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        if self.limiter is not None:
+            stats['limit'] = int(self.limiter.limit)
+        return stats
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls func, retrying retryable failures until the deadline
+
+        :return: the result of func
+        :raise: self.error: retries ran out or no concurrency slot was free
+        :raise: ClientError: non retryable AWS errors are raised as they are
+        """
+        deadline = time.monotonic() + self.deadline
+        sleep = self.base
+        self.count('calls')
+        while True:
+            if self.limiter is not None and not self.limiter.acquire(deadline):
+                self.count('exhausted')
+                raise self.error('{}: no free slot within {}s'.format(self.name, self.deadline))
+            throttled = False
+            try:
+                return func(*args, **kwargs)
+            except (ClientError, BotoConnectionError) as error:
+                if not is_retryable(error):
+                    raise
+                throttled = is_throttle(error)
+                if throttled:
+                    self.count('throttled')
+                # Decorrelated jitter, see the AWS architecture blog on backoff
+                sleep = min(self.cap, random.uniform(self.base, sleep * 3))
+                if time.monotonic() + sleep > deadline:
+                    self.count('exhausted')
+                    logger.warning('[{}] Giving up after {}s: {}'.format(
+                        self.name, self.deadline, str(error)))
+                    raise self.error('{}: {}'.format(self.name, str(error)))
+            finally:
+                if self.limiter is not None:
+                    self.limiter.release(throttled)
+            self.count('retries')
+            time.sleep(sleep)
@@ -24,8 +24,94 @@ CONFIG = {
 
     'REGION': $REGION_LIST,
 
+    # dynamodb, memory or sqlite, see statestore.py
+    'STATE_BACKEND': 'dynamodb',
+    'STATE_SQLITE_PATH': 'beepass.sqlite3',
+    'STATE_TTL': 86400,
     'DYNAMO_TABLE': '$AWS_DYNAMO_TABLE',
     'INFO_DYNAMO_TABLE': '$AWS_INFO_DYNAMO_TABLE',
+    # seconds the TOS/PP links are cached and between version stamp checks
+    'INFO_CACHE_TTL': 3600,
+    'INFO_VERSION_CHECK': 60,
+    # legacy, dual or compact, see dynamodb.py
+    'CHAT_KEY_SCHEME': 'legacy',
+    'CHAT_KEY_SECRET': '$CHAT_KEY_SECRET',
+    'LEGACY_DYNAMO_TABLE': '$AWS_LEGACY_DYNAMO_TABLE',
+    # seconds until a chat expires after its last status write, see
+    # dynamodb.py and expiry_report.py
+    'CHAT_TTL_PRE_OPT_IN': 30 * 86400,
+    'CHAT_TTL_POST_OPT_IN': 365 * 86400,
+    'CAPTCHA_STORE_TTL': 86400,
+    # seconds the flags of a user's account (registered, banned, has a key)
+    # and the ss_link of their key are cached on their chat instead of
+    # asked from the API. Changes made on the API server directly show up
+    # after at most this long.
+    'PROFILE_TTL': 3600,
+    # seconds a handled update_id is remembered so Telegram's redeliveries
+    # are dropped (0 disables), and the ids remembered by each process.
+    # Claims are records in RECORDS_DYNAMO_TABLE: create the table before
+    # setting this, 86400 covers Telegram's redeliveries.
+    'DEDUP_TTL': 0,
+    'DEDUP_CACHE_SIZE': 10000,
+    # threads handling the chats of a batch (see batch.py), and seconds
+    # before the Lambda timeout after which no update of it is started
+    'BATCH_WORKERS': 8,
+    'BATCH_STOP_MARGIN': 10,
+    # getUpdates worker (see poller.py): handler threads, seconds a poll
+    # waits for updates, and updates queued before polling pauses
+    'POLL_WORKERS': 8,
+    'POLL_TIMEOUT': 30,
+    'POLL_MAX_PENDING': 100,
+    # self-hosted webhook server (see webhook.py): value of Telegram's secret
+    # token header, 1-256 of A-Z, a-z, 0-9, _ and - (empty: not checked),
+    # handler threads, and updates queued before new ones are refused for
+    # Telegram to retry
+    'WEBHOOK_SECRET': '',
+    'WEBHOOK_WORKERS': 16,
+    'WEBHOOK_MAX_PENDING': 1000,
+    # write log lines on a background thread (see log.py), and the share of
+    # verbose payloads, such as updates and query results, logged at DEBUG
+    'LOG_QUEUE': True,
+    'LOG_PAYLOAD_SAMPLE': 0.1,
+    # time DynamoDB, API, Telegram and S3 calls (see tracing.py), write an
+    # EMF summary line per update, the CloudWatch namespace of the metrics,
+    # the span times kept per dependency for the process percentiles, and
+    # seconds between two lines of them (0: never)
+    'TRACE': True,
+    'TRACE_SUMMARY': True,
+    'TRACE_NAMESPACE': 'BeePassBot',
+    'TRACE_WINDOW': 1000,
+    'TRACE_STATS_INTERVAL': 60,
+    'CHAT_EXPIRY_INDEX': 'horizon-expires-index',
+    # seconds a DynamoDB call may spend retrying throttling, and the
+    # adaptive cap of calls in flight for long-running processes (0: off)
+    'DB_RETRY_DEADLINE': 3.0,
+    'DB_MAX_CONCURRENCY': 0,
+    # job records such as broadcast checkpoints, see statestore.py
+    'RECORDS_DYNAMO_TABLE': '$AWS_RECORDS_DYNAMO_TABLE',
+    # messages per second of all the jobs of the bot together (see
+    # jobs.send_bucket), workers, recipients per checkpoint, seconds a run
+    # may take and seconds between progress reports, see broadcast.py
+    'BROADCAST_RATE': 30,
+    'BROADCAST_WORKERS': 8,
+    'BROADCAST_PAGE_SIZE': 100,
+    'BROADCAST_BUDGET': 600,
+    'BROADCAST_REPORT_INTERVAL': 30,
+    # API calls per second and the user issue id new keys are requested
+    # with (0: none) when moving users off blocked servers, see
+    # keymigration.py. Its runs use the BROADCAST_* limits above.
+    'KEY_MIGRATION_API_RATE': 10,
+    'KEY_MIGRATION_ISSUE': 0,
+    # stored or signed, see captcha.py, and seconds a signed captcha can be
+    # answered, which bounds how long a solved one can be replayed
+    'CAPTCHA_MODE': 'stored',
+    'CAPTCHA_SECRET': '$CAPTCHA_SECRET',
+    'CAPTCHA_TTL': 120,
+    # sync or async, and the attempts and base retry delay of queued key
+    # requests, see keyqueue.py
+    'KEY_ISSUE_MODE': 'sync',
+    'KEY_ISSUE_ATTEMPTS': 3,
+    'KEY_ISSUE_RETRY_DELAY': 10,
     'API_KEY': '$API_KEY',
     'API_URL': '$API_URL',
     'API_TIMEOUT': 120,
@@ -64,7 +150,9 @@ STATUSES = {
     'ADMIN_SECTION_TERMS_OF_SERVICE': 1002,
     'ADMIN_SECTION_PRIVACY_POLICY': 1004,
     'ADMIN_SECTION_UNBAN_USER': 1005,
-    'ADMIN_SET_LANGUAGE': 1006
+    'ADMIN_SET_LANGUAGE': 1006,
+    'ADMIN_SECTION_BROADCAST': 1007,
+    'ADMIN_SECTION_BROADCAST_CONFIRM': 1008
 }
 
 API_ENDPOINTS = {
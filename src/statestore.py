@@ -0,0 +1,993 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+State Store Module
+Chat state and info link storage behind one interface, so the bot can keep
+its state in DynamoDB on Lambda or locally in a long-lived process.
+
+The backend is picked with CONFIG['STATE_BACKEND']:
+    dynamodb: the DynamoDB tables, see dynamodb.py
+    memory:   a process dictionary, chats are dropped STATE_TTL seconds
+              after their last write
+    sqlite:   a SQLite database in WAL mode at STATE_SQLITE_PATH, for
+              single-node deployments
+
+Every backend keeps the table name arguments and the return conventions of
+the dynamodb module functions, so call sites do not change with the backend.
+They expire chats and captchas alike: a chat CHAT_TTL_PRE_OPT_IN or
+CHAT_TTL_POST_OPT_IN seconds after its last status write, see
+dynamodb.chat_horizon, and a captcha CAPTCHA_STORE_TTL seconds after it was
+saved or as soon as the chat moves on from FIRST_CAPTCHA.
+
+Besides chats, the stores keep records: small keyed documents grouped by
+kind, such as the state of a broadcast job. Record methods raise DBError
+when the storage cannot be reached, since their callers have to stop
+rather than carry on from a wrong checkpoint.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+import dynamodb
+from errors import DBError
+from identity import Identity, hashed_chat_id
+from settings import CONFIG, STATUSES
+
+logger = logging.getLogger()
+
+DYNAMODB_BACKEND = 'dynamodb'
+MEMORY_BACKEND = 'memory'
+SQLITE_BACKEND = 'sqlite'
+
+DEFAULT_LANGUAGE = 'en'
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class ChatState(object):
+    """
+    Status, language, captcha and version of a chat as it was read. The
+    version grows with every status write, so a transition made from a
+    stale read can be detected. profile holds the flags of the user's
+    account cached on the chat, None if there are none or they expired.
+    """
+
+    __slots__ = ('status', 'language', 'captcha', 'version', 'profile')
+
+    def __init__(self, status=-1, language=None, captcha=None, version=0,
+                 profile=None):
+        self.status = status
+        self.language = language
+        self.captcha = captcha
+        self.version = version
+        self.profile = profile
+
+    @classmethod
+    def from_item(cls, item):
+        """
+        Builds the state from a stored chat item
+
+        :param item: dictionary with any of the chat attributes
+        :return: ChatState
+        """
+        return cls(
+            int(item['status']) if 'status' in item else -1,
+            item.get('language'),
+            live_captcha(item.get('captcha'), item.get('captcha_expires')),
+            int(item.get('version', 0)),
+            live_profile(item.get('profile'), item.get('profile_expires')))
+
+    def refresh(self, other):
+        """ Copies another state into this one """
+        for name in self.__slots__:
+            setattr(self, name, getattr(other, name))
+
+    def __repr__(self):
+        return 'ChatState(status={}, version={})'.format(self.status, self.version)
+
+
+def live_profile(profile, expires):
+    """
+    Returns cached profile flags unless they expired
+
+    :param profile: cached dictionary of flags or None
+    :param expires: epoch time the flags expire at
+    """
+    if profile is None or expires is None or float(expires) <= time.time():
+        return None
+    return profile
+
+
+def profile_expiry():
+    """ Returns the epoch time profile flags cached now expire at """
+    return int(time.time()) + CONFIG.get('PROFILE_TTL', 3600)
+
+
+def live_captcha(captcha, expires):
+    """
+    Returns stored captcha choices unless they expired
+
+    :param captcha: stored choices or None
+    :param expires: epoch time the captcha expires at, None if it has none
+    """
+    if captcha is None or (expires is not None and float(expires) < time.time()):
+        return None
+    return captcha
+
+
+def captcha_expiry():
+    """ Returns the epoch time a captcha stored now expires at """
+    return int(time.time()) + CONFIG.get('CAPTCHA_STORE_TTL', 86400)
+
+
+def chat_expiry(status):
+    """
+    Returns the epoch time a chat expires at after a write of status
+
+    :param status: new chat status
+    """
+    return int(time.time()) + dynamodb.horizon_ttl(dynamodb.chat_horizon(status))
+
+
+def keeps_captcha(status):
+    """
+    Tells whether a chat moving to status keeps its stored captcha, which
+    is only needed while an answer is awaited
+
+    :param status: new chat status
+    """
+    return int(status) == STATUSES['FIRST_CAPTCHA']
+
+
+def remember_state(chat_id, state):
+    """
+    Keeps the state of a chat on its Identity for the rest of the update
+
+    :param chat_id: Telegram Chat ID or its Identity
+    :param state: ChatState or None
+    """
+    if isinstance(chat_id, Identity):
+        chat_id.state = state
+
+
+class StateStore(object):
+    """
+    Interface of the chat state and info link storage
+    """
+
+    def get_chat(self, table, chat_id, consistent=False):
+        """
+        Reads the state of a chat
+
+        :param consistent: use a strongly consistent read where the
+            backend has weaker ones
+        :return: ChatState or None if the chat is unknown or cannot be read
+        """
+        raise NotImplementedError
+
+    def create_chat_status(self, table, chat_id, status):
+        """
+        Sets the status of a chat, creating it with the default language
+        if it does not exist. The new state is kept on the Identity.
+
+        :return: True in case of success and False otherwise
+        """
+        raise NotImplementedError
+
+    def save_chat_status(self, table, chat_id, status, expected=None):
+        """
+        Sets the status of a chat. Given the ChatState the chat was read
+        in, the write only happens if the chat is still in that status and
+        version, and expected follows the chat to the new status.
+
+        :return: True in case of success and False otherwise
+        """
+        raise NotImplementedError
+
+    def resolve_conflict(self, table, chat_id, status, expected):
+        """
+        Handles a transition whose expected state did not hold. The chat
+        is re-read consistently and expected is refreshed with it, so the
+        rest of the update sees the chat as it is.
+
+        :return: True if the chat already is in the wanted status
+        """
+        current = self.get_chat(table, chat_id, consistent=True)
+        logger.warning(
+            '[save_chat_status] {} changed from {} to {} concurrently'.format(
+                hashed_chat_id(chat_id), expected, current))
+        if current is None:
+            return False
+        expected.refresh(current)
+        return current.status == int(status)
+
+    def get_chat_status(self, table, chat_id):
+        """ :return: chat status or -1 in case of error or unknown chat """
+        raise NotImplementedError
+
+    def save_user_lang(self, table, chat_id, language):
+        """ :return: True in case of success and False otherwise """
+        raise NotImplementedError
+
+    def get_user_lang(self, table, chat_id):
+        """ :return: Language or None in case of error """
+        raise NotImplementedError
+
+    def save_captcha(self, table, chat_id, choices):
+        """ :return: True in case of success and False otherwise """
+        raise NotImplementedError
+
+    def get_captcha(self, table, chat_id, consistent=False):
+        """ :return: Captcha choices or None in case of error """
+        raise NotImplementedError
+
+    def save_profile(self, table, chat_id, profile):
+        """
+        Caches the flags of the user's account on an existing chat, for
+        PROFILE_TTL seconds
+
+        :param profile: JSON serializable dictionary of flags, or None to
+            drop the cached ones
+        :return: True in case of success and False otherwise
+        """
+        raise NotImplementedError
+
+    def save_info_link(self, table, link, language, linktype):
+        """
+        Saves a link and bumps the version stamp of the info links
+
+        :return: True in case of success and False otherwise
+        """
+        raise NotImplementedError
+
+    def get_info_link(self, table, language, linktype):
+        """ :return: Link or None in case of error """
+        raise NotImplementedError
+
+    def get_info_links(self, table, languages, linktypes):
+        """
+        :return: tuple of a dictionary of (language, linktype) to link and
+            the version stamp, or None in case of error
+        """
+        raise NotImplementedError
+
+    def get_info_version(self, table):
+        """ :return: version stamp or None in case of error """
+        raise NotImplementedError
+
+    def get_record(self, kind, key, consistent=False):
+        """
+        :return: dictionary of the record values, or None if the record is
+            missing or expired
+        :raise: DBError: the storage could not be read
+        """
+        raise NotImplementedError
+
+    def put_record(self, kind, key, values, ttl=None, only_new=False):
+        """
+        Writes a record
+
+        :param values: JSON serializable dictionary
+        :param ttl: seconds the record lives for, forever if None
+        :param only_new: do not replace a live record
+        :return: True if written, False if only_new and the record exists
+        :raise: DBError: the storage could not be written
+        """
+        raise NotImplementedError
+
+    def update_record(self, kind, key, values=None, increments=None, ttl=None):
+        """
+        Sets and increments values of a record in one write, creating the
+        record if needed
+
+        :param values: dictionary of values to set
+        :param increments: dictionary of numbers to add to values
+        :param ttl: seconds the record lives for from this write, its
+            expiry is left as it is if None
+        :return: dictionary of the record values after the update
+        :raise: DBError: the storage could not be written
+        """
+        raise NotImplementedError
+
+    def delete_record(self, kind, key):
+        """ :raise: DBError: the storage could not be written """
+        raise NotImplementedError
+
+    def query_records(self, kind, start=None, limit=100):
+        """
+        Reads the records of a kind in key order, a page at a time
+
+        :param start: key to continue after, as returned by the last page
+        :return: list of (key, values) and the key to continue after, or
+            None on the last page
+        :raise: DBError: the storage could not be read
+        """
+        raise NotImplementedError
+
+
+class DynamoDBStore(StateStore):
+    """
+    State in DynamoDB, see dynamodb.py
+    """
+
+    def get_chat(self, table, chat_id, consistent=False):
+        try:
+            item = dynamodb.get_chat_item(table, chat_id, consistent)
+        except ClientError as error:
+            logger.error(
+                '[get_chat] Unable to read from {}: {}'.format(table, str(error)))
+            return None
+        return None if item is None else ChatState.from_item(item)
+
+    def create_chat_status(self, table, chat_id, status):
+        item = dynamodb.create_chat_status(table, chat_id, status)
+        if item is None:
+            return False
+        remember_state(chat_id, ChatState.from_item(item))
+        return True
+
+    def save_chat_status(self, table, chat_id, status, expected=None):
+        if expected is None:
+            return dynamodb.save_chat_status(table, chat_id, status)
+        try:
+            dynamodb.transition_chat_status(
+                table, chat_id, status, expected.status, expected.version)
+        except ClientError as error:
+            if dynamodb.is_condition_failure(error):
+                return self.resolve_conflict(table, chat_id, status, expected)
+            logger.error(
+                '[save_chat_status] Unable to write to {}: {}'.format(table, str(error)))
+            return False
+        expected.status = int(status)
+        expected.version += 1
+        return True
+
+    def get_chat_status(self, table, chat_id):
+        return dynamodb.get_chat_status(table, chat_id)
+
+    def save_user_lang(self, table, chat_id, language):
+        return dynamodb.save_user_lang(table, chat_id, language)
+
+    def get_user_lang(self, table, chat_id):
+        return dynamodb.get_user_lang(table, chat_id)
+
+    def save_captcha(self, table, chat_id, choices):
+        return dynamodb.save_captcha(table, chat_id, choices)
+
+    def get_captcha(self, table, chat_id, consistent=False):
+        return dynamodb.get_captcha(table, chat_id, consistent)
+
+    def save_profile(self, table, chat_id, profile):
+        return dynamodb.save_profile(
+            table, chat_id, profile, None if profile is None else profile_expiry())
+
+    def save_info_link(self, table, link, language, linktype):
+        return dynamodb.save_info_link(table, link, language, linktype)
+
+    def get_info_link(self, table, language, linktype):
+        return dynamodb.get_info_link(table, language, linktype)
+
+    def get_info_links(self, table, languages, linktypes):
+        return dynamodb.get_info_links(table, languages, linktypes)
+
+    def get_info_version(self, table):
+        return dynamodb.get_info_version(table)
+
+    def _records(self, name, func, *args, **kwargs):
+        """ Runs a dynamodb record function, raising DBError on failure """
+        try:
+            return func(*args, **kwargs)
+        except ClientError as error:
+            logger.error('[{}] Unable to access {}: {}'.format(
+                name, CONFIG['RECORDS_DYNAMO_TABLE'], str(error)))
+            raise DBError(str(error))
+
+    def get_record(self, kind, key, consistent=False):
+        return self._records('get_record', dynamodb.get_record, kind, key, consistent)
+
+    def put_record(self, kind, key, values, ttl=None, only_new=False):
+        return self._records(
+            'put_record', dynamodb.put_record, kind, key, values,
+            None if ttl is None else time.time() + ttl, only_new)
+
+    def update_record(self, kind, key, values=None, increments=None, ttl=None):
+        return self._records(
+            'update_record', dynamodb.update_record, kind, key, values, increments,
+            None if ttl is None else time.time() + ttl)
+
+    def delete_record(self, kind, key):
+        self._records('delete_record', dynamodb.delete_record, kind, key)
+
+    def query_records(self, kind, start=None, limit=100):
+        return self._records('query_records', dynamodb.query_records, kind, start, limit)
+
+
+class MemoryStore(StateStore):
+    """
+    State in a process dictionary guarded by a lock. Chats are dropped
+    ttl seconds after their last write, or when they expire, and swept
+    every sweep_interval seconds.
+    """
+
+    def __init__(self, ttl=None, sweep_interval=60):
+        self.ttl = ttl if ttl is not None else CONFIG.get('STATE_TTL', 86400)
+        self.sweep_interval = sweep_interval
+        self.lock = threading.Lock()
+        self.chats = {}
+        self.links = {}
+        self.versions = {}
+        self.records = {}
+        self.swept = time.monotonic()
+
+    @staticmethod
+    def _live(item, now):
+        """ Tells whether a chat item is neither idle nor expired """
+        return item['idle_until'] > now and item.get('expires', now) >= time.time()
+
+    def _chat(self, table, chat_id, now):
+        """ Returns the live chat item or None, the lock must be held """
+        key = (table, hashed_chat_id(chat_id))
+        item = self.chats.get(key)
+        if item is not None and not self._live(item, now):
+            del self.chats[key]
+            return None
+        return item
+
+    def _update(self, table, chat_id, defaults=None, expected=None, **values):
+        """
+        Creates or updates a chat item and refreshes its expiry. Setting
+        the status bumps the version.
+
+        :param defaults: attributes set only when the item is created
+        :param expected: ChatState the item has to be in
+        :param values: attributes to set
+        :return: copy of the item, or None if it is not in expected
+        """
+        now = time.monotonic()
+        with self.lock:
+            if now - self.swept > self.sweep_interval:
+                self.chats = {
+                    key: item for key, item in self.chats.items()
+                    if self._live(item, now)}
+                self.swept = now
+            item = self._chat(table, chat_id, now)
+            if expected is not None and (
+                    item is None or
+                    item.get('status', -1) != expected.status or
+                    item.get('version', 0) != expected.version):
+                return None
+            if item is None:
+                item = self.chats.setdefault(
+                    (table, hashed_chat_id(chat_id)), dict(defaults or {}))
+            for name, value in values.items():
+                if value is not None:
+                    item[name] = value
+            if 'status' in values:
+                item['version'] = item.get('version', 0) + 1
+                item['expires'] = chat_expiry(values['status'])
+                if not keeps_captcha(values['status']):
+                    item.pop('captcha', None)
+                    item.pop('captcha_expires', None)
+            item['idle_until'] = now + self.ttl
+            return dict(item)
+
+    def _get(self, table, chat_id, name):
+        """ Returns an attribute of a chat item or None """
+        with self.lock:
+            item = self._chat(table, chat_id, time.monotonic())
+            return None if item is None else item.get(name)
+
+    def get_chat(self, table, chat_id, consistent=False):
+        with self.lock:
+            item = self._chat(table, chat_id, time.monotonic())
+            return None if item is None else ChatState.from_item(item)
+
+    def create_chat_status(self, table, chat_id, status):
+        item = self._update(
+            table, chat_id,
+            defaults={'language': DEFAULT_LANGUAGE},
+            status=int(status))
+        remember_state(chat_id, ChatState.from_item(item))
+        return True
+
+    def save_chat_status(self, table, chat_id, status, expected=None):
+        if self._update(table, chat_id, expected=expected, status=int(status)) is None:
+            return self.resolve_conflict(table, chat_id, status, expected)
+        if expected is not None:
+            expected.status = int(status)
+            expected.version += 1
+        return True
+
+    def get_chat_status(self, table, chat_id):
+        status = self._get(table, chat_id, 'status')
+        if status is None:
+            logger.error(
+                '[get_chat_status] Empty response for {}'.format(hashed_chat_id(chat_id)))
+            return -1
+        return status
+
+    def save_user_lang(self, table, chat_id, language):
+        self._update(table, chat_id, language=str(language))
+        return True
+
+    def get_user_lang(self, table, chat_id):
+        return self._get(table, chat_id, 'language')
+
+    def save_captcha(self, table, chat_id, choices):
+        self._update(
+            table, chat_id, captcha=[int(choice) for choice in choices],
+            captcha_expires=captcha_expiry())
+        return True
+
+    def get_captcha(self, table, chat_id, consistent=False):
+        with self.lock:
+            item = self._chat(table, chat_id, time.monotonic())
+            if item is None:
+                return None
+            return live_captcha(item.get('captcha'), item.get('captcha_expires'))
+
+    def save_profile(self, table, chat_id, profile):
+        with self.lock:
+            item = self._chat(table, chat_id, time.monotonic())
+            if item is None:
+                return True
+            if profile is None:
+                item.pop('profile', None)
+                item.pop('profile_expires', None)
+            else:
+                item['profile'] = dict(profile)
+                item['profile_expires'] = profile_expiry()
+        return True
+
+    def save_info_link(self, table, link, language, linktype):
+        with self.lock:
+            self.links[(table, language, linktype)] = link
+            self.versions[table] = self.versions.get(table, 0) + 1
+        return True
+
+    def get_info_link(self, table, language, linktype):
+        with self.lock:
+            return self.links.get((table, language, linktype))
+
+    def get_info_links(self, table, languages, linktypes):
+        with self.lock:
+            links = {
+                (language, linktype): self.links[(table, language, linktype)]
+                for language in languages for linktype in linktypes
+                if (table, language, linktype) in self.links}
+            return links, self.versions.get(table, 0)
+
+    def get_info_version(self, table):
+        with self.lock:
+            return self.versions.get(table, 0)
+
+    def _record(self, kind, key):
+        """ Returns the live record entry or None, the lock must be held """
+        entry = self.records.get((kind, str(key)))
+        if entry is not None and entry[1] is not None and entry[1] <= time.time():
+            del self.records[(kind, str(key))]
+            return None
+        return entry
+
+    def get_record(self, kind, key, consistent=False):
+        with self.lock:
+            entry = self._record(kind, key)
+            return None if entry is None else dict(entry[0])
+
+    def put_record(self, kind, key, values, ttl=None, only_new=False):
+        with self.lock:
+            if only_new and self._record(kind, key) is not None:
+                return False
+            self.records[(kind, str(key))] = (
+                dict(values), None if ttl is None else time.time() + ttl)
+            return True
+
+    def update_record(self, kind, key, values=None, increments=None, ttl=None):
+        with self.lock:
+            entry = self._record(kind, key)
+            if entry is None:
+                entry = ({}, None)
+            if ttl is not None:
+                entry = (entry[0], time.time() + ttl)
+            self.records[(kind, str(key))] = entry
+            record = entry[0]
+            record.update(values or {})
+            for name, amount in (increments or {}).items():
+                record[name] = record.get(name, 0) + amount
+            return dict(record)
+
+    def delete_record(self, kind, key):
+        with self.lock:
+            self.records.pop((kind, str(key)), None)
+
+    def query_records(self, kind, start=None, limit=100):
+        with self.lock:
+            keys = sorted(
+                key for record_kind, key in list(self.records)
+                if record_kind == kind and (start is None or key > start) and
+                self._record(kind, key) is not None)
+            records = [(key, dict(self.records[(kind, key)][0])) for key in keys[:limit]]
+        return records, (keys[limit - 1] if len(keys) > limit else None)
+
+
+class SQLiteStore(StateStore):
+    """
+    State in a SQLite database in WAL mode, so readers do not block the
+    writer. Every thread uses its own connection in autocommit mode.
+    Expired chats and records are ignored when read, and deleted every
+    sweep_interval seconds.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS chats ('
+        ' tbl TEXT NOT NULL, chat_id TEXT NOT NULL, status INTEGER,'
+        ' language TEXT, captcha TEXT, version INTEGER NOT NULL DEFAULT 0,'
+        ' profile TEXT, profile_expires REAL, captcha_expires REAL, expires REAL,'
+        ' PRIMARY KEY (tbl, chat_id)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS info_links ('
+        ' tbl TEXT NOT NULL, language TEXT NOT NULL, linktype TEXT NOT NULL,'
+        ' link TEXT,'
+        ' PRIMARY KEY (tbl, language, linktype)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS info_versions ('
+        ' tbl TEXT PRIMARY KEY, version INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS records ('
+        ' kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires REAL,'
+        ' PRIMARY KEY (kind, key)) WITHOUT ROWID',
+    )
+
+    def __init__(self, path=None, timeout=5.0, sweep_interval=3600):
+        self.path = path or CONFIG.get('STATE_SQLITE_PATH', 'beepass.sqlite3')
+        self.timeout = timeout
+        self.sweep_interval = sweep_interval
+        self.swept = time.monotonic()
+        self.local = threading.local()
+        connection = self.connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+        # chats tables created before profiles were cached or chats expired
+        columns = set(row[1] for row in connection.execute('PRAGMA table_info(chats)'))
+        for column, kind in (('profile', 'TEXT'), ('profile_expires', 'REAL'),
+                             ('captcha_expires', 'REAL'), ('expires', 'REAL')):
+            if column not in columns:
+                connection.execute('ALTER TABLE chats ADD COLUMN {} {}'.format(column, kind))
+
+    def connection(self):
+        """ Returns the connection of the current thread """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None,
+                check_same_thread=False)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def _write(self, name, sql, params):
+        """ Runs a write statement, True in case of success """
+        try:
+            self.connection().execute(sql, params)
+        except sqlite3.Error as error:
+            logger.error(
+                '[{}] Unable to write to {}: {}'.format(name, self.path, str(error)))
+            return False
+        return True
+
+    def _read(self, name, sql, params):
+        """ Returns the first row of a query, None if empty, False on error """
+        try:
+            return self.connection().execute(sql, params).fetchone()
+        except sqlite3.Error as error:
+            logger.error(
+                '[{}] Unable to read from {}: {}'.format(name, self.path, str(error)))
+            return False
+
+    def _sweep(self):
+        """ Deletes the expired chats and records, every sweep_interval """
+        now = time.monotonic()
+        if now - self.swept <= self.sweep_interval:
+            return
+        self.swept = now
+        self._write(
+            'sweep', 'DELETE FROM chats WHERE expires < ?', (time.time(),))
+        self._write(
+            'sweep', 'DELETE FROM records WHERE expires <= ?', (time.time(),))
+
+    def _set_chat(self, name, table, chat_id, column, value):
+        """ Upserts one column of a chat row """
+        return self._write(
+            name,
+            'INSERT INTO chats (tbl, chat_id, {0}) VALUES (?, ?, ?) '
+            'ON CONFLICT (tbl, chat_id) DO UPDATE SET {0} = excluded.{0}'.format(column),
+            (table, hashed_chat_id(chat_id), value))
+
+    def _get_chat(self, name, table, chat_id, column):
+        """ Returns one column of a chat row, None if missing, False on error """
+        row = self._read(
+            name,
+            'SELECT {} FROM chats WHERE tbl = ? AND chat_id = ? '
+            'AND (expires IS NULL OR expires >= ?)'.format(column),
+            (table, hashed_chat_id(chat_id), time.time()))
+        if not row:
+            return row
+        return row[0]
+
+    def get_chat(self, table, chat_id, consistent=False):
+        row = self._read(
+            'get_chat',
+            'SELECT status, language, captcha, captcha_expires, version, profile, '
+            'profile_expires FROM chats WHERE tbl = ? AND chat_id = ? '
+            'AND (expires IS NULL OR expires >= ?)',
+            (table, hashed_chat_id(chat_id), time.time()))
+        if not row:
+            return None
+        status, language, captcha, captcha_expires, version, profile, profile_expires = row
+        return ChatState(
+            -1 if status is None else status, language,
+            live_captcha(json.loads(captcha) if captcha else None, captcha_expires), version,
+            live_profile(json.loads(profile) if profile else None, profile_expires))
+
+    def create_chat_status(self, table, chat_id, status):
+        self._sweep()
+        keep = keeps_captcha(status)
+        created = self._write(
+            'create_chat_status',
+            'INSERT INTO chats (tbl, chat_id, status, language, version, expires) '
+            'VALUES (?, ?, ?, ?, 1, ?) '
+            'ON CONFLICT (tbl, chat_id) DO UPDATE SET status = excluded.status, '
+            'language = coalesce(language, excluded.language), '
+            'captcha = CASE WHEN ? THEN captcha END, '
+            'captcha_expires = CASE WHEN ? THEN captcha_expires END, '
+            'expires = excluded.expires, version = version + 1',
+            (table, hashed_chat_id(chat_id), int(status), DEFAULT_LANGUAGE,
+             chat_expiry(status), keep, keep))
+        if created:
+            remember_state(chat_id, self.get_chat(table, chat_id))
+        return created
+
+    def save_chat_status(self, table, chat_id, status, expected=None):
+        keep = keeps_captcha(status)
+        if expected is None:
+            return self._write(
+                'save_chat_status',
+                'INSERT INTO chats (tbl, chat_id, status, version, expires) '
+                'VALUES (?, ?, ?, 1, ?) '
+                'ON CONFLICT (tbl, chat_id) DO UPDATE SET status = excluded.status, '
+                'captcha = CASE WHEN ? THEN captcha END, '
+                'captcha_expires = CASE WHEN ? THEN captcha_expires END, '
+                'expires = excluded.expires, version = version + 1',
+                (table, hashed_chat_id(chat_id), int(status), chat_expiry(status),
+                 keep, keep))
+        try:
+            cursor = self.connection().execute(
+                'UPDATE chats SET status = ?, version = version + 1, '
+                'captcha = CASE WHEN ? THEN captcha END, '
+                'captcha_expires = CASE WHEN ? THEN captcha_expires END, expires = ? '
+                'WHERE tbl = ? AND chat_id = ? AND status = ? AND version = ?',
+                (int(status), keep, keep, chat_expiry(status), table,
+                 hashed_chat_id(chat_id), expected.status, expected.version))
+        except sqlite3.Error as error:
+            logger.error(
+                '[save_chat_status] Unable to write to {}: {}'.format(self.path, str(error)))
+            return False
+        if cursor.rowcount != 1:
+            return self.resolve_conflict(table, chat_id, status, expected)
+        expected.status = int(status)
+        expected.version += 1
+        return True
+
+    def get_chat_status(self, table, chat_id):
+        status = self._get_chat('get_chat_status', table, chat_id, 'status')
+        if status is None or status is False:
+            return -1
+        return status
+
+    def save_user_lang(self, table, chat_id, language):
+        return self._set_chat(
+            'save_user_lang', table, chat_id, 'language', str(language))
+
+    def get_user_lang(self, table, chat_id):
+        return self._get_chat('get_user_lang', table, chat_id, 'language') or None
+
+    def save_captcha(self, table, chat_id, choices):
+        return self._write(
+            'save_captcha',
+            'INSERT INTO chats (tbl, chat_id, captcha, captcha_expires) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (tbl, chat_id) DO UPDATE SET captcha = excluded.captcha, '
+            'captcha_expires = excluded.captcha_expires',
+            (table, hashed_chat_id(chat_id),
+             json.dumps([int(choice) for choice in choices]), captcha_expiry()))
+
+    def get_captcha(self, table, chat_id, consistent=False):
+        state = self.get_chat(table, chat_id, consistent)
+        return None if state is None else state.captcha
+
+    def save_profile(self, table, chat_id, profile):
+        return self._write(
+            'save_profile',
+            'UPDATE chats SET profile = ?, profile_expires = ? '
+            'WHERE tbl = ? AND chat_id = ?',
+            (None if profile is None else json.dumps(profile),
+             None if profile is None else profile_expiry(),
+             table, hashed_chat_id(chat_id)))
+
+    def save_info_link(self, table, link, language, linktype):
+        connection = self.connection()
+        try:
+            with connection:
+                connection.execute('BEGIN IMMEDIATE')
+                connection.execute(
+                    'INSERT INTO info_links (tbl, language, linktype, link) '
+                    'VALUES (?, ?, ?, ?) ON CONFLICT (tbl, language, linktype) '
+                    'DO UPDATE SET link = excluded.link',
+                    (table, language, linktype, link))
+                connection.execute(
+                    'INSERT INTO info_versions (tbl, version) VALUES (?, 1) '
+                    'ON CONFLICT (tbl) DO UPDATE SET version = version + 1',
+                    (table,))
+        except sqlite3.Error as error:
+            logger.error(
+                '[save_info_link] Unable to write to {}: {}'.format(self.path, str(error)))
+            return False
+        return True
+
+    def get_info_link(self, table, language, linktype):
+        row = self._read(
+            'get_info_link',
+            'SELECT link FROM info_links WHERE tbl = ? AND language = ? AND linktype = ?',
+            (table, language, linktype))
+        return row[0] if row else None
+
+    def get_info_links(self, table, languages, linktypes):
+        # Read the version first, a link saved in between is picked up by
+        # the next version check
+        version = self.get_info_version(table)
+        if version is None:
+            return None
+        try:
+            rows = self.connection().execute(
+                'SELECT language, linktype, link FROM info_links WHERE tbl = ?',
+                (table,)).fetchall()
+        except sqlite3.Error as error:
+            logger.error(
+                '[get_info_links] Unable to read from {}: {}'.format(self.path, str(error)))
+            return None
+        links = {
+            (language, linktype): link for language, linktype, link in rows
+            if language in languages and linktype in linktypes}
+        return links, version
+
+    def get_info_version(self, table):
+        row = self._read(
+            'get_info_version',
+            'SELECT version FROM info_versions WHERE tbl = ?',
+            (table,))
+        if row is False:
+            return None
+        return row[0] if row else 0
+
+    def _records(self, name, statements):
+        """
+        Runs record statements in one write transaction
+
+        :param statements: function taking the connection
+        :return: what statements returns
+        :raise: DBError: the database failed
+        """
+        connection = self.connection()
+        try:
+            with connection:
+                connection.execute('BEGIN IMMEDIATE')
+                return statements(connection)
+        except sqlite3.Error as error:
+            logger.error('[{}] Unable to access {}: {}'.format(name, self.path, str(error)))
+            raise DBError(str(error))
+
+    @staticmethod
+    def _load_record(connection, kind, key):
+        """ Returns the values of a live record or None """
+        row = connection.execute(
+            'SELECT value FROM records WHERE kind = ? AND key = ? '
+            'AND (expires IS NULL OR expires > ?)',
+            (kind, str(key), time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_record(self, kind, key, consistent=False):
+        try:
+            return self._load_record(self.connection(), kind, key)
+        except sqlite3.Error as error:
+            logger.error('[get_record] Unable to read from {}: {}'.format(self.path, str(error)))
+            raise DBError(str(error))
+
+    def put_record(self, kind, key, values, ttl=None, only_new=False):
+        def statements(connection):
+            if only_new and self._load_record(connection, kind, key) is not None:
+                return False
+            connection.execute(
+                'INSERT OR REPLACE INTO records (kind, key, value, expires) '
+                'VALUES (?, ?, ?, ?)',
+                (kind, str(key), json.dumps(values),
+                 None if ttl is None else time.time() + ttl))
+            return True
+        return self._records('put_record', statements)
+
+    def update_record(self, kind, key, values=None, increments=None, ttl=None):
+        def statements(connection):
+            record = self._load_record(connection, kind, key)
+            if record is None:
+                # an expired record is started over
+                connection.execute(
+                    'DELETE FROM records WHERE kind = ? AND key = ?', (kind, str(key)))
+                record = {}
+            record.update(values or {})
+            for name, amount in (increments or {}).items():
+                record[name] = record.get(name, 0) + amount
+            connection.execute(
+                'INSERT INTO records (kind, key, value, expires) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (kind, key) DO UPDATE SET value = excluded.value, '
+                'expires = coalesce(excluded.expires, expires)',
+                (kind, str(key), json.dumps(record),
+                 None if ttl is None else time.time() + ttl))
+            return record
+        return self._records('update_record', statements)
+
+    def delete_record(self, kind, key):
+        self._records('delete_record', lambda connection: connection.execute(
+            'DELETE FROM records WHERE kind = ? AND key = ?', (kind, str(key))))
+
+    def query_records(self, kind, start=None, limit=100):
+        try:
+            rows = self.connection().execute(
+                'SELECT key, value FROM records WHERE kind = ? AND key > ? '
+                'AND (expires IS NULL OR expires > ?) ORDER BY key LIMIT ?',
+                (kind, '' if start is None else str(start), time.time(),
+                 limit + 1)).fetchall()
+        except sqlite3.Error as error:
+            logger.error('[query_records] Unable to read from {}: {}'.format(
+                self.path, str(error)))
+            raise DBError(str(error))
+        records = [(key, json.loads(value)) for key, value in rows[:limit]]
+        return records, (records[-1][0] if len(rows) > limit else None)
+
+
+BACKENDS = {
+    DYNAMODB_BACKEND: DynamoDBStore,
+    MEMORY_BACKEND: MemoryStore,
+    SQLITE_BACKEND: SQLiteStore
+}
+
+
+def get_store():
+    """
+    Returns the state store of the process, created on first use from
+    CONFIG['STATE_BACKEND']
+
+    :return: StateStore
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                backend = CONFIG.get('STATE_BACKEND', DYNAMODB_BACKEND)
+                if backend not in BACKENDS:
+                    raise ValueError('Unknown STATE_BACKEND {}'.format(backend))
+                _store = BACKENDS[backend]()
+    return _store
@@ -25,6 +25,7 @@ from boto3.session import Session
 from botocore.client import Config
 from botocore.exceptions import ClientError
 from errors import AWSError, ValidationError
+from tracing import STORAGE, traced
 
 S3_AMAZON_LINK = "https://s3.amazonaws.com"
 
@@ -49,6 +50,7 @@ def build_static_link(bucket, key):
     """
     return "https://s3.amazonaws.com/" + bucket + "/" + key
 
+@traced(STORAGE)
 def get_binary_contents(bucket, key, config=None):
     """
     Get file contents from S3
@@ -65,6 +67,7 @@ def get_binary_contents(bucket, key, config=None):
         raise AWSError("Error loading file from S3: {}".format(str(error)))
     return response
 
+@traced(STORAGE)
 def put_file_with_creds(bucket, key, content, access_key, secret_key):
     """
     Get a file from S3 using Specific Credentials
@@ -97,6 +100,7 @@ def put_file_with_creds(bucket, key, content, access_key, secret_key):
                        .format(key, bucket, str(error)))
     return
 
+@traced(STORAGE)
 def get_file_with_creds(bucket, key, access_key, secret_key):
     """
     Get a file from S3 using Specific Credentials
@@ -123,6 +127,7 @@ def get_file_with_creds(bucket, key, access_key, secret_key):
         raise AWSError("Error loading file from S3: {}".format(str(error)))
     return response
 
+@traced(STORAGE)
 def get_json_contents(bucket, key):
     """
     Get json file from S3
@@ -139,6 +144,7 @@ def get_json_contents(bucket, key):
         raise AWSError("Error loading file from S3: {}".format(str(error)))
     return json.load(response["Body"])
 
+@traced(STORAGE)
 def get_object_metadata(bucket, key):
     """
     Get file metadata from S3
@@ -157,6 +163,7 @@ def get_object_metadata(bucket, key):
         raise AWSError("Error loading metadata from S3: {}".format(str(error)))
     return obj
 
+@traced(STORAGE)
 def put_object_metadata(bucket, key, meta_key, meta_value):
     """
     Get file metadata from S3
@@ -219,6 +226,7 @@ def get_temp_link(bucket, key, key_id, secret_key, expiry=300):
         raise AWSError("Error generating temp link: {}".format(str(error)))
     return link
 
+@traced(STORAGE)
 def put_doc_file(bucket, key, filename, url, caption=None, thumb=None):
     """
     Appends to a file in S3
@@ -260,6 +268,7 @@ def put_doc_file(bucket, key, filename, url, caption=None, thumb=None):
                        .format(key, bucket, str(error)))
     return
 
+@traced(STORAGE)
 def put_text_file(bucket, key, text):
     """
     Appends to a file in S3
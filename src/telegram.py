@@ -20,6 +20,7 @@ Holds functions for working with Telegram API
 import json
 import csv
 import io
+import threading
 from datetime import datetime
 import boto3
 from botocore.exceptions import ClientError
@@ -27,13 +28,27 @@ import requests
 from requests.exceptions import ConnectionError, HTTPError, Timeout, TooManyRedirects
 from errors import AWSError, TelegramError, ValidationError
 import storage
+from tracing import DYNAMODB, TELEGRAM, traced
 
 TELEGRAM_HOSTNAME = "https://api.telegram.org"
 TELEGRAM_SEC_PORT = 443
 TELEGRAM_METHOD = "POST"
 MAX_ITEMS_PER_ROW = 4
 
+_local = threading.local()
 
+
+def http_session():
+    """
+    Returns the requests session of the current thread, so warm processes
+    reuse their connections to Telegram
+    """
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+@traced(TELEGRAM)
 def get_file_path(token, file_id):
     """
     Send a text message and hides the keyboard for the user.
@@ -54,8 +69,8 @@ def get_file_path(token, file_id):
 
     url = make_getfile_url(token)
     try:
-        response = requests.post(url, headers=headers,
-                                 data=json.dumps(post_data))
+        response = http_session().post(url, headers=headers,
+                                       data=json.dumps(post_data))
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -71,6 +86,7 @@ def get_file_path(token, file_id):
     return response
 
 
+@traced(TELEGRAM)
 def hide_keyboard(token, chat_id, text):
     """
     Send a text message and hides the keyboard for the user.
@@ -94,8 +110,8 @@ def hide_keyboard(token, chat_id, text):
 
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/sendMessage"
     try:
-        response = requests.post(url, headers=headers,
-                                 data=json.dumps(post_data))
+        response = http_session().post(url, headers=headers,
+                                       data=json.dumps(post_data))
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -170,6 +186,7 @@ def make_keyboard(items, items_per_row=0, add_home=""):
     return keyboard
 
 
+@traced(TELEGRAM)
 def send_csv(token, chat_id, content, filename):
     """
     Send a CSV file to telegram user
@@ -193,6 +210,7 @@ def send_csv(token, chat_id, content, filename):
     return send_document(token, chat_id, buf, filename)
 
 
+@traced(TELEGRAM)
 def send_file(token, chat_id, text, file_bucket, file_key, config=None):
     """
     Returns a file to the user using the S3 link provided
@@ -229,6 +247,7 @@ def send_file(token, chat_id, text, file_bucket, file_key, config=None):
         _send_document_from_s3(token, chat_id, file_bucket, file_key, config)
 
 
+@traced(TELEGRAM)
 def _send_document_cached(token, chat_id, file_bucket, file_key, file_id):
     """
     Send Telegram-cached copy of file
@@ -250,7 +269,7 @@ def _send_document_cached(token, chat_id, file_bucket, file_key, file_id):
         url = TELEGRAM_HOSTNAME + "/bot" + token + "/sendDocument"
 
         try:
-            response = requests.post(url, data=post_data)
+            response = http_session().post(url, data=post_data)
         except ConnectionError as error:
             raise TelegramError(
                 "Error connecting to Telegram API: {}".format(str(error)))
@@ -270,6 +289,7 @@ def _send_document_cached(token, chat_id, file_bucket, file_key, file_id):
         _send_document_from_s3(token, chat_id, file_bucket, file_key)
 
 
+@traced(TELEGRAM)
 def _send_document_from_s3(token, chat_id, file_bucket, file_key, config=None):
     """
     Send document directly to Telegram user
@@ -307,7 +327,7 @@ def _send_document_from_s3(token, chat_id, file_bucket, file_key, config=None):
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/sendDocument"
 
     try:
-        response = requests.post(url, files=file_data, data=post_data)
+        response = http_session().post(url, files=file_data, data=post_data)
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -333,6 +353,7 @@ def _send_document_from_s3(token, chat_id, file_bucket, file_key, config=None):
     return response
 
 
+@traced(TELEGRAM)
 def send_keyboard(token, chat_id, text, keyboard=[], one_time=True, resize=True, inline=False):
     """ Returns a message with keyboard to the user
 
@@ -376,8 +397,8 @@ def send_keyboard(token, chat_id, text, keyboard=[], one_time=True, resize=True,
 
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/sendMessage"
     try:
-        response = requests.post(url, headers=headers,
-                                 data=json.dumps(post_data))
+        response = http_session().post(url, headers=headers,
+                                       data=json.dumps(post_data))
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -395,6 +416,7 @@ def send_keyboard(token, chat_id, text, keyboard=[], one_time=True, resize=True,
     return response
 
 
+@traced(TELEGRAM)
 def send_message(token, chat_id, text, keyboard=[], parse=None):
     """
     Returns a text message to the user
@@ -436,8 +458,8 @@ def send_message(token, chat_id, text, keyboard=[], parse=None):
 
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/sendMessage"
     try:
-        response = requests.post(url, headers=headers,
-                                 data=json.dumps(post_data))
+        response = http_session().post(url, headers=headers,
+                                       data=json.dumps(post_data))
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -455,6 +477,187 @@ def send_message(token, chat_id, text, keyboard=[], parse=None):
     return response
 
 
+DELIVERY_SENT = 'sent'
+DELIVERY_BLOCKED = 'blocked'
+DELIVERY_RETRY = 'retry'
+DELIVERY_FAILED = 'failed'
+
+
+@traced(TELEGRAM)
+def deliver_message(token, chat_id, text, session=None, parse=None):
+    """
+    Sends a text message without a keyboard and tells how it went instead
+    of raising, for sending to many chats
+
+    :param token: telegram api key
+    :param chat_id: ID of the chat with the user
+    :param text: text of the message
+    :param session: optional requests.Session to reuse connections
+    :param parse: Format to parse message in
+    :return: tuple of the outcome and the seconds Telegram asked to wait.
+        DELIVERY_BLOCKED means the chat cannot be reached anymore: the user
+        blocked the bot or the chat is gone. DELIVERY_RETRY means the call
+        was rate limited or did not reach Telegram.
+    """
+    post_data = {
+        "chat_id": chat_id,
+        "text": text
+    }
+    if parse == 'HTML':
+        post_data['parse_mode'] = 'HTML'
+    elif parse == 'MARKDOWN':
+        post_data['parse_mode'] = 'Markdown'
+
+    url = TELEGRAM_HOSTNAME + "/bot" + token + "/sendMessage"
+    try:
+        response = (session or requests).post(url, json=post_data, timeout=10)
+    except (ConnectionError, Timeout):
+        return DELIVERY_RETRY, 0
+    if response.status_code < 400:
+        return DELIVERY_SENT, 0
+    try:
+        body = response.json()
+    except ValueError:
+        body = {}
+    if response.status_code == 429:
+        return DELIVERY_RETRY, body.get('parameters', {}).get('retry_after', 1)
+    if response.status_code == 403 or (
+            response.status_code == 400 and
+            'chat not found' in str(body.get('description', '')).lower()):
+        return DELIVERY_BLOCKED, 0
+    if response.status_code >= 500:
+        return DELIVERY_RETRY, 0
+    return DELIVERY_FAILED, 0
+
+
+def get_updates(token, offset=None, timeout=30, session=None):
+    """
+    Long polls Telegram for updates. Updates before offset are confirmed
+    and not returned again.
+
+    :param token: telegram api key
+    :param offset: id of the first update to return
+    :param timeout: seconds Telegram holds the call when there is no update
+    :param session: optional requests.Session to reuse connections
+    :return: list of update objects
+    :raise: TelegramError: Telegram API call failed
+    """
+    post_data = {'timeout': timeout}
+    if offset is not None:
+        post_data['offset'] = offset
+
+    url = TELEGRAM_HOSTNAME + "/bot" + token + "/getUpdates"
+    try:
+        response = (session or http_session()).post(
+            url, json=post_data, timeout=timeout + 10)
+    except ConnectionError as error:
+        raise TelegramError(
+            "Error connecting to Telegram API: {}".format(str(error)))
+    except Timeout as error:
+        raise TelegramError(
+            "Timeout connecting to Telegram API: {}".format(str(error)))
+
+    if response.status_code >= 400:
+        raise TelegramError("Error response from Telegram API: {} {}".format(
+            str(response), response.text))
+
+    try:
+        return response.json()['result']
+    except (ValueError, KeyError) as error:
+        raise TelegramError(
+            "Unexpected response from Telegram API: {}".format(str(error)))
+
+
+def delete_webhook(token):
+    """
+    Removes the webhook of the bot, which getUpdates refuses to run with
+
+    :param token: telegram api key
+    :return: Telegram response object
+    :raise: TelegramError: Telegram API call failed
+    """
+    url = TELEGRAM_HOSTNAME + "/bot" + token + "/deleteWebhook"
+    try:
+        response = http_session().post(url, json={})
+    except (ConnectionError, Timeout) as error:
+        raise TelegramError(
+            "Error connecting to Telegram API: {}".format(str(error)))
+
+    if response.status_code >= 400:
+        raise TelegramError("Error response from Telegram API: {} {}".format(
+            str(response), response.text))
+
+    return response
+
+
+def set_webhook(token, url, secret_token=None):
+    """
+    Points the webhook of the bot to url
+
+    :param token: telegram api key
+    :param url: HTTPS url Telegram posts the updates to
+    :param secret_token: value Telegram sends in the
+        X-Telegram-Bot-Api-Secret-Token header of every update
+    :return: Telegram response object
+    :raise: TelegramError: Telegram API call failed
+    """
+    post_data = {"url": url}
+    if secret_token:
+        post_data["secret_token"] = secret_token
+
+    url = TELEGRAM_HOSTNAME + "/bot" + token + "/setWebhook"
+    try:
+        response = http_session().post(url, json=post_data)
+    except (ConnectionError, Timeout) as error:
+        raise TelegramError(
+            "Error connecting to Telegram API: {}".format(str(error)))
+
+    if response.status_code >= 400:
+        raise TelegramError("Error response from Telegram API: {} {}".format(
+            str(response), response.text))
+
+    return response
+
+
+@traced(TELEGRAM)
+def edit_message_text(token, chat_id, message_id, text):
+    """
+    Replaces the text of a message the bot sent
+
+    :param token: telegram api key
+    :param chat_id: ID of the chat with the user
+    :param message_id: ID of the message to edit
+    :param text: new text
+    :return: Telegram response object
+    :raise: TelegramError: Telegram API call failed
+    """
+    if text is None or len(text) <= 0:
+        raise ValidationError("Text cannot be empty")
+
+    post_data = {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "text": text
+    }
+
+    url = TELEGRAM_HOSTNAME + "/bot" + token + "/editMessageText"
+    try:
+        response = http_session().post(url, json=post_data)
+    except ConnectionError as error:
+        raise TelegramError(
+            "Error connecting to Telegram API: {}".format(str(error)))
+    except Timeout as error:
+        raise TelegramError(
+            "Timeout connecting to Telegram API: {}".format(str(error)))
+
+    if response.status_code >= 400:
+        raise TelegramError("Error response from Telegram API: {} {}".format(
+            str(response), response.text))
+
+    return response
+
+
+@traced(DYNAMODB)
 def save_request(chat_id, msg_id, user_name, event, table_name="MajlisMonitorBot"):
     """
     Save a telegram request to dynamodb
@@ -489,6 +692,7 @@ def save_request(chat_id, msg_id, user_name, event, table_name="MajlisMonitorBot
     return response
 
 
+@traced(TELEGRAM)
 def send_photo(token, chat_id, photo, photoname, caption=None, keyboard=[], inline=False):
     """
     Returns a photo to the user
@@ -533,14 +737,14 @@ def send_photo(token, chat_id, photo, photoname, caption=None, keyboard=[], inli
                 "Content-Length": str(len(json.dumps(post_data)))
             }
 
-            response = requests.post(
+            response = http_session().post(
                 url, data=json.dumps(post_data), headers=headers)
 
         else:
             photo_data = {
                 "photo": (photoname, photo)
             }
-            response = requests.post(url, files=photo_data, data=post_data)
+            response = http_session().post(url, files=photo_data, data=post_data)
 
     except ConnectionError as error:
         raise TelegramError(
@@ -559,6 +763,7 @@ def send_photo(token, chat_id, photo, photoname, caption=None, keyboard=[], inli
     return response
 
 
+@traced(TELEGRAM)
 def send_inlinequery_answer(token, response):
     """
     Returns a text message to the user
@@ -593,8 +798,8 @@ def send_inlinequery_answer(token, response):
 
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/answerInlineQuery"
     try:
-        response = requests.post(url, headers=headers,
-                                 data=json.dumps(post_data))
+        response = http_session().post(url, headers=headers,
+                                       data=json.dumps(post_data))
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -612,6 +817,7 @@ def send_inlinequery_answer(token, response):
     return response
 
 
+@traced(TELEGRAM)
 def edit_message_reply_markup(token, message_id, reply_markup, chat_id=None):
     """
     Edit reply markup of the messages sent
@@ -647,8 +853,8 @@ def edit_message_reply_markup(token, message_id, reply_markup, chat_id=None):
 
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/editMessageReplyMarkup"
     try:
-        response = requests.post(url, headers=headers,
-                                 data=json.dumps(post_data))
+        response = http_session().post(url, headers=headers,
+                                       data=json.dumps(post_data))
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -666,6 +872,7 @@ def edit_message_reply_markup(token, message_id, reply_markup, chat_id=None):
     return response
 
 
+@traced(TELEGRAM)
 def send_answer_callbackquery(token, message_id, text, show_alert):
     """
     Send Answer to Callback Query
@@ -698,8 +905,8 @@ def send_answer_callbackquery(token, message_id, text, show_alert):
 
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/answerCallbackQuery"
     try:
-        response = requests.post(url, headers=headers,
-                                 data=json.dumps(post_data))
+        response = http_session().post(url, headers=headers,
+                                       data=json.dumps(post_data))
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -717,6 +924,7 @@ def send_answer_callbackquery(token, message_id, text, show_alert):
     return response
 
 
+@traced(TELEGRAM)
 def send_document(token, chat_id, file_to_send, filename):
     """
     Send document directly to Telegram user
@@ -738,7 +946,7 @@ def send_document(token, chat_id, file_to_send, filename):
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/sendDocument"
 
     try:
-        response = requests.post(url, files=file_data, data=post_data)
+        response = http_session().post(url, files=file_data, data=post_data)
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -761,6 +969,7 @@ def send_document(token, chat_id, file_to_send, filename):
     return response
 
 
+@traced(TELEGRAM)
 def send_video(token, chat_id, video, supports_streaming=True, caption='', keyboard=[]):
     """ Returns a video to the user
 
@@ -792,7 +1001,7 @@ def send_video(token, chat_id, video, supports_streaming=True, caption='', keybo
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/sendVideo"
 
     try:
-        response = requests.post(url, files=video_data, data=post_data)
+        response = http_session().post(url, files=video_data, data=post_data)
 
     except ConnectionError as error:
         raise TelegramError(
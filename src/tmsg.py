@@ -12,6 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+"""
+Telegram Message Module
+Parses Telegram updates into TelegramMessage objects.
+
+The kind of an update is the one field next to its update_id, so
+update_type tells it, and whether it is parsed at all, before anything
+else is read. TelegramMessage only reads the fields the handlers route on
+(chat, sender, body) when it is built; the others are read from the update
+when accessed.
+"""
+
 import logging
 logger = logging.getLogger("tmsg")
 
@@ -20,300 +31,75 @@ class ObjectCreationFailed(Exception):
     pass
 
 
+# message type of every update kind parsed, the other kinds are rejected
+UPDATE_TYPES = {
+    'message': 'MESSAGE',
+    'inline_query': 'INLINE',
+    'edited_message': 'EDITED_MESSAGE',
+    'callback_query': 'CALLBACK',
+    'my_chat_member': 'MEMBER_UPDATE',
+    'channel_post': 'CHANNEL_POST',
+    'edited_channel_post': 'EDITED_CHANNEL_POST'
+}
+
+# types of chats the bot talks in, messages from the others are rejected
+PRIVATE_CHAT = 'private'
+
+
+def update_kind(update):
+    """
+    Returns the kind of an update, the name of its field holding the
+    message, query or member change
+
+    :param update: Telegram update object
+    :return: name of the field, or None
+    """
+    for field in update:
+        if field != 'update_id':
+            return field
+    return None
+
+
+def update_type(update):
+    """
+    Returns the message type an update is parsed as
+
+    :param update: Telegram update object
+    :return: message type, or None if the kind is not parsed
+    """
+    return UPDATE_TYPES.get(update_kind(update))
+
+
 class TelegramMessage(object):
 
+    __slots__ = ('type', 'source', 'lang', 'id', 'chat_id', 'user_uid', 'body',
+                 'command', 'command_arg', 'status', 'identity')
+
     def __init__(self, event, lang):
+        """
+        :param event: information about the chat, the update in 'Input'
+        :param lang: language of the chat
+        :raise: ObjectCreationFailed: the update is of a kind not parsed,
+            from a group or channel, or misses fields
+        """
+        update = event['Input']
+        kind = update_kind(update)
+        self.type = UPDATE_TYPES.get(kind)
+        if self.type is None:
+            logger.error('Not supporting {} updates yet!'.format(kind))
+            raise ObjectCreationFailed
 
+        self.source = update[kind]
         self.lang = lang
+        self.body = ''
         self.command = ''
         self.command_arg = ''
-
-        if 'message' in event['Input']:
-            # New incoming message of any kind - text, photo, sticker, etc.
-            self.type = 'MESSAGE'
-            message = event['Input']['message']
-            if 'title' in message['chat']:
-                self.title = message['chat']['title']
-            else:
-                self.title = u''
-
-            if 'from' in message:
-                self.user_uid = str(message['from']['id'])
-                if 'username' in message['from']:
-                    self.user_id = str(message['from']['username'])
-                else:
-                    self.user_id = str(message['from']['id'])
-                self.user_info = str(message['from'])
-            else:
-                self.user_id = u''
-                self.user_info = u''
-
-            # Type of chat, can be either “private”, “group”, “supergroup” or “channel”
-            if message['chat']['type'] == 'supergroup':
-                logger.error(f"Message from a Telegram Super Group: {self.title}")
-                raise ObjectCreationFailed
-            elif message['chat']['type'] == 'channel':
-                logger.error(f"Message from a Telegram Channel {self.title}"
-                    f"Forwarded by {self.user_uid}")
-                raise ObjectCreationFailed
-            elif message['chat']['type'] == 'group':
-                logger.error(f"Message from a Telegram Group {self.title}"
-                    f"Forwarded by {self.user_uid}")
-                raise ObjectCreationFailed
-            try:
-                self.msg_date = message['date']
-                self.id = int(message['message_id'])
-                self.chat_id = int(message['chat']['id'])
-
-                if 'text' in message:
-                    self.body = message['text']
-                    self.bodytype = 'TEXT'
-                elif 'document' in message:
-                    self.body = message['document']['file_id']
-                    self.bodytype = 'DOCUMENT'
-                    self.bodymime = message['document']['mime_type']
-                elif 'location' in message:
-                    self.body = ''
-                    self.bodytype = 'LOCATION'
-                    self.lat = message['location']['latitude']
-                    self.lon = message['location']['longitude']
-                elif 'photo' in message:
-                    self.body = ''
-                    self.bodytype = 'PHOTO'
-                    self.photo_id = message['photo'][1]['file_id']
-                elif 'voice' in message:
-                    self.body = ''
-                    self.bodytype = 'VOICE'
-                    self.voice_id = message['voice']['file_id']
-                else:
-                    self.body = ''
-                    self.bodytype = 'UNKNOWN'
-
-            except Exception as exc:
-                logger.error(str(exc))
-                raise ObjectCreationFailed
-
-        elif 'inline_query' in event['Input']:
-            # New incoming inline query
-            self.type = 'INLINE'
-            inline_query = event['Input']['inline_query']
-            try:
-                self.id = inline_query['id']
-                self.chat_id = inline_query['from']['id']
-                self.user_id = inline_query['from']['username']
-                self.body = inline_query['query']
-                self.is_bot = inline_query['from']['is_bot']
-
-            except Exception as exc:
-                raise ObjectCreationFailed
-
-        elif 'edited_message' in event['Input']:
-            # New version of a message that is known to the bot and was edited
-            self.type = 'EDITED_MESSAGE'
-            message = event['Input']['edited_message']
-            try:
-                self.msg_date = message['edit_date']
-                self.id = int(message['message_id'])
-                self.chat_id = int(message['chat']['id'])
-                self.user_uid = str(message['from']['id'])
-                if 'from' in message:
-                    if 'username' in message['from']:
-                        self.user_id = str(message['from']['username'])
-                    else:
-                        self.user_id = str(message['from']['id'])
-                    self.user_info = str(message['from'])
-                else:
-                    self.user_id = u''
-                    self.user_info = u''
-
-                if 'text' in message:
-                    self.body = message['text']
-                    self.bodytype = 'TEXT'
-                elif 'document' in message:
-                    self.body = message['document']['file_id']
-                    self.bodytype = 'DOCUMENT'
-                    self.bodymime = message['document']['mime_type']
-                elif 'location' in message:
-                    self.body = ''
-                    self.bodytype = 'LOCATION'
-                    self.lat = message['location']['latitude']
-                    self.lon = message['location']['longitude']
-                elif 'photo' in message:
-                    self.body = ''
-                    self.bodytype = 'PHOTO'
-                    self.photo_id = message['photo'][1]['file_id']
-                elif 'voice' in message:
-                    self.body = ''
-                    self.bodytype = 'VOICE'
-                    self.voice_id = message['voice']['file_id']
-                else:
-                    self.body = ''
-                    self.bodytype = 'UNKNOWN'
-
-            except Exception as exc:
-                logger.error(str(exc))
-                raise ObjectCreationFailed
-
-        elif 'callback_query' in event['Input']:
-            # New incoming callback query
-            self.type = 'CALLBACK'
-            callback_query = event['Input']['callback_query']
-            try:
-                self.id = callback_query['id']
-                if 'message' in callback_query and 'chat' in callback_query['message']:
-                    self.chat_id = callback_query['message']['chat']['id']
-                else:
-                    self.chat_id = callback_query['from']['id']
-
-                if 'message' in callback_query:
-                    self.msg_id = callback_query['message']['message_id']
-                    self.inline = False
-                else:
-                    self.msg_id = callback_query['inline_message_id']
-                    self.inline = True
-
-                self.user_uid = str(callback_query['from']['id'])
-                if 'username' in callback_query['from']:
-                    self.user_id = callback_query['from']['username']
-                else:
-                    self.user_id = callback_query['from']['id']
-
-                self.firstname = callback_query['from']['first_name']
-                self.body = callback_query['data']
-
-            except Exception as exc:
-                raise ObjectCreationFailed
-
-        elif 'my_chat_member' in event['Input']:
-            # The bot's chat member status was updated in a chat.
-            # For private chats, this update is received only when the bot is blocked
-            # or unblocked by the user.
-            self.type = 'MEMBER_UPDATE'
-            self.body = ''
-            self.chat_id = 0
-            my_chat_member = event['Input']['my_chat_member']
-            try:
-                self.status = my_chat_member['new_chat_member']['status']
-                self.user_uid = str(my_chat_member['from']['id'])
-                if 'username' in my_chat_member['from']:
-                    self.user_id = my_chat_member['from']['username']
-                else:
-                    self.user_id = my_chat_member['from']['id']
-                logger.info(
-                    "[Member Update] chat with {} has a new status: {}".format(
-                        self.user_id, self.status))
-
-            except Exception as exc:
-                raise ObjectCreationFailed
-
-        elif 'channel_post' in event['Input']:
-            # New incoming channel post of any kind - text, photo, sticker, etc.
-            self.type = 'CHANNEL_POST'
-            self.body = ''
-            self.chat_id = 0
-            channel_post = event['Input']['channel_post']
-            try:
-                self.user_uid = str(channel_post['sender_chat']['id'])
-                if 'username' in channel_post['sender_chat']:
-                    self.user_id = channel_post['sender_chat']['username']
-                else:
-                    self.user_id = channel_post['sender_chat']['id']
-                logger.info(
-                    "[Channel Post] We've got a channel post from: {}".format(
-                        self.user_id))
-
-            except Exception as exc:
-                raise ObjectCreationFailed
-
-        elif 'edited_channel_post' in event['Input']:
-            # New version of a channel post that is known to the bot and was edited
-            self.type = 'EDITED_CHANNEL_POST'
-            self.body = ''
-            self.chat_id = 0
-            channel_post = event['Input']['edited_channel_post']
-            try:
-                self.user_uid = str(channel_post['sender_chat']['id'])
-                if 'username' in channel_post['sender_chat']:
-                    self.user_id = channel_post['sender_chat']['username']
-                else:
-                    self.user_id = channel_post['sender_chat']['id']
-                logger.info(
-                    f"[Edited Channel Post] We've got a channel post from: {self.user_id}")
-
-            except Exception as exc:
-                raise ObjectCreationFailed
-
-        elif 'chosen_inline_result' in event['Input']:
-            # Represents a result of an inline query that was chosen by the user and sent to their chat partner.
-            self.user_uid = event['Input']['chosen_inline_result']['from']['id']
-            self.query = event['Input']['chosen_inline_result']['query']
-            logger.error('Not supporting chosen_inline_result yet!'
-                f'from: {self.user_id}, query: {self.query}')
-            raise ObjectCreationFailed
-        elif 'shipping_query' in event['Input']:
-            # This object contains information about an incoming shipping query.
-            self.user_uid = event['Input']['shipping_query']['from']['id']
-            self.invoice_payload = event['Input']['shipping_query']['invoice_payload']
-            logger.error('Not supporting shipping_query yet!'
-                f'from: {self.user_uid}, Invoice: {self.invoice_payload}')
-            raise ObjectCreationFailed
-        elif 'pre_checkout_query' in event['Input']:
-            # This object contains information about an incoming pre-checkout query.
-            self.user_uid = event['Input']['pre_checkout_query']['from']['id']
-            self.currency = event['Input']['pre_checkout_query']['currency']
-            self.total_amount = event['Input']['pre_checkout_query']['total_amount']
-            self.invoice_payload = event['Input']['pre_checkout_query']['invoice_payload']
-            logger.error('Not supporting pre_checkout_query yet!'
-                f'from: {self.user_uid}, Invoice: {self.invoice_payload}')
-            raise ObjectCreationFailed
-        elif 'poll' in event['Input']:
-            # This object contains information about a poll.
-            self.poll_id = event['Input']['poll']['id']
-            self.question = event['Input']['poll']['question']
-            logger.error('Not supporting poll yet!'
-                f'Poll ID: {self.poll_id}, Question: {self.question}')
-            raise ObjectCreationFailed
-        elif 'poll_answer' in event['Input']:
-            # This object represents an answer of a user in a non-anonymous poll.
-            self.user_uid = event['Input']['poll_answer']['user']['id']
-            self.poll_id = event['Input']['poll_answer']['poll_id']
-            logger.error('Not supporting poll_answer yet!'
-                f'User: {self.user_uid}, Question: {self.question}')
-            raise ObjectCreationFailed
-        elif 'chat_member' in event['Input']:
-            # A chat member's status was updated in a chat.
-            # The bot must be an administrator in the chat
-            # and must explicitly specify “chat_member” in
-            # the list of allowed_updates to receive these updates.
-            self.type = 'MEMBER_UPDATE'
-            self.body = ''
-            self.chat_id = 0
-            chat_member = event['Input']['chat_member']
-            try:
-                self.status = chat_member['new_chat_member']['status']
-                self.user_uid = str(chat_member['from']['id'])
-                if 'username' in chat_member['from']:
-                    self.user_id = chat_member['from']['username']
-                else:
-                    self.user_id = chat_member['from']['id']
-            except Exception as exc:
-                raise ObjectCreationFailed
-            logger.error('Not supporting chat_member yet!'
-                f'chat with {self.user_id} has a new status: {self.status}')
-            raise ObjectCreationFailed
-        elif 'chat_join_request' in event['Input']:
-            # A request to join the chat has been sent.
-            # The bot must have the can_invite_users administrator right in the chat to receive these updates
-            self.type = 'CHAT_JOIN_UPDATE'
-            self.body = ''
-            chat_join_request = event['Input']['chat_join_request']
-            self.chat_id = chat_join_request['chat']['id']
-            self.user_uid = chat_join_request['from']['id']
-            logger.error('Not supporting chat_join_request yet!'
-                f'User: {self.user_id}, Chat ID: {self.chat_id}')
-            raise ObjectCreationFailed
-        else:
-            logger.error('Undefined message type! {}'.format(event['Input']))
+        try:
+            getattr(self, '_parse_' + kind)(self.source)
+        except ObjectCreationFailed:
+            raise
+        except Exception as exc:
+            logger.error(str(exc))
             raise ObjectCreationFailed
 
         if self.body.startswith('/'):
@@ -323,3 +109,127 @@ class TelegramMessage(object):
                 self.command = str(cmd[0])
                 self.command_arg = str(cmd[1])
             self.command = self.command.lower()
+
+    def _parse_message(self, message):
+        # New incoming message of any kind - text, photo, sticker, etc.
+        # Type of chat, can be either “private”, “group”, “supergroup” or “channel”
+        chat_type = message['chat']['type']
+        if chat_type != PRIVATE_CHAT:
+            logger.error('Message from a Telegram {} {}'.format(chat_type, self.title))
+            raise ObjectCreationFailed
+        self.user_uid = str(message['from']['id'])
+        self.id = int(message['message_id'])
+        self.chat_id = int(message['chat']['id'])
+        if 'text' in message:
+            self.body = message['text']
+        elif 'document' in message:
+            self.body = message['document']['file_id']
+
+    def _parse_edited_message(self, message):
+        # New version of a message that is known to the bot and was edited
+        self._parse_message(message)
+
+    def _parse_inline_query(self, inline_query):
+        # New incoming inline query
+        self.id = inline_query['id']
+        self.chat_id = inline_query['from']['id']
+        self.body = inline_query['query']
+
+    def _parse_callback_query(self, callback_query):
+        # New incoming callback query
+        self.id = callback_query['id']
+        if 'message' in callback_query and 'chat' in callback_query['message']:
+            self.chat_id = callback_query['message']['chat']['id']
+        else:
+            self.chat_id = callback_query['from']['id']
+        self.user_uid = str(callback_query['from']['id'])
+        self.body = callback_query['data']
+
+    def _parse_my_chat_member(self, my_chat_member):
+        # The bot's chat member status was updated in a chat.
+        # For private chats, this update is received only when the bot is blocked
+        # or unblocked by the user.
+        self.status = my_chat_member['new_chat_member']['status']
+        self.chat_id = 0
+        if my_chat_member['chat']['type'] == PRIVATE_CHAT:
+            self.chat_id = my_chat_member['chat']['id']
+        self.user_uid = str(my_chat_member['from']['id'])
+
+    def _parse_channel_post(self, channel_post):
+        # New incoming channel post of any kind - text, photo, sticker, etc.
+        self.chat_id = 0
+        self.user_uid = str(channel_post['sender_chat']['id'])
+
+    def _parse_edited_channel_post(self, channel_post):
+        # New version of a channel post that is known to the bot and was edited
+        self._parse_channel_post(channel_post)
+
+    @property
+    def sender(self):
+        """ User or chat the update comes from """
+        return self.source.get('from') or self.source.get('sender_chat') or {}
+
+    @property
+    def user_id(self):
+        """ Username of the sender, or their id """
+        sender = self.sender
+        return str(sender.get('username', sender.get('id', '')))
+
+    @property
+    def user_info(self):
+        return str(self.sender) if 'from' in self.source else ''
+
+    @property
+    def firstname(self):
+        return self.sender.get('first_name')
+
+    @property
+    def is_bot(self):
+        return self.sender.get('is_bot')
+
+    @property
+    def title(self):
+        return self.source.get('chat', {}).get('title', '')
+
+    @property
+    def msg_date(self):
+        return self.source.get('edit_date', self.source.get('date'))
+
+    @property
+    def msg_id(self):
+        """ Message of a callback query, or its inline message id """
+        if 'message' in self.source:
+            return self.source['message']['message_id']
+        return self.source.get('inline_message_id')
+
+    @property
+    def inline(self):
+        return 'message' not in self.source
+
+    @property
+    def bodytype(self):
+        """ TEXT, DOCUMENT, LOCATION, PHOTO, VOICE or UNKNOWN """
+        for field in ('text', 'document', 'location', 'photo', 'voice'):
+            if field in self.source:
+                return field.upper()
+        return 'UNKNOWN'
+
+    @property
+    def bodymime(self):
+        return self.source['document']['mime_type']
+
+    @property
+    def lat(self):
+        return self.source['location']['latitude']
+
+    @property
+    def lon(self):
+        return self.source['location']['longitude']
+
+    @property
+    def photo_id(self):
+        return self.source['photo'][1]['file_id']
+
+    @property
+    def voice_id(self):
+        return self.source['voice']['file_id']
@@ -0,0 +1,296 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tracing Module
+Times the calls to the services an update waits on: DynamoDB
+(dynamodb.call), the BeePass API (api.py), Telegram (telegram.py) and S3
+(storage.py).
+
+Every call is a span of its dependency. The time of a span does not count
+the spans it makes, so the time S3 takes inside a Telegram call is S3's,
+and a span inside a span of the same dependency is not counted again.
+
+outlinebot.bot_handler runs every update in a trace, tagged with the type
+of the update, the status of its chat and the action asked for. With
+TRACE_SUMMARY, a trace ends with one line in CloudWatch's embedded metric
+format (EMF): the total time, the time and calls per dependency, the
+slowest spans and the tags, with the action as dimension.
+
+Span times are also kept for the process, the last TRACE_WINDOW of each
+dependency. Every TRACE_STATS_INTERVAL seconds a warm process writes their
+percentiles, with the DynamoDB throttling counters, as another EMF line.
+"""
+
+import contextvars
+import functools
+import json
+import sys
+import threading
+import time
+from collections import deque
+
+from settings import CONFIG
+
+DYNAMODB = 'dynamodb'
+API = 'api'
+TELEGRAM = 'telegram'
+STORAGE = 'storage'
+DEPENDENCIES = (DYNAMODB, API, TELEGRAM, STORAGE)
+
+TOTAL = 'total'
+
+# slowest spans listed in a summary
+MAX_SPANS = 10
+
+PERCENTILES = (50, 95, 99)
+
+_trace = contextvars.ContextVar('trace', default=None)
+
+_lock = threading.Lock()
+_windows = {}
+_stats_written = time.monotonic()
+_output_lock = threading.Lock()
+
+
+class Trace(object):
+    """
+    Spans and tags of one update
+    """
+    __slots__ = ('started', 'tags', 'times', 'calls', 'errors', 'spans', 'stack')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.tags = {}
+        self.times = dict.fromkeys(DEPENDENCIES, 0.0)
+        self.calls = dict.fromkeys(DEPENDENCIES, 0)
+        self.errors = dict.fromkeys(DEPENDENCIES, 0)
+        self.spans = []
+        # [dependency, time of the spans made inside] of the open spans
+        self.stack = []
+
+
+def enabled():
+    """ Returns whether calls are timed """
+    return CONFIG.get('TRACE', True)
+
+
+def tag(**tags):
+    """ Tags the trace of the update being handled """
+    trace = _trace.get()
+    if trace is not None:
+        trace.tags.update(tags)
+
+
+def record(dependency, seconds):
+    """ Adds a span time to the window of its dependency """
+    with _lock:
+        window = _windows.get(dependency)
+        if window is None:
+            window = _windows[dependency] = deque(maxlen=CONFIG.get('TRACE_WINDOW', 1000))
+        window.append(seconds)
+
+
+def traced(dependency, operation=None):
+    """
+    Decorates a function calling dependency, timing every call as a span
+
+    :param dependency: one of DEPENDENCIES
+    :param operation: name of the call, the name of the function if None
+    """
+    def decorate(func):
+        name = operation or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(dependency, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class Span(object):
+    """
+    Context manager timing one call to dependency
+    """
+    __slots__ = ('dependency', 'operation', 'trace', 'frame', 'started')
+
+    def __init__(self, dependency, operation):
+        self.dependency = dependency
+        self.operation = operation
+
+    def __enter__(self):
+        self.trace = _trace.get()
+        self.frame = None
+        if not enabled():
+            self.started = None
+            return self
+        if self.trace is not None:
+            stack = self.trace.stack
+            if stack and stack[-1][0] == self.dependency:
+                # part of the call already timed
+                self.started = None
+                return self
+            self.frame = [self.dependency, 0.0]
+            stack.append(self.frame)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.started is None:
+            return False
+        elapsed = time.perf_counter() - self.started
+        trace = self.trace
+        if trace is None:
+            record(self.dependency, elapsed)
+            return False
+        trace.stack.pop()
+        if trace.stack:
+            trace.stack[-1][1] += elapsed
+        own = max(elapsed - self.frame[1], 0.0)
+        record(self.dependency, own)
+        trace.times[self.dependency] += own
+        trace.calls[self.dependency] += 1
+        if exc_type is not None:
+            trace.errors[self.dependency] += 1
+        trace.spans.append((own, self.dependency, self.operation))
+        return False
+
+
+def run(func, *args):
+    """
+    Runs func(*args) in a trace of its own and writes its summary, to be
+    called in a fresh contextvars.Context
+
+    :return: the result of func
+    """
+    if not enabled():
+        return func(*args)
+    trace = Trace()
+    _trace.set(trace)
+    try:
+        return func(*args)
+    finally:
+        _trace.set(None)
+        elapsed = time.perf_counter() - trace.started
+        record(TOTAL, elapsed)
+        if CONFIG.get('TRACE_SUMMARY', True):
+            write(summary(trace, elapsed))
+        write_stats()
+
+
+def emf(metrics, dimensions, values):
+    """
+    Builds an EMF line
+
+    :param metrics: names of the millisecond metrics
+    :param dimensions: names of the dimensions
+    :param values: metric, dimension and other properties
+    :return: dictionary to write
+    """
+    return dict(values, _aws={
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{
+            'Namespace': CONFIG.get('TRACE_NAMESPACE', 'BeePassBot'),
+            'Dimensions': [list(dimensions)],
+            'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in metrics]
+        }]
+    })
+
+
+def summary(trace, elapsed):
+    """
+    Builds the EMF summary of a trace
+
+    :param trace: ended Trace
+    :param elapsed: seconds the update took
+    """
+    values = {'action': 'none', 'state': 'none', 'type': 'none'}
+    values.update(trace.tags)
+    values[TOTAL + '_ms'] = round(elapsed * 1000, 2)
+    metrics = [TOTAL + '_ms']
+    for dependency in DEPENDENCIES:
+        if not trace.calls[dependency]:
+            continue
+        metrics.append(dependency + '_ms')
+        values[dependency + '_ms'] = round(trace.times[dependency] * 1000, 2)
+        values[dependency + '_calls'] = trace.calls[dependency]
+        if trace.errors[dependency]:
+            values[dependency + '_errors'] = trace.errors[dependency]
+    values['spans'] = [
+        [dependency, operation, round(seconds * 1000, 2)]
+        for seconds, dependency, operation in sorted(trace.spans, reverse=True)[:MAX_SPANS]]
+    return emf(metrics, ['action'], values)
+
+
+def percentile(values, pct):
+    """ Nearest rank percentile of sorted values """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def percentiles():
+    """
+    Returns the span time percentiles of the process
+
+    :return: dictionary of dependency, or TOTAL for whole updates, to a
+        dictionary of 'p50', 'p95', 'p99' milliseconds and 'count'
+    """
+    with _lock:
+        windows = {dependency: sorted(window) for dependency, window in _windows.items()}
+    stats = {}
+    for dependency, values in windows.items():
+        stats[dependency] = {'count': len(values)}
+        for pct in PERCENTILES:
+            stats[dependency]['p{}'.format(pct)] = round(percentile(values, pct) * 1000, 2)
+    return stats
+
+
+def write_stats(force=False):
+    """
+    Writes the percentiles of the process as an EMF line, at most every
+    TRACE_STATS_INTERVAL seconds (0: never) unless forced
+    """
+    global _stats_written
+    interval = CONFIG.get('TRACE_STATS_INTERVAL', 60)
+    now = time.monotonic()
+    with _lock:
+        if not force and (not interval or now - _stats_written < interval):
+            return
+        _stats_written = now
+    # imported here, dynamodb imports this module
+    import dynamodb
+
+    values = {'scope': 'process'}
+    metrics = []
+    for dependency, stats in percentiles().items():
+        for name, value in stats.items():
+            if name == 'count':
+                values['{}_count'.format(dependency)] = value
+                continue
+            metric = '{}_{}_ms'.format(dependency, name)
+            metrics.append(metric)
+            values[metric] = value
+    values.update(('dynamodb_' + name, value)
+                  for name, value in dynamodb.throttle_stats().items())
+    write(emf(metrics, ['scope'], values))
+
+
+def write(line):
+    """ Writes an EMF line to stdout, where CloudWatch Logs picks it up """
+    text = json.dumps(line, separators=(',', ':'), default=str)
+    with _output_lock:
+        sys.stdout.write(text + '\n')
+        sys.stdout.flush()
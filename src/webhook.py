@@ -0,0 +1,280 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Webhook Module
+Runs the bot as a self-hosted HTTP server receiving Telegram's webhook
+posts, for hosting on a single machine instead of API Gateway and Lambda.
+
+The server runs on asyncio. A post is checked against WEBHOOK_SECRET, the
+X-Telegram-Bot-Api-Secret-Token header Telegram sends, before its body is
+read, and acknowledged as soon as it is read, so a slow update is never
+posted again by Telegram. Updates are then handed to
+outlinebot.bot_handler on a pool of WEBHOOK_WORKERS threads, the updates of
+a chat one at a time and in order. The threads keep their HTTP sessions
+(see telegram.http_session) and clients between updates. New posts are
+answered 503, for Telegram to retry them, while WEBHOOK_MAX_PENDING updates
+are queued.
+
+Acknowledged updates live in memory only: the ones queued when the server
+dies are lost. SIGINT and SIGTERM stop accepting posts and let the queued
+updates finish.
+
+Telegram only posts to HTTPS on ports 443, 80, 88 and 8443: pass a
+certificate, or run the server behind a proxy terminating TLS.
+
+    python webhook.py --token TOKEN [--lang fa] [--host 0.0.0.0] [--port 8443]
+                      [--path /] [--certificate cert.pem --key key.pem] [--url URL]
+"""
+
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import re
+import signal
+import ssl
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import batch
+import outlinebot
+import telegram
+from errors import ValidationError
+from settings import CONFIG
+
+logger = logging.getLogger()
+
+SECRET_HEADER = b'x-telegram-bot-api-secret-token'
+# characters and length Telegram accepts for a secret token
+SECRET_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,256}')
+
+# largest body read, updates are a few kilobytes
+MAX_BODY = 1 << 20
+
+# seconds an idle connection is kept open
+KEEP_ALIVE = 75
+
+REASONS = {
+    200: b'OK',
+    400: b'Bad Request',
+    401: b'Unauthorized',
+    404: b'Not Found',
+    405: b'Method Not Allowed',
+    413: b'Payload Too Large',
+    503: b'Service Unavailable'
+}
+
+
+def webhook_secret():
+    """
+    Returns WEBHOOK_SECRET, checked against what Telegram accepts
+
+    :return: the secret, or '' if posts are not checked
+    :raise: ValidationError: the secret is not 1-256 of A-Z, a-z, 0-9, _ and -
+    """
+    secret = CONFIG.get('WEBHOOK_SECRET') or ''
+    if secret and not SECRET_PATTERN.fullmatch(secret):
+        raise ValidationError(
+            'WEBHOOK_SECRET must be 1-256 of A-Z, a-z, 0-9, _ and -')
+    return secret
+
+
+class WebhookServer(object):
+    """
+    HTTP server of the webhook of one bot
+    """
+
+    def __init__(self, token, default_language, path='/'):
+        self.token = token
+        self.default_language = default_language
+        self.path = path.encode('utf-8')
+        self.secret = webhook_secret().encode('utf-8')
+        self.max_pending = CONFIG.get('WEBHOOK_MAX_PENDING', 1000)
+        self.pool = ThreadPoolExecutor(CONFIG.get('WEBHOOK_WORKERS', 16))
+        self.queues = {}
+        self.pending = 0
+        self.idle = None
+        self.stopping = None
+        self.connections = set()
+
+    def handle(self, update):
+        """ Hands one update to the bot, called on the pool """
+        event = {'token': self.token, 'lang': self.default_language, 'Input': update}
+        outlinebot.bot_handler(event, None)
+
+    def enqueue(self, update):
+        """ Queues an update after the updates of its chat """
+        chat = batch.chat_of(update)
+        key = update['update_id'] if chat is None else chat
+        self.pending += 1
+        self.idle.clear()
+        if key in self.queues:
+            self.queues[key].append(update)
+            return
+        self.queues[key] = deque()
+        asyncio.get_running_loop().create_task(self.drain(key, update))
+
+    async def drain(self, key, update):
+        """ Handles the updates of a chat until its queue is empty """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(self.pool, self.handle, update)
+            except Exception as exc:
+                logger.exception('[webhook] Update {} failed: {}'.format(
+                    update['update_id'], exc))
+            self.pending -= 1
+            if not self.queues[key]:
+                del self.queues[key]
+                break
+            update = self.queues[key].popleft()
+        if not self.pending:
+            self.idle.set()
+
+    def check(self, method, path, headers):
+        """
+        Checks a request from its head, before its body is read
+
+        :return: HTTP status, 200 if the body is to be read
+        """
+        if path.split(b'?', 1)[0] != self.path:
+            return 404
+        if method != b'POST':
+            return 405
+        if self.secret and not hmac.compare_digest(
+                headers.get(SECRET_HEADER, b''), self.secret):
+            return 401
+        if self.stopping.is_set() or self.pending >= self.max_pending:
+            return 503
+        try:
+            length = int(headers.get(b'content-length', b''))
+        except ValueError:
+            return 400
+        if length < 0:
+            return 400
+        if length > MAX_BODY:
+            return 413
+        return 200
+
+    def accept(self, body):
+        """
+        Queues the update of a request body
+
+        :return: HTTP status
+        """
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return 400
+        if not isinstance(update, dict) or not isinstance(update.get('update_id'), int):
+            return 400
+        self.enqueue(update)
+        return 200
+
+    async def serve(self, reader, writer):
+        """ Answers the requests of one connection """
+        self.connections.add(writer)
+        try:
+            while not self.stopping.is_set():
+                line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE)
+                if not line:
+                    break
+                method, path, version = line.rstrip().split(b' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.partition(b':')
+                    headers[name.strip().lower()] = value.strip()
+
+                status = self.check(method, path, headers)
+                if status == 200:
+                    body = await reader.readexactly(int(headers[b'content-length']))
+                    status = self.accept(body)
+                # the body of a refused request is not read, the
+                # connection closes instead
+                close = (status != 200 or version == b'HTTP/1.0' or
+                         headers.get(b'connection', b'').lower() == b'close')
+                writer.write(b'HTTP/1.1 %d %s\r\nContent-Length: 0\r\n%s\r\n' % (
+                    status, REASONS[status], b'Connection: close\r\n' if close else b''))
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ValueError:
+            # request line or header beyond the stream limit, or malformed
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n'
+                         b'Connection: close\r\n\r\n')
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def run(self, host, port, ssl_context=None):
+        """ Serves until stop is called, then drains the queued updates """
+        loop = asyncio.get_running_loop()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop)
+
+        server = await asyncio.start_server(
+            self.serve, host, port, ssl=ssl_context, backlog=1024)
+        logger.info('[webhook] Listening on {}:{}'.format(host, port))
+        async with server:
+            await self.stopping.wait()
+            server.close()
+            for writer in list(self.connections):
+                writer.close()
+            logger.info('[webhook] Stopping, waiting for {} updates'.format(self.pending))
+            await self.idle.wait()
+        self.pool.shutdown()
+
+    def stop(self):
+        """ Stops accepting updates, called on the event loop """
+        self.stopping.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the bot as a webhook server')
+    parser.add_argument('--token', required=True, help='Telegram Bot Token')
+    parser.add_argument('--lang', default='fa', help='language of new chats')
+    parser.add_argument('--host', default='0.0.0.0', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8443, help='port to listen on')
+    parser.add_argument('--path', default='/', help='path Telegram posts to')
+    parser.add_argument('--certificate', help='PEM certificate, to serve HTTPS')
+    parser.add_argument('--key', help='PEM private key of the certificate')
+    parser.add_argument('--url', help='public url of the server, set as the webhook first')
+    args = parser.parse_args()
+    try:
+        secret = webhook_secret()
+    except ValidationError as error:
+        parser.error(str(error))
+
+    ssl_context = None
+    if args.certificate:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(args.certificate, args.key)
+    if args.url:
+        telegram.set_webhook(args.token, args.url, secret)
+    server = WebhookServer(args.token, args.lang, args.path)
+    asyncio.run(server.run(args.host, args.port, ssl_context))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test setup: the modules of src are imported with a settings module made
+from settings-sample.py the way install.sh does, with every placeholder
+replaced by a test value. DynamoDB is moto's.
+"""
+
+import os
+import re
+import sys
+import types
+
+import boto3
+import pytest
+from moto import mock_aws
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+os.environ.update({
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_DEFAULT_REGION': 'us-east-1'
+})
+os.environ.pop('AWS_ENDPOINT_URL_DYNAMODB', None)
+os.environ.pop('AWS_LAMBDA_FUNCTION_NAME', None)
+
+
+def load_settings():
+    """ Returns the settings module made from settings-sample.py """
+    with open(os.path.join(SRC, 'settings-sample.py')) as sample:
+        source = sample.read()
+    source = source.replace('$ADMIN_LIST', '[]').replace('$REGION_LIST', "['us-east-1']")
+    source = re.sub(
+        r"'\$([A-Z_]+)'", lambda match: "'test-{}'".format(match.group(1).lower()), source)
+    settings = types.ModuleType('settings')
+    exec(compile(source, 'settings.py', 'exec'), settings.__dict__)
+    settings.CONFIG['STATE_BACKEND'] = 'memory'
+    return settings
+
+
+sys.path.insert(0, SRC)
+sys.modules['settings'] = load_settings()
+
+import dynamodb  # noqa: E402
+import statestore  # noqa: E402
+from settings import CONFIG  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_store():
+    """ Every test starts with a new state store """
+    statestore._store = None
+    yield
+    statestore._store = None
+
+
+@pytest.fixture
+def aws():
+    """ Mocked AWS with the chat, info and records tables """
+    with mock_aws():
+        dynamodb._local.resource = None
+        resource = boto3.resource('dynamodb')
+        for name, keys in (
+                (CONFIG['DYNAMO_TABLE'], [('chat_id', 'HASH', 'S')]),
+                (CONFIG['INFO_DYNAMO_TABLE'], [
+                    ('language', 'HASH', 'S'), ('linktype', 'RANGE', 'S')]),
+                (CONFIG['RECORDS_DYNAMO_TABLE'], [
+                    ('kind', 'HASH', 'S'), ('key', 'RANGE', 'S')])):
+            resource.create_table(
+                TableName=name,
+                KeySchema=[
+                    {'AttributeName': key, 'KeyType': key_type}
+                    for key, key_type, _ in keys],
+                AttributeDefinitions=[
+                    {'AttributeName': key, 'AttributeType': attribute_type}
+                    for key, _, attribute_type in keys],
+                BillingMode='PAY_PER_REQUEST')
+        yield resource
+        dynamodb._local.resource = None
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'dynamodb'])
+def store(request, tmp_path, monkeypatch):
+    """ Each state store backend, installed as the store of the process """
+    if request.param == 'dynamodb':
+        request.getfixturevalue('aws')
+        backend = statestore.DynamoDBStore()
+    elif request.param == 'sqlite':
+        backend = statestore.SQLiteStore(path=str(tmp_path / 'state.sqlite3'))
+    else:
+        backend = statestore.MemoryStore()
+    monkeypatch.setattr(statestore, '_store', backend)
+    return backend
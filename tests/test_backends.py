@@ -0,0 +1,205 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The same cases against every state store backend, see the store fixture
+"""
+
+import time
+
+import pytest
+
+from settings import CONFIG, STATUSES
+
+TABLE = CONFIG['DYNAMO_TABLE']
+INFO_TABLE = CONFIG['INFO_DYNAMO_TABLE']
+CHAT_ID = 1234
+
+
+@pytest.fixture
+def later(monkeypatch):
+    """ Moves the clock of every module forward by the seconds given """
+    offset = [0]
+    now = time.time
+    monkeypatch.setattr(time, 'time', lambda: now() + offset[0])
+
+    def move(seconds):
+        offset[0] += seconds
+    return move
+
+
+def test_unknown_chat(store):
+    assert store.get_chat(TABLE, CHAT_ID) is None
+    assert store.get_chat(TABLE, CHAT_ID, consistent=True) is None
+    assert int(store.get_chat_status(TABLE, CHAT_ID)) == -1
+    assert store.get_captcha(TABLE, CHAT_ID) is None
+
+
+def test_create_chat(store):
+    assert store.create_chat_status(TABLE, CHAT_ID, STATUSES['START'])
+    state = store.get_chat(TABLE, CHAT_ID, consistent=True)
+
+    assert state.status == STATUSES['START']
+    assert state.language == 'en'
+    assert state.version == 1
+    assert state.captcha is None
+    assert state.profile is None
+
+
+def test_create_keeps_the_language(store):
+    store.create_chat_status(TABLE, CHAT_ID, STATUSES['START'])
+    assert store.save_user_lang(TABLE, CHAT_ID, 'fa')
+    store.create_chat_status(TABLE, CHAT_ID, STATUSES['HOME'])
+
+    assert store.get_user_lang(TABLE, CHAT_ID) == 'fa'
+    state = store.get_chat(TABLE, CHAT_ID, consistent=True)
+    assert (state.status, state.language, state.version) == (STATUSES['HOME'], 'fa', 2)
+
+
+def test_blind_status_writes_bump_the_version(store):
+    store.create_chat_status(TABLE, CHAT_ID, STATUSES['START'])
+    assert store.save_chat_status(TABLE, CHAT_ID, STATUSES['HOME'])
+    assert store.save_chat_status(TABLE, CHAT_ID, STATUSES['GET_NEW_KEY'])
+
+    assert int(store.get_chat_status(TABLE, CHAT_ID)) == STATUSES['GET_NEW_KEY']
+    assert store.get_chat(TABLE, CHAT_ID, consistent=True).version == 3
+
+
+def test_captcha_lives_while_answered(store):
+    store.create_chat_status(TABLE, CHAT_ID, STATUSES['START'])
+    assert store.save_captcha(TABLE, CHAT_ID, ['2', '3'])
+    store.save_chat_status(TABLE, CHAT_ID, STATUSES['FIRST_CAPTCHA'])
+
+    assert [int(choice) for choice in store.get_captcha(TABLE, CHAT_ID)] == [2, 3]
+    state = store.get_chat(TABLE, CHAT_ID, consistent=True)
+    assert [int(choice) for choice in state.captcha] == [2, 3]
+
+    store.save_chat_status(TABLE, CHAT_ID, STATUSES['OPT_IN'])
+    assert store.get_captcha(TABLE, CHAT_ID, consistent=True) is None
+    assert store.get_chat(TABLE, CHAT_ID, consistent=True).captcha is None
+
+
+def test_profile(store):
+    store.create_chat_status(TABLE, CHAT_ID, STATUSES['HOME'])
+    profile = {'registered': True, 'banned': False, 'ss_link': 'ssconf://a'}
+    assert store.save_profile(TABLE, CHAT_ID, profile)
+    assert store.get_chat(TABLE, CHAT_ID, consistent=True).profile == profile
+
+    assert store.save_profile(TABLE, CHAT_ID, None)
+    assert store.get_chat(TABLE, CHAT_ID, consistent=True).profile is None
+
+
+def test_info_links(store):
+    version = store.get_info_version(INFO_TABLE)
+    assert store.save_info_link(INFO_TABLE, 'https://tos/en', 'en', 'tos')
+    assert store.save_info_link(INFO_TABLE, 'https://pp/fa', 'fa', 'pp')
+
+    assert store.get_info_link(INFO_TABLE, 'en', 'tos') == 'https://tos/en'
+    assert store.get_info_link(INFO_TABLE, 'en', 'pp') is None
+    links, new_version = store.get_info_links(INFO_TABLE, ['en', 'fa'], ['tos', 'pp'])
+    assert links == {('en', 'tos'): 'https://tos/en', ('fa', 'pp'): 'https://pp/fa'}
+    assert new_version != version
+    assert store.get_info_version(INFO_TABLE) == new_version
+
+
+def test_records(store):
+    assert store.get_record('job', 'a') is None
+    assert store.put_record('job', 'a', {'offset': 0, 'name': 'x'})
+    assert not store.put_record('job', 'a', {'offset': 5}, only_new=True)
+    assert store.get_record('job', 'a', consistent=True) == {'offset': 0, 'name': 'x'}
+
+    record = store.update_record('job', 'a', values={'name': 'y'}, increments={'offset': 3})
+    assert record == {'offset': 3, 'name': 'y'}
+    assert store.update_record('job', 'b', increments={'sent': 2}) == {'sent': 2}
+
+    store.delete_record('job', 'a')
+    assert store.get_record('job', 'a', consistent=True) is None
+    store.delete_record('job', 'missing')
+
+
+def test_query_records_pages_in_key_order(store):
+    for key in ('c', 'a', 'e', 'b', 'd'):
+        store.put_record('page', key, {'name': key})
+    store.put_record('other', 'a', {})
+
+    keys = []
+    start = None
+    while True:
+        records, start = store.query_records('page', start=start, limit=2)
+        assert len(records) <= 2
+        keys.extend(key for key, _ in records)
+        assert all(values == {'name': key} for key, values in records)
+        if start is None:
+            break
+    assert keys == ['a', 'b', 'c', 'd', 'e']
+
+
+def test_record_expiry(store, later):
+    store.put_record('lease', 'a', {'started': 1}, ttl=60)
+    store.update_record('rate', 'a', increments={'taken': 1}, ttl=60)
+    store.put_record('job', 'a', {'offset': 1})
+    later(30)
+    assert store.get_record('lease', 'a', consistent=True) == {'started': 1}
+    assert not store.put_record('lease', 'a', {'started': 2}, ttl=60, only_new=True)
+
+    later(31)
+    assert store.get_record('lease', 'a', consistent=True) is None
+    assert store.query_records('lease') == ([], None)
+    # an expired record is replaced, and started over by an update
+    assert store.put_record('lease', 'a', {'started': 2}, ttl=60, only_new=True)
+    assert store.update_record('rate', 'a', increments={'taken': 1}) == {'taken': 1}
+    assert store.get_record('job', 'a', consistent=True) == {'offset': 1}
+
+
+def test_captcha_expiry(store, later, monkeypatch):
+    monkeypatch.setitem(CONFIG, 'CAPTCHA_STORE_TTL', 60)
+    store.create_chat_status(TABLE, CHAT_ID, STATUSES['FIRST_CAPTCHA'])
+    store.save_captcha(TABLE, CHAT_ID, ['2', '3'])
+    later(30)
+    assert store.get_captcha(TABLE, CHAT_ID, consistent=True) is not None
+
+    later(31)
+    assert store.get_captcha(TABLE, CHAT_ID, consistent=True) is None
+    state = store.get_chat(TABLE, CHAT_ID, consistent=True)
+    assert state.captcha is None
+    assert state.status == STATUSES['FIRST_CAPTCHA']
+
+
+def test_profile_expiry(store, later, monkeypatch):
+    monkeypatch.setitem(CONFIG, 'PROFILE_TTL', 60)
+    store.create_chat_status(TABLE, CHAT_ID, STATUSES['HOME'])
+    store.save_profile(TABLE, CHAT_ID, {'registered': True})
+    later(61)
+
+    assert store.get_chat(TABLE, CHAT_ID, consistent=True).profile is None
+
+
+@pytest.mark.parametrize('status, setting', [
+    ('FIRST_CAPTCHA', 'CHAT_TTL_PRE_OPT_IN'),
+    ('HOME', 'CHAT_TTL_POST_OPT_IN')])
+def test_chat_expiry(store, later, monkeypatch, status, setting):
+    monkeypatch.setitem(CONFIG, 'CHAT_TTL_PRE_OPT_IN', 100)
+    monkeypatch.setitem(CONFIG, 'CHAT_TTL_POST_OPT_IN', 1000)
+    store.create_chat_status(TABLE, CHAT_ID, STATUSES[status])
+    later(CONFIG[setting] - 10)
+    assert store.get_chat(TABLE, CHAT_ID, consistent=True) is not None
+
+    # a status write restarts the clock
+    store.save_chat_status(TABLE, CHAT_ID, STATUSES[status])
+    later(20)
+    assert store.get_chat(TABLE, CHAT_ID, consistent=True) is not None
+
+    later(CONFIG[setting])
+    assert store.get_chat(TABLE, CHAT_ID, consistent=True) is None
+    assert int(store.get_chat_status(TABLE, CHAT_ID)) == -1
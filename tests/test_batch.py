@@ -0,0 +1,111 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import threading
+
+import pytest
+
+import batch
+import outlinebot
+
+
+def record(message_id, chat_id, text, group=True):
+    update = {
+        'update_id': message_id,
+        'message': {
+            'message_id': message_id,
+            'from': {'id': chat_id},
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': text
+        }
+    }
+    attributes = {'MessageGroupId': str(chat_id)} if group else {}
+    return {
+        'messageId': 'm{}'.format(message_id),
+        'attributes': attributes,
+        'body': json.dumps({'token': 'token', 'lang': 'en', 'Input': update})
+    }
+
+
+class Context(object):
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def get_remaining_time_in_millis(self):
+        return self.seconds * 1000
+
+
+@pytest.fixture
+def handled(monkeypatch):
+    """ Texts handled per chat, 'fail' raises """
+    handled = {}
+    lock = threading.Lock()
+
+    def bot_handler(event, context):
+        message = event['Input']['message']
+        with lock:
+            handled.setdefault(message['chat']['id'], []).append(message['text'])
+        if message['text'] == 'fail':
+            raise RuntimeError('failed')
+        return True
+
+    monkeypatch.setattr(outlinebot, 'bot_handler', bot_handler)
+    return handled
+
+
+def failures(reply):
+    return [failure['itemIdentifier'] for failure in reply['batchItemFailures']]
+
+
+def test_groups_keep_their_order(handled):
+    records = [record(1, 10, 'a'), record(2, 20, 'x'), record(3, 10, 'b'),
+               record(4, 30, 'p', group=False), record(5, 20, 'y'),
+               record(6, 30, 'q', group=False), record(7, 10, 'c')]
+
+    assert failures(batch.batch_handler({'Records': records}, None)) == []
+    assert handled == {10: ['a', 'b', 'c'], 20: ['x', 'y'], 30: ['p', 'q']}
+
+
+def test_failed_record_mid_group(handled):
+    records = [record(1, 10, 'a'), record(2, 10, 'fail'), record(3, 20, 'x'),
+               record(4, 10, 'c'), record(5, 20, 'y')]
+
+    # the failed record and the ones after it in its chat are retried,
+    # the other chat is not held back
+    assert failures(batch.batch_handler({'Records': records}, None)) == ['m2', 'm4']
+    assert handled == {10: ['a', 'fail'], 20: ['x', 'y']}
+
+
+def test_unreadable_record_is_dropped(handled):
+    records = [record(1, 10, 'a'), {'messageId': 'm2', 'body': 'not json'}]
+
+    assert failures(batch.batch_handler({'Records': records}, None)) == []
+    assert handled == {10: ['a']}
+
+
+def test_records_past_the_deadline_are_retried(handled):
+    records = [record(1, 10, 'a'), record(2, 20, 'x')]
+
+    reply = batch.batch_handler({'Records': records}, Context(0))
+    assert sorted(failures(reply)) == ['m1', 'm2']
+    assert handled == {}
+
+
+def test_chat_of_callbacks_and_members():
+    assert batch.chat_of({'callback_query': {
+        'from': {'id': 1}, 'message': {'chat': {'id': 2}}}}) == 2
+    assert batch.chat_of({'my_chat_member': {'chat': {'id': 3}, 'from': {'id': 4}}}) == 3
+    assert batch.chat_of({'inline_query': {'from': {'id': 5}}}) == 5
@@ -0,0 +1,126 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import captcha
+from settings import CONFIG
+
+CHAT_ID = 1234
+NOW = 1700000000.0
+
+
+@pytest.fixture(autouse=True)
+def nonces():
+    captcha._nonces.clear()
+    yield
+    captcha._nonces.clear()
+
+
+def challenge(now=NOW, chat_id=CHAT_ID):
+    """ :return: callback data of the right and of a wrong choice """
+    choices, a, b, callbacks = captcha.get_signed_choice(chat_id, now=now)
+    answer = int(a) + int(b)
+    right = [data for choice, data in zip(choices, callbacks) if int(choice) == answer]
+    wrong = [data for choice, data in zip(choices, callbacks) if int(choice) != answer]
+    assert len(right) == 1 and len(wrong) == 3
+    return right[0], wrong[0]
+
+
+def test_right_choice_passes(store):
+    right, wrong = challenge()
+
+    assert len(right) <= 64
+    assert not captcha.check_signed_captcha(CHAT_ID, wrong, now=NOW + 1)
+    assert captcha.check_signed_captcha(CHAT_ID, right, now=NOW + 1)
+
+
+def test_nothing_is_stored(store, monkeypatch):
+    def no_store(*args, **kwargs):
+        raise AssertionError('the store was used')
+
+    monkeypatch.setattr(captcha, 'get_store', no_store)
+    right, _ = challenge()
+    assert captcha.check_signed_captcha(CHAT_ID, right, now=NOW + 1)
+
+
+def test_expired_challenge_fails():
+    right, _ = challenge()
+
+    assert not captcha.check_signed_captcha(
+        CHAT_ID, right, now=NOW + CONFIG['CAPTCHA_TTL'] + 1)
+
+
+def test_tampered_data_fails():
+    right, _ = challenge()
+    prefix, choice, expires, nonce, signature = right.split(':')
+
+    later = ':'.join([prefix, choice, str(int(expires) + 3600), nonce, signature])
+    assert not captcha.check_signed_captcha(CHAT_ID, later, now=NOW + 1)
+    forged = ':'.join([prefix, choice, expires, nonce, signature[::-1]])
+    assert not captcha.check_signed_captcha(CHAT_ID, forged, now=NOW + 1)
+    assert not captcha.check_signed_captcha(CHAT_ID, 'cpt:1:2', now=NOW + 1)
+    assert not captcha.check_signed_captcha(CHAT_ID, 'cpt:a:b:c:d', now=NOW + 1)
+    # signed for another chat
+    assert not captcha.check_signed_captcha(CHAT_ID + 1, right, now=NOW + 1)
+
+
+def test_passed_challenge_is_not_replayed():
+    right, _ = challenge()
+
+    assert captcha.check_signed_captcha(CHAT_ID, right, now=NOW + 1)
+    assert not captcha.check_signed_captcha(CHAT_ID, right, now=NOW + 2)
+
+
+def test_older_challenge_is_refused():
+    old, _ = challenge(now=NOW)
+    new, _ = challenge(now=NOW + 5)
+
+    assert not captcha.check_signed_captcha(CHAT_ID, old, now=NOW + 6)
+    assert captcha.check_signed_captcha(CHAT_ID, new, now=NOW + 6)
+
+
+def test_nonces_are_per_chat():
+    first, _ = challenge(chat_id=CHAT_ID)
+    second, _ = challenge(now=NOW + 5, chat_id=CHAT_ID + 1)
+
+    assert captcha.check_signed_captcha(CHAT_ID, first, now=NOW + 6)
+    assert captcha.check_signed_captcha(CHAT_ID + 1, second, now=NOW + 6)
+
+
+def test_choices_are_distinct():
+    for _ in range(500):
+        a, b, choices = captcha.make_challenge()
+        assert len(set(choices)) == 4
+        assert choices.count(a + b) == 1
+
+
+def test_stored_captcha_uses_the_chat_state(store, monkeypatch):
+    table = CONFIG['DYNAMO_TABLE']
+    store.create_chat_status(table, CHAT_ID, 3)
+    store.save_captcha(table, CHAT_ID, ['2', '3'])
+    state = store.get_chat(table, CHAT_ID, consistent=True)
+    reads = []
+    get_captcha = store.get_captcha
+    monkeypatch.setattr(
+        store, 'get_captcha',
+        lambda *args, **kwargs: reads.append(kwargs) or get_captcha(*args, **kwargs))
+
+    assert captcha.check_captcha(table, CHAT_ID, 5, state.captcha)
+    # a wrong guess costs no read
+    assert not captcha.check_captcha(table, CHAT_ID, 6, state.captcha)
+    assert reads == []
+    # a state read before the captcha was saved
+    assert captcha.check_captcha(table, CHAT_ID, 5, None)
+    assert reads == [{'consistent': True}]
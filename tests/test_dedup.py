@@ -0,0 +1,97 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import dedup
+import outlinebot
+from errors import DBError
+from settings import CONFIG
+
+
+def update(update_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': 1,
+            'from': {'id': 42, 'first_name': 'Test'},
+            'chat': {'id': 42, 'type': 'private'},
+            'text': 'hi'
+        }
+    }
+
+
+@pytest.fixture(autouse=True)
+def enabled(monkeypatch):
+    monkeypatch.setitem(CONFIG, 'DEDUP_TTL', 86400)
+    dedup._seen.clear()
+    yield
+    dedup._seen.clear()
+
+
+def test_off_without_ttl(store, monkeypatch):
+    monkeypatch.setitem(CONFIG, 'DEDUP_TTL', 0)
+
+    assert dedup.claim(update(1))
+    assert dedup.claim(update(1))
+    assert store.get_record(dedup.UPDATE_KIND, '1') is None
+
+
+def test_duplicate_is_dropped(store):
+    assert dedup.claim(update(1))
+    assert not dedup.claim(update(1))
+    assert dedup.claim(update(2))
+
+
+def test_duplicate_from_another_process_is_dropped(store):
+    assert dedup.claim(update(1))
+    # the LRU of the process that sees the redelivery does not know it
+    dedup._seen.clear()
+    assert not dedup.claim(update(1))
+
+
+def test_release_lets_the_redelivery_through(store):
+    assert dedup.claim(update(1))
+    dedup.release(update(1))
+
+    assert store.get_record(dedup.UPDATE_KIND, '1', consistent=True) is None
+    assert dedup.claim(update(1))
+
+
+def test_store_failure_does_not_drop_updates(store, monkeypatch):
+    def unreachable(*args, **kwargs):
+        raise DBError('unreachable')
+
+    monkeypatch.setattr(store, 'put_record', unreachable)
+    assert dedup.claim(update(1))
+
+
+def test_bot_handler_releases_failed_updates(store, monkeypatch):
+    handled = []
+
+    def handle_update(event, token, default_language):
+        handled.append(event['Input']['update_id'])
+        if len(handled) == 1:
+            raise RuntimeError('failed')
+        return True
+
+    monkeypatch.setattr(outlinebot, 'handle_update', handle_update)
+    event = {'token': 'token', 'lang': 'en', 'Input': update(7)}
+
+    with pytest.raises(RuntimeError):
+        outlinebot.bot_handler(event, None)
+    # the redelivery of the failed update is handled, the next one dropped
+    assert outlinebot.bot_handler(event, None)
+    assert outlinebot.bot_handler(event, None)
+    assert handled == [7, 7]
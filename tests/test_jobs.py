@@ -0,0 +1,87 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+import pytest
+
+import jobs
+
+
+class Clock(object):
+    """ time.time and time.sleep of the jobs module, without waiting """
+
+    def __init__(self, now=1700000000.0):
+        self.now = now
+        self.lock = threading.Lock()
+
+    def time(self):
+        with self.lock:
+            return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(jobs.time, 'time', clock.time)
+    monkeypatch.setattr(jobs.time, 'sleep', clock.sleep)
+    return clock
+
+
+def taken_per_second(buckets, takes, clock):
+    """ Takes tokens from the buckets in turn, returns the count per second """
+    seconds = {}
+    for index in range(takes):
+        buckets[index % len(buckets)].take()
+        second = int(clock.time())
+        seconds[second] = seconds.get(second, 0) + 1
+    return seconds
+
+
+def test_buckets_share_the_rate(store, clock):
+    # two runs, or two Lambda instances, of jobs of the same bot
+    buckets = [jobs.SharedTokenBucket('bot', 10), jobs.SharedTokenBucket('bot', 10)]
+
+    seconds = taken_per_second(buckets, 60, clock)
+    assert max(seconds.values()) <= 10
+    assert len(seconds) >= 6
+
+
+def test_buckets_of_other_names_do_not_share(store, clock):
+    buckets = [jobs.SharedTokenBucket('bot', 10), jobs.SharedTokenBucket('other', 10)]
+
+    seconds = taken_per_second(buckets, 20, clock)
+    assert list(seconds.values()) == [20]
+
+
+def test_pause_holds_every_taker(store, clock):
+    first = jobs.SharedTokenBucket('bot', 10)
+    second = jobs.SharedTokenBucket('bot', 10)
+    start = clock.time()
+
+    first.pause(3)
+    second.take()
+    assert clock.time() >= int(start) + 4
+
+
+def test_send_bucket_is_per_bot(monkeypatch):
+    monkeypatch.setattr(jobs, '_send_buckets', {})
+
+    assert jobs.send_bucket('1:a') is jobs.send_bucket('1:b')
+    assert jobs.send_bucket('1:a') is not jobs.send_bucket('2:a')
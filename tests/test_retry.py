@@ -0,0 +1,103 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+import dynamodb
+import statestore
+from errors import DBError
+from retry import AIMDLimiter, Retrier
+
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'UpdateItem')
+
+
+class Flaky(object):
+    """ Raises an error for its first failures calls, then returns 'ok' """
+
+    def __init__(self, code, failures):
+        self.code = code
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise client_error(self.code)
+        return 'ok'
+
+
+def test_retries_throttling_until_it_passes():
+    retrier = Retrier('test', DBError, deadline=5.0, base=0.001, cap=0.002)
+    flaky = Flaky('ProvisionedThroughputExceededException', 3)
+
+    assert retrier.call(flaky) == 'ok'
+    assert flaky.calls == 4
+    stats = retrier.stats()
+    assert stats['throttled'] == 3
+    assert stats['retries'] == 3
+    assert stats['exhausted'] == 0
+
+
+def test_gives_up_at_the_deadline():
+    retrier = Retrier('test', DBError, deadline=0.05, base=0.005, cap=0.01)
+    flaky = Flaky('ThrottlingException', float('inf'))
+
+    started = time.monotonic()
+    with pytest.raises(DBError):
+        retrier.call(flaky)
+    assert time.monotonic() - started < 0.05 + 0.1
+    assert flaky.calls > 1
+    assert retrier.stats()['exhausted'] == 1
+
+
+def test_other_errors_are_not_retried():
+    retrier = Retrier('test', DBError, deadline=5.0, base=0.001)
+    flaky = Flaky('ValidationException', 1)
+
+    with pytest.raises(ClientError):
+        retrier.call(flaky)
+    assert flaky.calls == 1
+    assert retrier.stats()['retries'] == 0
+
+
+def test_limiter_backs_off_on_throttling():
+    limiter = AIMDLimiter(8)
+    retrier = Retrier('test', DBError, deadline=5.0, base=0.001, cap=0.002, limiter=limiter)
+
+    retrier.call(Flaky('ThrottlingException', 2))
+    assert limiter.limit == pytest.approx(8 * 0.5 ** 2 + 1.0 / 2)
+    assert limiter.in_flight == 0
+
+
+class ThrottledTable(object):
+    """ Table whose reads are always throttled """
+
+    def get_item(self, **kwargs):
+        raise client_error('ProvisionedThroughputExceededException')
+
+
+def test_store_records_raise_when_throttled(monkeypatch):
+    monkeypatch.setattr(dynamodb.retrier, 'deadline', 0.02)
+    monkeypatch.setattr(dynamodb.retrier, 'base', 0.005)
+    monkeypatch.setattr(dynamodb, 'get_table', lambda table: ThrottledTable())
+
+    exhausted = dynamodb.throttle_stats()['exhausted']
+    with pytest.raises(DBError):
+        statestore.DynamoDBStore().get_record('job', 'a', consistent=True)
+    assert dynamodb.throttle_stats()['exhausted'] == exhausted + 1
@@ -0,0 +1,78 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from settings import CONFIG, STATUSES
+
+TABLE = CONFIG['DYNAMO_TABLE']
+CHAT_ID = 1234
+
+
+def test_transition_bumps_version(store):
+    store.create_chat_status(TABLE, CHAT_ID, STATUSES['START'])
+    state = store.get_chat(TABLE, CHAT_ID, consistent=True)
+
+    assert store.save_chat_status(TABLE, CHAT_ID, STATUSES['HOME'], expected=state)
+    assert state.status == STATUSES['HOME']
+    current = store.get_chat(TABLE, CHAT_ID, consistent=True)
+    assert current.status == STATUSES['HOME']
+    assert current.version == state.version
+
+
+def test_version_conflict(store):
+    store.create_chat_status(TABLE, CHAT_ID, STATUSES['HOME'])
+    first = store.get_chat(TABLE, CHAT_ID, consistent=True)
+    second = store.get_chat(TABLE, CHAT_ID, consistent=True)
+
+    assert store.save_chat_status(TABLE, CHAT_ID, STATUSES['GET_NEW_KEY'], expected=first)
+    # the second tap was read in the same state, its transition must lose
+    assert not store.save_chat_status(
+        TABLE, CHAT_ID, STATUSES['DELETE_ACCOUNT_REASON'], expected=second)
+    assert int(store.get_chat_status(TABLE, CHAT_ID)) == STATUSES['GET_NEW_KEY']
+    # and it now sees the chat as the first one left it
+    assert second.status == STATUSES['GET_NEW_KEY']
+    assert second.version == first.version
+
+
+def test_conflict_to_same_status_succeeds(store):
+    store.create_chat_status(TABLE, CHAT_ID, STATUSES['HOME'])
+    first = store.get_chat(TABLE, CHAT_ID, consistent=True)
+    second = store.get_chat(TABLE, CHAT_ID, consistent=True)
+
+    assert store.save_chat_status(TABLE, CHAT_ID, STATUSES['GET_NEW_KEY'], expected=first)
+    assert store.save_chat_status(TABLE, CHAT_ID, STATUSES['GET_NEW_KEY'], expected=second)
+    assert store.get_chat(TABLE, CHAT_ID, consistent=True).version == first.version
+
+
+def test_stale_expected(store):
+    store.create_chat_status(TABLE, CHAT_ID, STATUSES['HOME'])
+    stale = store.get_chat(TABLE, CHAT_ID, consistent=True)
+    # a blind write, such as an admin's, moves the chat after the read
+    assert store.save_chat_status(TABLE, CHAT_ID, STATUSES['HOME'])
+
+    assert not store.save_chat_status(TABLE, CHAT_ID, STATUSES['GET_NEW_KEY'], expected=stale)
+    assert int(store.get_chat_status(TABLE, CHAT_ID)) == STATUSES['HOME']
+    current = store.get_chat(TABLE, CHAT_ID, consistent=True)
+    assert stale.version == current.version
+
+    # refreshed, the expected state is good for the next transition
+    assert store.save_chat_status(TABLE, CHAT_ID, STATUSES['GET_NEW_KEY'], expected=stale)
+    assert int(store.get_chat_status(TABLE, CHAT_ID)) == STATUSES['GET_NEW_KEY']
+
+
+def test_conflict_on_missing_chat(store):
+    store.create_chat_status(TABLE, CHAT_ID, STATUSES['HOME'])
+    state = store.get_chat(TABLE, CHAT_ID, consistent=True)
+    state.version += 1
+
+    assert not store.save_chat_status(TABLE, CHAT_ID + 1, STATUSES['GET_NEW_KEY'], expected=state)
@@ -0,0 +1,127 @@
+# Copyright 2024 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from tmsg import ObjectCreationFailed, TelegramMessage, update_kind, update_type
+
+SENDER = {'id': 42, 'is_bot': False, 'first_name': 'Test', 'username': 'tester'}
+
+
+def message(**fields):
+    message = {
+        'message_id': 7,
+        'date': 1700000000,
+        'from': SENDER,
+        'chat': {'id': 42, 'type': 'private'}
+    }
+    message.update(fields)
+    return message
+
+
+def parse(kind, value):
+    return TelegramMessage({'Input': {'update_id': 1, kind: value}}, 'en')
+
+
+class Untouchable(dict):
+    """ Part of an update that must not be read while parsing """
+
+    def __getitem__(self, key):
+        raise AssertionError('read {}'.format(key))
+
+    get = __getitem__
+
+
+def test_update_kind_and_type():
+    assert update_kind({'update_id': 1, 'callback_query': {}}) == 'callback_query'
+    assert update_type({'update_id': 1, 'callback_query': {}}) == 'CALLBACK'
+    assert update_type({'update_id': 1, 'poll': {}}) is None
+    assert update_kind({'update_id': 1}) is None
+
+
+def test_text_message():
+    tmsg = parse('message', message(text='/start ref code'))
+
+    assert tmsg.type == 'MESSAGE'
+    assert tmsg.chat_id == 42
+    assert tmsg.user_uid == '42'
+    assert tmsg.id == 7
+    assert tmsg.command == 'start'
+    assert tmsg.command_arg == 'ref code'
+    assert tmsg.bodytype == 'TEXT'
+
+
+def test_unsupported_kind_is_rejected_unread():
+    with pytest.raises(ObjectCreationFailed):
+        parse('poll', Untouchable())
+
+
+def test_group_message_is_rejected():
+    with pytest.raises(ObjectCreationFailed):
+        parse('message', message(text='hi', chat={'id': -5, 'type': 'group', 'title': 'G'}))
+
+
+def test_missing_fields_are_rejected():
+    with pytest.raises(ObjectCreationFailed):
+        parse('message', {'chat': {'type': 'private'}, 'text': 'hi'})
+
+
+def test_optional_fields_are_read_on_access():
+    location = Untouchable()
+    tmsg = parse('message', message(location=location))
+
+    assert tmsg.body == ''
+    assert tmsg.bodytype == 'LOCATION'
+    with pytest.raises(AssertionError):
+        tmsg.lat
+    assert tmsg.user_id == 'tester'
+    assert tmsg.firstname == 'Test'
+    assert tmsg.is_bot is False
+    assert tmsg.user_info == str(SENDER)
+    assert tmsg.msg_date == 1700000000
+
+
+def test_callback_query():
+    tmsg = parse('callback_query', {
+        'id': 'q1',
+        'from': SENDER,
+        'message': {'message_id': 9, 'chat': {'id': 42, 'type': 'private'}},
+        'data': 'cpt:3:1:2:sig'
+    })
+
+    assert tmsg.type == 'CALLBACK'
+    assert tmsg.chat_id == 42
+    assert tmsg.body == 'cpt:3:1:2:sig'
+    assert tmsg.msg_id == 9
+    assert not tmsg.inline
+
+
+def test_member_update_of_a_group_has_no_chat():
+    tmsg = parse('my_chat_member', {
+        'chat': {'id': -5, 'type': 'group'},
+        'from': SENDER,
+        'new_chat_member': {'status': 'kicked'}
+    })
+
+    assert tmsg.type == 'MEMBER_UPDATE'
+    assert tmsg.status == 'kicked'
+    assert tmsg.chat_id == 0
+
+
+def test_messages_have_no_dict():
+    tmsg = parse('message', message(text='hi'))
+
+    assert not hasattr(tmsg, '__dict__')
+    with pytest.raises(AttributeError):
+        tmsg.unknown = 1